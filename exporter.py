@@ -1,9 +1,10 @@
+import argparse
 import logging
-from os import getenv
+from functools import wraps
 from time import sleep
 from wsgiref.simple_server import make_server
 
-from flask import Flask
+from flask import Flask, Response, abort, request
 from flask_httpauth import HTTPBasicAuth
 from flask_healthz import healthz
 from prometheus_client import make_wsgi_app
@@ -11,33 +12,26 @@ from prometheus_client.core import CollectorRegistry
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from helpers.prometheus import SentryCollector
-from libs.sentry import SentryAPI
-
-# TODO - Move these settings to use Flask Ccnfiguration Handling
-# https://flask.palletsprojects.com/en/2.0.x/config/
-DEFAULT_BASE_URL = "https://sentry.io/api/0/"
-BASE_URL = getenv("SENTRY_BASE_URL") or DEFAULT_BASE_URL
-AUTH_TOKEN = getenv("SENTRY_AUTH_TOKEN")
-ORG_SLUG = getenv("SENTRY_EXPORTER_ORG")
-PROJECTS_SLUG = getenv("SENTRY_EXPORTER_PROJECTS")
-EXPORTER_BASIC_AUTH = getenv("SENTRY_EXPORTER_BASIC_AUTH") or "False"
-EXPORTER_BASIC_AUTH_USER = getenv("SENTRY_EXPORTER_BASIC_AUTH_USER") or "prometheus"
-EXPORTER_BASIC_AUTH_PASS = getenv("SENTRY_EXPORTER_BASIC_AUTH_PASS") or "prometheus"
-LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
-SENTRY_USE_LEGACY_API = getenv("SENTRY_USE_LEGACY_API", "True")
+from helpers.config import (
+    AUTH_TOKEN,
+    DEFAULT_BASIC_AUTH_PASS,
+    EXPORTER_BASIC_AUTH,
+    EXPORTER_BASIC_AUTH_PASS,
+    EXPORTER_BASIC_AUTH_USER,
+    EXPORTER_DEBUG_ENDPOINTS,
+    ORG_SLUG,
+    PROJECTS_SLUG,
+    SHARED_EXPOSITION,
+    build_collector,
+    build_sentry_api,
+    configure_logging,
+    get_metric_config,
+)
+from helpers.prometheus import WEBHOOK_SECRET
 
 log = logging.getLogger("exporter")
 gunicorn_error_logger = logging.getLogger("gunicorn.error")
-level = logging.getLevelName(LOG_LEVEL)
-logging.basicConfig(
-    level=logging.getLevelName(level),
-    format="[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S %z",
-)
-
-registry = CollectorRegistry()
-current_collector = None
+configure_logging()
 
 app = Flask(__name__)
 app.register_blueprint(healthz, url_prefix="/healthz")
@@ -70,23 +64,42 @@ def verify_password(username, password):
         return username
 
 
-def get_metric_config():
-    """Get metric scraping options."""
-    scrape_issue_metrics = getenv("SENTRY_SCRAPE_ISSUE_METRICS") or "True"
-    scrape_events_metrics = getenv("SENTRY_SCRAPE_EVENT_METRICS") or "True"
-    scrape_rate_limit_metrics = getenv("SENTRY_SCRAPE_RATE_LIMIT_METRICS") or "False"
-    default_for_time_metrics = "True" if scrape_issue_metrics == "True" else "False"
-    get_1h_metrics = getenv("SENTRY_ISSUES_1H") or default_for_time_metrics
-    get_24h_metrics = getenv("SENTRY_ISSUES_24H") or default_for_time_metrics
-    get_14d_metrics = getenv("SENTRY_ISSUES_14D") or default_for_time_metrics
-    return [
-        scrape_issue_metrics,
-        scrape_events_metrics,
-        scrape_rate_limit_metrics,
-        get_1h_metrics,
-        get_24h_metrics,
-        get_14d_metrics,
-    ]
+def get_scrape_timeout():
+    """Get the scrape timeout Prometheus sends along each scrape, None if there is none."""
+    try:
+        return float(request.headers.get("X-Prometheus-Scrape-Timeout-Seconds"))
+    except (TypeError, ValueError):
+        return None
+
+
+def debug_endpoints_enabled():
+    """Whether the debug endpoints are served, never with the default basic auth password.
+
+    A refresh profile crawls the whole Sentry API, so it must not be reachable with publicly
+    known credentials.
+    """
+    if EXPORTER_DEBUG_ENDPOINTS != "True":
+        return False
+    if EXPORTER_BASIC_AUTH_PASS == DEFAULT_BASIC_AUTH_PASS:
+        log.error(
+            "debug: SENTRY_EXPORTER_DEBUG_ENDPOINTS requires SENTRY_EXPORTER_BASIC_AUTH_PASS "
+            "to be changed from its default, debug endpoints disabled"
+        )
+        return False
+    return True
+
+
+def debug_endpoint(view):
+    """Serve a debug endpoint only when enabled (404 otherwise), then authenticate the client"""
+    authenticated_view = auth.login_required(view)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not debug_endpoints_enabled():
+            abort(404)
+        return authenticated_view(*args, **kwargs)
+
+    return wrapper
 
 
 @app.route("/")
@@ -99,24 +112,96 @@ def home():
 @app.route("/metrics/")
 @auth.login_required(optional=basic_auth_is_enabled(EXPORTER_BASIC_AUTH))
 def sentry_exporter():
-    global current_collector
-    sentry = SentryAPI(BASE_URL, AUTH_TOKEN, use_legacy_api=(SENTRY_USE_LEGACY_API == "True"))
+    if SHARED_EXPOSITION == "True" and "name[]" not in request.args:
+        from helpers import exposition
 
-    if current_collector is not None:
-        log.info("exporter: cleaning registry collectors...")
-        registry.unregister(current_collector)
-
-    current_collector = SentryCollector(sentry, ORG_SLUG, get_metric_config(), PROJECTS_SLUG)
-    registry.register(current_collector)
+        shared = exposition.serve(
+            request.headers.get("Accept"), request.headers.get("Accept-Encoding")
+        )
+        if shared is not None:
+            headers, length, chunks = shared
+            headers["Content-Length"] = str(length)
+            return Response(chunks, headers=headers, direct_passthrough=True)
+
+    # a registry per scrape, concurrent scrapes (i.e.: gthread workers) don't share collectors
+    registry = CollectorRegistry()
+    registry.register(build_collector(get_scrape_timeout()))
     exporter = DispatcherMiddleware(app.wsgi_app, {"/metrics": make_wsgi_app(registry=registry)})
     return exporter
 
 
+@app.route("/webhooks/sentry", methods=["POST"])
+def sentry_webhook():
+    """Apply Sentry integration webhooks to the cached data, see helpers.webhooks.
+
+    Sentry can't use the exporter basic authentication, requests are authenticated
+    by their signature instead.
+    """
+    if not WEBHOOK_SECRET:
+        abort(404)
+
+    from helpers.webhooks import queue_webhook, verify_signature
+
+    if not verify_signature(
+        WEBHOOK_SECRET, request.get_data(), request.headers.get("Sentry-Hook-Signature")
+    ):
+        log.warning("webhooks: invalid signature from {addr}".format(addr=request.remote_addr))
+        abort(401)
+
+    queue_webhook(request.headers.get("Sentry-Hook-Resource"), request.get_json(silent=True) or {})
+    return "", 204
+
+
+@app.route("/debug/profile")
+@debug_endpoint
+def debug_profile():
+    """Profile one refresh or one scrape, see helpers.debug.
+
+    Query parameters: target (refresh or scrape), sort (cumulative, tottime or calls)
+    and limit (number of functions reported).
+    """
+    from helpers.debug import profile
+
+    try:
+        stats = profile(
+            request.args.get("target", "scrape"),
+            request.args.get("sort", "cumulative"),
+            request.args.get("limit", 40, type=int),
+        )
+    except ValueError as err:
+        return str(err), 400, {"Content-Type": "text/plain"}
+    return stats, 200, {"Content-Type": "text/plain"}
+
+
+@app.route("/debug/memory")
+@debug_endpoint
+def debug_memory():
+    """Report the snapshot memory usage and the top allocation sites of a scrape"""
+    from helpers.debug import memory
+
+    return memory(request.args.get("limit", 20, type=int)), 200, {"Content-Type": "text/plain"}
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sentry Issues & Events Exporter")
+    subcommands = parser.add_subparsers(dest="command")
+    subcommands.add_parser(
+        "plan",
+        help="estimate the Sentry API requests a refresh costs with the current settings, "
+        "only the organization, projects and environments are requested",
+    )
+    args = parser.parse_args()
+
     if not ORG_SLUG or not AUTH_TOKEN:
         log.error("ENVs: SENTRY_AUTH_TOKEN or SENTRY_EXPORTER_ORG was not found!")
         exit(1)
 
+    if args.command == "plan":
+        from helpers.planner import plan
+
+        print(plan(build_sentry_api(), ORG_SLUG, PROJECTS_SLUG, get_metric_config()), end="")
+        exit(0)
+
     log.info("auth: basic authentication enabled: {}".format(EXPORTER_BASIC_AUTH))
 
     if (
@@ -0,0 +1,48 @@
+"""Gunicorn deployment profile for the exporter.
+
+Run with ``gunicorn -c gunicorn.conf.py exporter:app``. The app is preloaded once in the
+master, a single refresher process crawls the Sentry API in the background and the threaded
+workers only serve the cached data, so a slow crawl never blocks a scrape.
+
+The objects preloaded by the master are frozen before the workers are forked, so the
+workers' garbage collections don't write to, and copy, the memory pages they share.
+"""
+
+import gc
+import os
+from os import getenv
+
+# must be set before the app is preloaded, helpers.prometheus reads it at import time
+os.environ.setdefault("SENTRY_EXPORTER_REFRESH_MODE", "background")
+
+bind = getenv("GUNICORN_BIND", "0.0.0.0:9790")
+workers = int(getenv("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(getenv("GUNICORN_THREADS", "4"))
+preload_app = True
+timeout = int(getenv("GUNICORN_TIMEOUT", "60"))
+gc_freeze = getenv("GUNICORN_GC_FREEZE", "True")
+
+refresher = None
+
+
+def when_ready(server):
+    global refresher
+    from helpers import refresher as sentry_refresher
+    from helpers.prometheus import REFRESH_MODE, WARMUP
+
+    # the background refresher first refresh is the warm-up
+    if REFRESH_MODE == "background":
+        refresher = sentry_refresher.start()
+    elif WARMUP == "True":
+        refresher = sentry_refresher.start(once=True)
+
+    # when_ready runs right before the first workers are forked
+    if gc_freeze == "True":
+        gc.collect()
+        gc.freeze()
+
+
+def on_exit(server):
+    if refresher is not None and refresher.poll() is None:
+        refresher.terminate()
@@ -0,0 +1,89 @@
+"""Per project and endpoint circuit breakers.
+
+A project whose endpoints keep failing (server errors, timeouts, ...) would otherwise be
+retried inline on every refresh, delaying every other project. Each project endpoint gets
+its own circuit breaker: after ``SENTRY_BREAKER_FAILURES`` consecutive failures it opens
+and the endpoint isn't requested anymore for ``SENTRY_BREAKER_COOLDOWN`` seconds, then a
+single trial request closes it again or reopens it. Meanwhile the collector keeps serving
+the last good data of the project, and the breakers state tells how old it is.
+
+The state is a plain dict stored in the collector's data structure:
+
+    state = {
+        "project_slug/issues": {"failures": 0, "open_until": 0.0, "last_success": 1614556800.0}
+    }
+"""
+
+import logging
+import threading
+from os import getenv
+from time import time
+
+log = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = int(getenv("SENTRY_BREAKER_FAILURES", "3"))
+COOLDOWN = int(getenv("SENTRY_BREAKER_COOLDOWN", "300"))
+
+
+def breaker_key(project_slug, endpoint):
+    return "{proj}/{endpoint}".format(proj=project_slug, endpoint=endpoint)
+
+
+class CircuitBreakers(object):
+    """A simple :class:`CircuitBreakers <CircuitBreakers>` guarding the project API calls.
+
+    Typical usage example:
+
+      >>> breakers = CircuitBreakers(previous_state)
+      >>> stats = breakers.call("backend/stats", sentry.project_stats, org_slug, "backend")
+      >>> if stats is None:
+      ...     stats = previous_stats
+      >>> data["breakers"] = breakers.state
+    """
+
+    def __init__(self, state=None):
+        """Inits CircuitBreakers with the state of the previous refresh"""
+        super(CircuitBreakers, self).__init__()
+        self.state = {key: dict(entry) for key, entry in (state or {}).items()}
+        self.__lock = threading.Lock()
+
+    def is_open(self, key):
+        entry = self.state.get(key) or {}
+        return entry.get("open_until", 0) > time()
+
+    def call(self, key, func, *args, **kwargs):
+        """Call func unless the key circuit is open.
+
+        Returns:
+            The func result, or None if the circuit is open or the call failed.
+        """
+        if self.is_open(key):
+            log.debug("breaker: {key} circuit open, skipping".format(key=key))
+            return None
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            with self.__lock:
+                entry = self.state.setdefault(key, {"failures": 0, "open_until": 0.0})
+                entry["failures"] = entry.get("failures", 0) + 1
+                if entry["failures"] >= FAILURE_THRESHOLD:
+                    entry["open_until"] = time() + COOLDOWN
+                    log.warning(
+                        "breaker: {key} failed {num} times, circuit open for {cooldown}s: "
+                        "{err}".format(key=key, num=entry["failures"], cooldown=COOLDOWN, err=err)
+                    )
+                else:
+                    log.warning("breaker: {key} failed: {err}".format(key=key, err=err))
+            return None
+
+        with self.__lock:
+            self.state[key] = {"failures": 0, "open_until": 0.0, "last_success": time()}
+        return result
+
+    def forget(self, projects_slug):
+        """Drop the breakers of the projects that no longer exist"""
+        projects_slug = set(projects_slug)
+        for key in list(self.state):
+            if key.rsplit("/", 1)[0] not in projects_slug:
+                self.state.pop(key)
@@ -0,0 +1,79 @@
+"""Exporter settings, shared by the Flask app, the standalone server and the refresher.
+
+This module doesn't import Flask, so the standalone server (helpers.server) and the
+refresher process don't pay for it.
+"""
+
+import logging
+from os import getenv
+
+DEFAULT_BASE_URL = "https://sentry.io/api/0/"
+BASE_URL = getenv("SENTRY_BASE_URL") or DEFAULT_BASE_URL
+AUTH_TOKEN = getenv("SENTRY_AUTH_TOKEN")
+ORG_SLUG = getenv("SENTRY_EXPORTER_ORG")
+PROJECTS_SLUG = getenv("SENTRY_EXPORTER_PROJECTS")
+EXPORTER_BASIC_AUTH = getenv("SENTRY_EXPORTER_BASIC_AUTH") or "False"
+DEFAULT_BASIC_AUTH_PASS = "prometheus"
+EXPORTER_BASIC_AUTH_USER = getenv("SENTRY_EXPORTER_BASIC_AUTH_USER") or "prometheus"
+EXPORTER_BASIC_AUTH_PASS = getenv("SENTRY_EXPORTER_BASIC_AUTH_PASS") or DEFAULT_BASIC_AUTH_PASS
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
+SENTRY_USE_LEGACY_API = getenv("SENTRY_USE_LEGACY_API", "True")
+EXPORTER_DEBUG_ENDPOINTS = getenv("SENTRY_EXPORTER_DEBUG_ENDPOINTS") or "False"
+# scrapes serve the exposition rendered by the refresher, see helpers.exposition
+SHARED_EXPOSITION = getenv("SENTRY_EXPORTER_SHARED_EXPOSITION") or "False"
+
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.getLevelName(LOG_LEVEL),
+        format="[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S %z",
+    )
+
+
+def get_metric_config():
+    """Get metric scraping options."""
+    scrape_issue_metrics = getenv("SENTRY_SCRAPE_ISSUE_METRICS") or "True"
+    scrape_events_metrics = getenv("SENTRY_SCRAPE_EVENT_METRICS") or "True"
+    scrape_rate_limit_metrics = getenv("SENTRY_SCRAPE_RATE_LIMIT_METRICS") or "False"
+    scrape_event_stream_metrics = getenv("SENTRY_SCRAPE_EVENT_STREAM_METRICS") or "False"
+    scrape_release_metrics = getenv("SENTRY_SCRAPE_RELEASE_METRICS") or "False"
+    default_for_time_metrics = "True" if scrape_issue_metrics == "True" else "False"
+    get_1h_metrics = getenv("SENTRY_ISSUES_1H") or default_for_time_metrics
+    get_24h_metrics = getenv("SENTRY_ISSUES_24H") or default_for_time_metrics
+    get_14d_metrics = getenv("SENTRY_ISSUES_14D") or default_for_time_metrics
+    scrape_rollup_metrics = getenv("SENTRY_SCRAPE_ROLLUP_METRICS") or default_for_time_metrics
+    scrape_event_rate_metrics = getenv("SENTRY_SCRAPE_ISSUE_RATE_METRICS") or "False"
+    return [
+        scrape_issue_metrics,
+        scrape_events_metrics,
+        scrape_rate_limit_metrics,
+        get_1h_metrics,
+        get_24h_metrics,
+        get_14d_metrics,
+        scrape_event_stream_metrics,
+        scrape_release_metrics,
+        scrape_rollup_metrics,
+        scrape_event_rate_metrics,
+    ]
+
+
+def build_sentry_api():
+    """Return a SentryAPI configured from the environment"""
+    from libs.sentry import SentryAPI
+
+    return SentryAPI(BASE_URL, AUTH_TOKEN, use_legacy_api=(SENTRY_USE_LEGACY_API == "True"))
+
+
+def build_collector(scrape_timeout=None):
+    """Return a SentryCollector configured from the environment.
+
+    Args:
+        scrape_timeout: Optional; see SentryCollector.
+    """
+    from helpers.prometheus import SentryCollector
+
+    sentry = build_sentry_api()
+    return SentryCollector(
+        sentry, ORG_SLUG, get_metric_config(), PROJECTS_SLUG, scrape_timeout=scrape_timeout
+    )
@@ -0,0 +1,101 @@
+"""Profiling helpers behind the exporter's ``/debug/profile`` and ``/debug/memory`` endpoints.
+
+Both endpoints are disabled unless ``SENTRY_EXPORTER_DEBUG_ENDPOINTS=True``, this module is
+only imported when one of them is requested, so they cost nothing otherwise.
+"""
+
+import cProfile
+import io
+import marshal
+import pstats
+import tracemalloc
+
+from prometheus_client import generate_latest
+from prometheus_client.core import CollectorRegistry
+
+from helpers.config import build_collector
+from helpers.prometheus import CACHE_FILE, SNAPSHOT_SCHEMA_VERSION
+from helpers.utils import get_cached
+
+PROFILE_TARGETS = ("refresh", "scrape")
+PROFILE_SORT_KEYS = ("cumulative", "tottime", "calls")
+
+
+def scrape(collector):
+    """Render the exposition of a single collector, the way a scrape does"""
+    registry = CollectorRegistry()
+    registry.register(collector)
+    return generate_latest(registry)
+
+
+def profile(target="scrape", sort="cumulative", limit=40):
+    """Run one refresh or one scrape under cProfile and return the formatted stats.
+
+    Args:
+        target: Optional; "refresh" rebuilds the data structure from the Sentry API (and
+            stores it into the cache), "scrape" renders the metrics from the cache.
+        sort: Optional; pstats sort key, one of PROFILE_SORT_KEYS.
+        limit: Optional; number of functions reported.
+    """
+    if target not in PROFILE_TARGETS:
+        raise ValueError("profile target must be one of: {0}".format(", ".join(PROFILE_TARGETS)))
+    if sort not in PROFILE_SORT_KEYS:
+        raise ValueError("profile sort must be one of: {0}".format(", ".join(PROFILE_SORT_KEYS)))
+
+    collector = build_collector()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        if target == "refresh":
+            collector.refresh()
+        else:
+            scrape(collector)
+    finally:
+        profiler.disable()
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def memory(limit=20):
+    """Report the memory used by the current snapshot and the top allocation sites of a scrape.
+
+    The snapshot is loaded from the cache with tracemalloc tracing, each top level key is then
+    measured on its own, and the allocations of a whole scrape are grouped by source line.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.clear_traces()
+        data = get_cached(CACHE_FILE, expired_ok=True, schema_version=SNAPSHOT_SCHEMA_VERSION)
+        if data is False:
+            return "snapshot not built yet\n"
+        snapshot_size = tracemalloc.get_traced_memory()[0]
+
+        keys_size = []
+        for key, value in data.items():
+            encoded = marshal.dumps(value)
+            before = tracemalloc.get_traced_memory()[0]
+            loaded = marshal.loads(encoded)
+            keys_size.append((tracemalloc.get_traced_memory()[0] - before, key))
+            del loaded, encoded
+        del data
+
+        tracemalloc.clear_traces()
+        scrape(build_collector())
+        top_stats = tracemalloc.take_snapshot().statistics("lineno")
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    lines = ["snapshot: {size:.1f} KiB".format(size=snapshot_size / 1024.0)]
+    for size, key in sorted(keys_size, reverse=True):
+        lines.append("  {key}: {size:.1f} KiB".format(key=key, size=size / 1024.0))
+    lines.append("")
+    lines.append("scrape top {limit} allocation sites:".format(limit=limit))
+    for stat in top_stats[:limit]:
+        lines.append("  {0}".format(stat))
+    return "\n".join(lines) + "\n"
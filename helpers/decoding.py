@@ -0,0 +1,106 @@
+"""Decoding of the issues list responses, optionally spread over a pool of processes.
+
+Decoding the issues JSON and indexing them is CPU bound and, for organizations with
+thousands of projects, caps the refresh speed to a single core. With
+``SENTRY_EXPORTER_DECODE_WORKERS`` set, the raw response bodies are shipped to worker
+processes which decode them and return compact issues: only the fields the exporter uses,
+with their date labels already derived, along with the sum of their events. The compact
+issues are much cheaper to send back to the collector, and to store into the cache, than
+the full API payload.
+"""
+
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+
+from helpers.utils import iso_date_label
+
+log = logging.getLogger(__name__)
+
+# 0 decodes the responses in the collector process
+DECODE_WORKERS = int(getenv("SENTRY_EXPORTER_DECODE_WORKERS", "0"))
+
+# issue fields used by the collector, the issue queries, the adaptive scheduler and the webhooks
+ISSUE_FIELDS = (
+    "id",
+    "count",
+    "userCount",
+    "level",
+    "status",
+    "platform",
+    "logger",
+    "project",
+    "isUnhandled",
+    "firstSeen",
+    "lastSeen",
+    "assignedTo",
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def decode_issues(body, stats=False):
+    """Decode an issues list response body into compact issues.
+
+    Adds ``firstSeenDate`` and ``lastSeenDate`` (``YYYY-MM-DD``) keys to every issue so
+    ``collect()`` doesn't need to parse any timestamp on each scrape.
+
+    Args:
+        body: The raw response body bytes.
+        stats: Optional; also keep the issues events time buckets (``stats``).
+
+    Returns:
+        A list of issue dicts holding the ISSUE_FIELDS only.
+    """
+    fields = ISSUE_FIELDS + ("stats",) if stats else ISSUE_FIELDS
+    issues = []
+    for issue in json.loads(body):
+        compact = {field: issue.get(field) for field in fields if field in issue}
+        compact["firstSeenDate"] = iso_date_label(issue.get("firstSeen"))
+        compact["lastSeenDate"] = iso_date_label(issue.get("lastSeen"))
+        issues.append(compact)
+    return issues
+
+
+def sum_events(issues):
+    """Return the sum of the issues events counts"""
+    return sum(int(issue.get("count") or 0) for issue in issues or [])
+
+
+def decode_and_sum(body, stats=False):
+    """Decode an issues list response body, see `decode_issues()`, and sum their events.
+
+    Returns:
+        A (issues, events) tuple.
+    """
+    issues = decode_issues(body, stats)
+    return issues, sum_events(issues)
+
+
+def issues_events(issues_by_age):
+    """Return the sum of the events of a project environment issues, per age"""
+    return {age: sum_events(issues) for age, issues in issues_by_age.items()}
+
+
+def decode_pool():
+    """Return the process pool decoding the responses, None if it's disabled.
+
+    The pool is started on first use and kept for the process lifetime. Its workers are
+    spawned rather than forked, so they don't inherit the threads and locks of the caller
+    (i.e.: a gunicorn gthread worker).
+    """
+    global _pool
+
+    if DECODE_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            log.info("decoding: starting {num} decoding processes".format(num=DECODE_WORKERS))
+            _pool = ProcessPoolExecutor(
+                max_workers=DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _pool
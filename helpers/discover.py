@@ -0,0 +1,257 @@
+"""User defined Discover queries: performance and error aggregates exported as gauges.
+
+Queries are read from the YAML file set in ``SENTRY_DISCOVER_QUERIES_FILE``:
+
+    queries:
+      - name: transaction_duration
+        dataset: transactions
+        query: "event.type:transaction"
+        fields: ["p95(transaction.duration)", "failure_rate()"]
+        groupby: ["project", "transaction"]
+        period: 1h
+        ttl: 300
+      - name: errors
+        type: events-stats
+        query: "event.type:error"
+        fields: ["count()"]
+        period: 1h
+        interval: 5m
+
+``events`` queries (the default type) are Discover tables: each row of aggregates, grouped by
+the ``groupby`` fields or tags, is a sample labelled with the group values. ``events-stats``
+queries are time series: the last complete bucket of each aggregate is exported, for the
+whole organization.
+
+Each query is a single request scoped to all the exported projects (``project=-1`` unless a
+project list is set), through the organization ``events``/``events-stats`` endpoints, so the
+refresh cost grows with the number of queries rather than the number of projects. Results are
+cached per query for its ``ttl`` and a failing query keeps its previous results. The state is stored in the collector's data
+structure:
+
+    state = {
+        "transaction_duration": {
+            "definition": "...",
+            "expire_at": 1614600000,
+            "labels": ["project_slug", "transaction"],
+            "rows": [["backend", "/checkout", "p95(transaction.duration)", 250.0]],
+        }
+    }
+
+each row ending with the aggregate and its value.
+"""
+
+import logging
+import os
+import re
+from datetime import datetime
+from os import getenv
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+DISCOVER_FILE = getenv("SENTRY_DISCOVER_QUERIES_FILE")
+MAX_PAGES = int(getenv("SENTRY_DISCOVER_MAX_PAGES", "5"))
+DEFAULT_TTL = int(getenv("SENTRY_DISCOVER_CACHE_TTL", "300"))
+DEFAULT_PERIOD = "1h"
+DEFAULT_INTERVAL = "5m"
+QUERY_TYPES = ("events", "events-stats")
+
+_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+# queries of each file, with its modification time, see load_discover_queries()
+_loaded = {}
+
+
+def _label_name(field):
+    """Prometheus label name of a groupby field, project slugs keep the exporter's label"""
+    if field == "project":
+        return "project_slug"
+    return re.sub(r"[^a-zA-Z0-9_]", "_", field)
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [str(item) for item in (value if isinstance(value, list) else [value])]
+
+
+def _parse_query(query):
+    if not isinstance(query, dict):
+        raise ValueError("discover queries must be mappings: {0}".format(query))
+    name = str(query.get("name") or "")
+    fields = _as_list(query.get("fields"))
+    query_type = str(query.get("type") or "events")
+    if not _NAME.match(name) or not fields:
+        raise ValueError(
+            "discover queries need a name (letters, digits and underscores) and fields: "
+            "{0}".format(query)
+        )
+    if query_type not in QUERY_TYPES:
+        raise ValueError("discover query type must be one of: {0}".format(", ".join(QUERY_TYPES)))
+    groupby = _as_list(query.get("groupby", ["project"]))
+    if query_type == "events-stats" and query.get("groupby"):
+        raise ValueError("events-stats discover queries can't be grouped: {0}".format(name))
+    labels = [_label_name(field) for field in groupby]
+    if "aggregate" in labels or len(set(labels)) < len(labels):
+        raise ValueError(
+            "discover query {0} groupby labels must be distinct and not aggregate".format(name)
+        )
+    return {
+        "name": name,
+        "type": query_type,
+        "dataset": str(query.get("dataset") or ""),
+        "query": str(query.get("query") or ""),
+        "fields": fields,
+        "groupby": groupby if query_type == "events" else [],
+        "period": str(query.get("period") or DEFAULT_PERIOD),
+        "interval": str(query.get("interval") or DEFAULT_INTERVAL),
+        "ttl": int(query.get("ttl") or DEFAULT_TTL),
+    }
+
+
+def load_discover_queries(filename=DISCOVER_FILE):
+    """Return the list of queries defined in the Discover queries file, empty if there is none.
+
+    The file is loaded once, until it's modified. An invalid query (or one reusing the name
+    of a previous query) is logged and skipped, and an unreadable file has no queries.
+    """
+    if not filename:
+        return []
+    try:
+        modified_at = os.path.getmtime(filename)
+        if _loaded.get(filename, (None, None))[0] == modified_at:
+            return _loaded[filename][1]
+        with open(filename) as queries_file:
+            config = yaml.safe_load(queries_file) or {}
+    except (OSError, yaml.YAMLError):
+        log.exception("discover: failed to load {file}".format(file=filename))
+        return []
+
+    queries = []
+    for query in (config.get("queries") if isinstance(config, dict) else None) or []:
+        try:
+            query = _parse_query(query)
+            if query.get("name") in [known.get("name") for known in queries]:
+                raise ValueError("duplicate discover query name: {0}".format(query.get("name")))
+        except (TypeError, ValueError) as err:
+            log.error("discover: skipping invalid query: {err}".format(err=err))
+            continue
+        queries.append(query)
+    _loaded[filename] = (modified_at, queries)
+    return queries
+
+
+def _value(row, field):
+    """Return a row aggregate, older Sentry versions key them by an underscored alias"""
+    if field in row:
+        return row.get(field)
+    return row.get(re.sub(r"[^a-zA-Z0-9]+", "_", field).strip("_"))
+
+
+def _table_rows(sentry_api, org_slug, projects, query):
+    rows = []
+    pages = sentry_api.discover_pages(
+        org_slug,
+        projects,
+        query.get("groupby") + query.get("fields"),
+        query.get("query"),
+        query.get("period"),
+        query.get("dataset"),
+    )
+    for page_number, page in enumerate(pages, start=1):
+        for row in page.get("data") or []:
+            labels = [str(row.get(field)) for field in query.get("groupby")]
+            for field in query.get("fields"):
+                value = _value(row, field)
+                if value is not None:
+                    rows.append(labels + [field, float(value)])
+        if page_number >= MAX_PAGES:
+            log.warning(
+                "discover: {name} has more than {pages} pages of rows".format(
+                    name=query.get("name"), pages=MAX_PAGES
+                )
+            )
+            break
+    return rows
+
+
+def _stats_rows(sentry_api, org_slug, projects, query):
+    stats = sentry_api.events_stats(
+        org_slug,
+        projects,
+        query.get("fields"),
+        query.get("query"),
+        query.get("period"),
+        query.get("interval"),
+        query.get("dataset"),
+    )
+    # a single y axis isn't keyed by its aggregate
+    if len(query.get("fields")) == 1 and "data" in stats:
+        stats = {query.get("fields")[0]: stats}
+    rows = []
+    for field in query.get("fields"):
+        buckets = (stats.get(field) or {}).get("data") or []
+        # the last bucket is still filling up
+        if len(buckets) < 2:
+            continue
+        value = sum(item.get("count") or 0 for item in buckets[-2][1])
+        rows.append([field, float(value)])
+    return rows
+
+
+def run_discover_queries(queries, sentry_api, org_slug, projects, state=None, now=None):
+    """Run the Discover queries whose cached results expired.
+
+    Args:
+        queries: A list of queries as returned by `load_discover_queries()`.
+        sentry_api: SentryAPI instance.
+        org_slug: A organization slug string name.
+        projects: A list of project dicts the queries are scoped to, None for all the
+            organization's projects.
+        state: Optional; the state returned by the previous refresh.
+        now: Optional; current timestamp, defaults to the current time.
+
+    Returns:
+        The new Discover queries state.
+    """
+    state = state or {}
+    if projects is not None and not projects:
+        return {}
+    if now is None:
+        now = datetime.timestamp(datetime.now())
+
+    new_state = {}
+    for query in queries:
+        definition = repr(sorted(query.items()))
+        previous = state.get(query.get("name"))
+        if previous and previous.get("definition") == definition:
+            if previous.get("expire_at") > now:
+                new_state[query.get("name")] = previous
+                continue
+        else:
+            previous = None
+
+        log.debug("discover: running {name} query".format(name=query.get("name")))
+        try:
+            if query.get("type") == "events-stats":
+                rows = _stats_rows(sentry_api, org_slug, projects, query)
+            else:
+                rows = _table_rows(sentry_api, org_slug, projects, query)
+        except Exception:
+            log.exception(
+                "discover: {name} query failed, keeping its previous results".format(
+                    name=query.get("name")
+                )
+            )
+            if previous:
+                new_state[query.get("name")] = previous
+            continue
+
+        new_state[query.get("name")] = {
+            "definition": definition,
+            "expire_at": int(now + query.get("ttl")),
+            "labels": [_label_name(field) for field in query.get("groupby")],
+            "rows": rows,
+        }
+    return new_state
@@ -0,0 +1,144 @@
+"""Incremental tailing of the projects events stream.
+
+Instead of listing every event on each refresh, the tailer follows each project's events
+list newest first and stops at the ``dateReceived`` watermark reached by the previous refresh,
+so the refresh cost grows with the number of new events rather than with the history. The list
+is ordered by event time though, and an event can be received well after it happened (i.e.: an
+offline mobile client): the tailer keeps reading ``SENTRY_EVENTS_LATE_WINDOW`` seconds past the
+watermark, and remembers the events received over that window so they're only counted once.
+
+The state is a plain dict stored in the collector's data structure, so it survives across
+refreshes and processes:
+
+    state = {
+        "project_slug": {
+            "watermark": 1614556800.0,
+            "seen": {"event_id": 1614556800.0},
+            "lag_bounds": [1.0, 5.0, ...],
+            "envs": {
+                "production": {"count": 10, "lag_buckets": [0, 2, ...], "lag_sum": 12.5}
+            }
+        }
+    }
+"""
+
+import logging
+from datetime import datetime, timezone
+from os import getenv
+
+log = logging.getLogger(__name__)
+
+MAX_PAGES = int(getenv("SENTRY_EVENTS_MAX_PAGES", "10"))
+LATE_WINDOW = float(getenv("SENTRY_EVENTS_LATE_WINDOW", "300"))
+LAG_BUCKETS = [
+    float(bucket)
+    for bucket in getenv("SENTRY_EVENTS_LAG_BUCKETS", "1,5,15,30,60,300,900,3600").split(",")
+]
+
+
+def parse_timestamp(timestamp):
+    """Return the epoch seconds of a Sentry ISO-8601 timestamp, None if it's missing"""
+    if not timestamp:
+        return None
+    timestamp = str(timestamp).replace("Z", "")
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in timestamp else "%Y-%m-%dT%H:%M:%S"
+    try:
+        return datetime.strptime(timestamp[:26], fmt).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def event_environment(event):
+    """Return the environment tag value of an event"""
+    for tag in event.get("tags") or []:
+        if tag.get("key") == "environment":
+            return tag.get("value")
+    return None
+
+
+def _observe(env_state, lag):
+    """Add one event with the given ingestion lag to an environment running aggregates"""
+    env_state["count"] += 1
+    if lag is None:
+        return
+    lag = max(lag, 0.0)
+    env_state["lag_sum"] += lag
+    for index, bound in enumerate(LAG_BUCKETS):
+        if lag <= bound:
+            env_state["lag_buckets"][index] += 1
+            break
+    else:
+        env_state["lag_buckets"][-1] += 1
+
+
+def tail_project_events(sentry_api, org_slug, project, project_state=None):
+    """Process the events received by a project since the last refresh.
+
+    Args:
+        sentry_api: SentryAPI instance.
+        org_slug: A organization slug string name.
+        project: dict instance of a project.
+        project_state: Optional; the project state returned by the previous refresh.
+
+    Returns:
+        The new project state. On the first refresh only the watermark is set, the running
+        aggregates start counting from there.
+    """
+    state = project_state or {"watermark": None, "seen": {}, "envs": {}}
+    if state.get("lag_bounds") != LAG_BUCKETS:
+        # buckets configuration changed, the running aggregates can't be reused
+        state["envs"], state["lag_bounds"] = {}, LAG_BUCKETS
+    watermark = state.get("watermark")
+    seen = dict(state.get("seen"))
+    new_watermark = watermark
+    processed = 0
+
+    pages = sentry_api.events_pages(org_slug, project, full=True)
+    for page_number, page in enumerate(pages, start=1):
+        reached_watermark = False
+        for event in page:
+            received = parse_timestamp(event.get("dateReceived") or event.get("dateCreated"))
+            if received is None:
+                continue
+            created = parse_timestamp(event.get("dateCreated"))
+            # the list is ordered by event time, events received late are looked for over the
+            # window, anything older was listed by a previous refresh
+            listed_at = created if created is not None else received
+            if watermark is not None and listed_at < watermark - LATE_WINDOW:
+                reached_watermark = True
+                break
+            if event.get("id") in seen:
+                continue
+            seen[event.get("id")] = received
+            if new_watermark is None or received > new_watermark:
+                new_watermark = received
+            if watermark is None:
+                continue
+
+            env = str(event_environment(event))
+            env_state = state["envs"].setdefault(
+                env, {"count": 0, "lag_buckets": [0] * (len(LAG_BUCKETS) + 1), "lag_sum": 0.0}
+            )
+            _observe(env_state, received - created if created is not None else None)
+            processed += 1
+
+        if reached_watermark or watermark is None:
+            break
+        if page_number >= MAX_PAGES:
+            log.warning(
+                "events: {proj} has more than {pages} pages of new events, "
+                "skipping the rest".format(proj=project.get("slug"), pages=MAX_PAGES)
+            )
+            break
+
+    log.debug(
+        "events: {proj} processed {num} new events".format(proj=project.get("slug"), num=processed)
+    )
+    state["watermark"] = new_watermark
+    # only the events the next refresh can list again are remembered
+    state["seen"] = {
+        event_id: received
+        for event_id, received in seen.items()
+        if received >= new_watermark - LATE_WINDOW
+    }
+    return state
@@ -0,0 +1,139 @@
+"""Pre-rendered exposition, shared by the forked workers through the page cache.
+
+Each worker loading the snapshot on a scrape keeps its own copy of the decoded dicts and
+strings: with gunicorn forking several workers, the memory grows with the number of workers
+even though they all serve identical data. With ``SENTRY_EXPORTER_SHARED_EXPOSITION=True``
+(background refresh mode only) the refresher renders the exposition once per refresh, in the
+text and OpenMetrics formats, plain and gzip compressed, into files next to the cache file.
+Scrapes then stream the file matching the request from a read-only memory map, in small
+chunks: the pages are shared by every worker and the snapshot is never loaded.
+
+The snapshot age and scrape partial families are still rendered on each scrape, ahead of the
+pre-rendered ones (a gzip compressed response is then two gzip members, which is valid gzip).
+Other time relative values, i.e. ``sentry_exporter_project_data_age_seconds``, are as old as
+the exposition. Exposition files older than the cache file (i.e.: the refresher isn't
+rendering them), or removed after a webhook updated the cache, are ignored and the scrape
+falls back to loading the snapshot until the refresher renders them again.
+"""
+
+import gzip
+import logging
+import mmap
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CollectorRegistry
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+from prometheus_client.openmetrics import exposition as openmetrics
+
+import helpers.prometheus as prometheus
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+FORMATS = {
+    "text": (generate_latest, CONTENT_TYPE_LATEST),
+    "openmetrics": (openmetrics.generate_latest, openmetrics.CONTENT_TYPE_LATEST),
+}
+# rendered on each scrape, see prometheus.snapshot_families()
+LIVE_FAMILIES = ("sentry_exporter_snapshot_age_seconds", "sentry_exporter_scrape_partial")
+
+
+class _Families(object):
+    """Collector yielding a fixed list of metric families"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+
+def exposition_file(fmt, compressed=False):
+    """Return the path of the pre-rendered exposition of a format, see FORMATS"""
+    return "{cache}.{fmt}{ext}".format(
+        cache=prometheus.CACHE_FILE, fmt=fmt, ext=".gz" if compressed else ""
+    )
+
+
+def _write(filename, output):
+    # write then rename, so the workers never map a partial file
+    tmp_filename = "{file}.{pid}.tmp".format(file=filename, pid=os.getpid())
+    with open(tmp_filename, "wb") as exposition:
+        exposition.write(output)
+    os.replace(tmp_filename, filename)
+
+
+def render(collector):
+    """Render the collector's metrics, but the live ones, into the exposition files.
+
+    The snapshot is collected once for all the formats. The compressed files are written
+    first, since the plain text file modification time tells whether they're up to date.
+    """
+    families = [family for family in collector.collect() if family.name not in LIVE_FAMILIES]
+    registry = CollectorRegistry()
+    registry.register(_Families(families))
+    for fmt, (encoder, _) in FORMATS.items():
+        output = encoder(registry)
+        _write(exposition_file(fmt, compressed=True), gzip.compress(output, 6))
+        _write(exposition_file(fmt), output)
+    log.debug("exposition: rendered {num} families".format(num=len(families)))
+
+
+def invalidate():
+    """Mark the exposition stale, scrapes load the snapshot until the next rendering.
+
+    Removing the plain text files is enough: they tell whether the compressed ones are up to
+    date, see `serve()`.
+    """
+    for fmt in FORMATS:
+        try:
+            os.remove(exposition_file(fmt))
+        except FileNotFoundError:
+            pass
+
+
+def _live(fmt):
+    registry = CollectorRegistry()
+    registry.register(_Families(list(prometheus.snapshot_families())))
+    output = FORMATS[fmt][0](registry)
+    # the OpenMetrics end of exposition marker ends the pre-rendered families
+    return output[: -len(b"# EOF\n")] if fmt == "openmetrics" else output
+
+
+def serve(accept_header=None, accept_encoding_header=None):
+    """Return the pre-rendered exposition matching the request headers, or None if stale.
+
+    Returns:
+        A (headers, length, chunks) tuple: the response headers dict, the body length and
+        an iterator over the body chunks, which unmaps the file once exhausted or closed.
+    """
+    _, content_type = choose_encoder(accept_header)
+    fmt = "openmetrics" if content_type == openmetrics.CONTENT_TYPE_LATEST else "text"
+    compressed = gzip_accepted(accept_encoding_header or "")
+
+    try:
+        if os.path.getmtime(exposition_file(fmt)) < os.path.getmtime(prometheus.CACHE_FILE):
+            log.debug("exposition: older than the cache, loading the snapshot")
+            return None
+        with open(exposition_file(fmt, compressed), "rb") as exposition:
+            exposition_map = mmap.mmap(exposition.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    live = _live(fmt)
+    headers = {"Content-Type": FORMATS[fmt][1]}
+    if compressed:
+        live = gzip.compress(live, 1)
+        headers["Content-Encoding"] = "gzip"
+
+    def chunks():
+        try:
+            yield live
+            for offset in range(0, len(exposition_map), CHUNK_SIZE):
+                yield exposition_map[offset : offset + CHUNK_SIZE]
+        finally:
+            exposition_map.close()
+
+    return headers, len(live) + len(exposition_map), chunks()
@@ -0,0 +1,275 @@
+"""Sentry API cost planner, a dry run of the exporter configuration.
+
+Run with ``python exporter.py plan``. Only the cheap metadata requests are made (organization,
+projects and environments), then the number of requests a refresh costs is estimated per phase
+and endpoint from the same settings as the exporter. With the observed latency and the Sentry
+rate limit headers, it also tells whether the configuration fits the rate limit and the
+refresh interval.
+"""
+
+import logging
+from os import getenv
+from statistics import median
+from time import monotonic
+
+from helpers import discover, events, queries, releases
+from helpers.prometheus import (
+    CACHE_TTL,
+    KEYS_CACHE_TTL,
+    KEYS_FETCH_WORKERS,
+    REFRESH_INTERVAL,
+    REFRESH_MODE,
+    SCRAPE_TIMEOUT,
+    pad_metric_config,
+)
+
+log = logging.getLogger(__name__)
+
+# Sentry rate limits are enforced per second, unless told otherwise
+RATE_LIMIT_WINDOW = float(getenv("SENTRY_RATE_LIMIT_WINDOW", "1"))
+
+
+def estimate(
+    projects_envs,
+    metric_config,
+    remote_queries=0,
+    concurrency=1,
+    legacy_api=True,
+    projects_specified=False,
+    discover_queries=(),
+):
+    """Estimate the requests a refresh costs.
+
+    Args:
+        projects_envs: A dict mapping each project slug to its list of environments.
+        metric_config: The metric scraping options, as returned by `get_metric_config()`.
+        remote_queries: Optional; number of issue queries evaluated through the API.
+        concurrency: Optional; number of client keys requests made concurrently.
+        legacy_api: Optional; whether the issues are listed per project or organization.
+        projects_specified: Optional; whether the projects are requested one by one
+            (SENTRY_EXPORTER_PROJECTS) rather than listed.
+        discover_queries: Optional; the Discover queries, as returned by
+            `helpers.discover.load_discover_queries()`.
+
+    Returns:
+        A list of (phase, endpoint, requests per refresh, note) rows, requests being a float
+        when they're amortized over several refreshes.
+    """
+    metric_config = pad_metric_config(metric_config)
+    issue_metrics, events_metrics, rate_limit_metrics = metric_config[0:3]
+    event_stream_metrics, release_metrics = metric_config[6:8]
+    num_projects = len(projects_envs)
+
+    rows = [
+        ("metadata", "organizations/{org}/", 1, ""),
+        ("metadata", "projects/{org}/{project}/", num_projects, "specified projects")
+        if projects_specified
+        else ("metadata", "organizations/{org}/projects/", 1, ""),
+        ("metadata", "projects/{org}/{project}/environments/", num_projects, ""),
+    ]
+    label_releases = issue_metrics == "True" and releases.RELEASE_LABEL == "releases"
+    if release_metrics == "True" or label_releases:
+        rows.append(
+            (
+                "releases",
+                "organizations/{org}/releases/",
+                1,
+                "up to {pages} pages on the first refresh".format(pages=releases.MAX_PAGES),
+            )
+        )
+    if issue_metrics == "True":
+        ages = [
+            age
+            for age, enabled in zip(("1h", "24h", "14d"), metric_config[3:6])
+            if enabled == "True"
+        ]
+        issues_requests = sum(len(envs) or 1 for envs in projects_envs.values()) * len(ages)
+        rows.append(
+            (
+                "issues",
+                "projects/{org}/{project}/issues/"
+                if legacy_api
+                else "organizations/{org}/issues/",
+                issues_requests,
+                "1 per project environment and age: {ages}".format(ages=", ".join(ages)),
+            )
+        )
+        if releases.RELEASE_LABEL == "current" and "1h" in ages:
+            # the lookups depend on the issues activity, which the metadata doesn't tell
+            rows.append(
+                (
+                    "issues",
+                    "issues/{issue}/current-release/",
+                    0,
+                    "not counted, 1 per new or updated issue of the last hour and environment",
+                )
+            )
+    if remote_queries:
+        rows.append(
+            (
+                "issue queries",
+                "organizations/{org}/issues/",
+                remote_queries,
+                "up to {pages} pages per query".format(pages=queries.MAX_PAGES),
+            )
+        )
+    for query_type, endpoint in (
+        ("events", "organizations/{org}/events/"),
+        ("events-stats", "organizations/{org}/events-stats/"),
+    ):
+        typed_queries = [query for query in discover_queries if query.get("type") == query_type]
+        if typed_queries:
+            rows.append(
+                (
+                    "discover",
+                    endpoint,
+                    sum(
+                        min(1.0, REFRESH_INTERVAL / float(query.get("ttl")))
+                        for query in typed_queries
+                    ),
+                    "{num} queries, each cached for its ttl".format(num=len(typed_queries))
+                    + (
+                        ", up to {pages} pages per query".format(pages=discover.MAX_PAGES)
+                        if query_type == "events"
+                        else ""
+                    ),
+                )
+            )
+    if events_metrics == "True":
+        rows.append(
+            ("events", "projects/{org}/{project}/stats/", 3 * num_projects, "3 stats per project")
+        )
+    if rate_limit_metrics == "True":
+        rows.append(
+            (
+                "rate limit",
+                "projects/{org}/{project}/keys/",
+                num_projects * min(1.0, REFRESH_INTERVAL / float(KEYS_CACHE_TTL)),
+                "{num} every {ttl}s, {workers} concurrently".format(
+                    num=num_projects, ttl=KEYS_CACHE_TTL, workers=concurrency
+                ),
+            )
+        )
+    if event_stream_metrics == "True":
+        rows.append(
+            (
+                "events stream",
+                "projects/{org}/{project}/events/",
+                num_projects,
+                "up to {pages} pages per project".format(pages=events.MAX_PAGES),
+            )
+        )
+    return rows
+
+
+def rate_limit(headers):
+    """Return the number of requests allowed per second by the rate limit headers, or None"""
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    try:
+        return float(headers.get("x-sentry-rate-limit-limit")) / RATE_LIMIT_WINDOW
+    except (TypeError, ValueError):
+        return None
+
+
+def report(rows, latency=None, limit=None, interval=REFRESH_INTERVAL):
+    """Format the plan rows and, when known, the estimated refresh duration and its fit"""
+    lines = ["{:<15} {:<42} {:>10}  {}".format("PHASE", "ENDPOINT", "REQUESTS", "NOTE")]
+    for phase, endpoint, requests, note in rows:
+        lines.append(
+            "{:<15} {:<42} {:>10}  {}".format(
+                phase, endpoint, "{:g}".format(round(requests, 2)), note
+            )
+        )
+    total = sum(requests for _, _, requests, _ in rows)
+    lines.append("{:<15} {:<42} {:>10}".format("total", "", "{:g}".format(round(total, 2))))
+
+    lines.append("")
+    if latency is None:
+        return "\n".join(lines) + "\n"
+
+    # requests are made one after another, the concurrent client keys ones are rare enough
+    duration = total * latency
+    lines.append(
+        "median latency: {latency:.3f}s, estimated refresh duration: {duration:.1f}s".format(
+            latency=latency, duration=duration
+        )
+    )
+    fits = duration <= interval
+    lines.append(
+        "refresh interval: {interval}s ({mode} mode): {verdict}".format(
+            interval=interval, mode=REFRESH_MODE, verdict="fits" if fits else "DOESN'T FIT"
+        )
+    )
+    if limit is not None:
+        rate = 1.0 / latency if latency else float("inf")
+        lines.append(
+            "rate limit: {limit:g} requests/s, serial request rate: {rate:.1f} requests/s: "
+            "{verdict}".format(
+                limit=limit,
+                rate=rate,
+                verdict="fits" if rate <= limit else "EXCEEDS, requests will be retried",
+            )
+        )
+    else:
+        lines.append("rate limit: unknown, no X-Sentry-Rate-Limit-Limit header received")
+    return "\n".join(lines) + "\n"
+
+
+def plan(sentry_api, org_slug, projects_slug, metric_config):
+    """Make the metadata requests and return the plan report of the configuration.
+
+    Args:
+        sentry_api: SentryAPI instance.
+        org_slug: A organization slug string name.
+        projects_slug: Optional; the comma separated projects slugs, all projects if None.
+        metric_config: The metric scraping options, as returned by `get_metric_config()`.
+    """
+    latencies = []
+
+    def timed(func, *args):
+        started = monotonic()
+        result = func(*args)
+        latencies.append(monotonic() - started)
+        return result
+
+    org = timed(sentry_api.get_org, org_slug)
+    if projects_slug:
+        projects = [
+            timed(sentry_api.get_project, org.get("slug"), slug)
+            for slug in projects_slug.split(",")
+        ]
+    else:
+        projects = timed(sentry_api.projects, org.get("slug"))
+    projects_envs = {
+        project.get("slug"): timed(sentry_api.environments, org.get("slug"), project)
+        for project in projects
+    }
+
+    local_ages = [
+        age
+        for age, enabled in zip(("1h", "24h", "14d"), metric_config[3:6])
+        if enabled == "True" and metric_config[0] == "True"
+    ]
+    remote_queries = 0
+    if queries.QUERIES_FILE:
+        remote_queries = len(
+            [
+                query_plan
+                for query_plan in queries.plan_queries(queries.load_queries(), local_ages)
+                if query_plan.get("predicates") is None
+            ]
+        )
+
+    rows = estimate(
+        projects_envs,
+        metric_config,
+        remote_queries,
+        KEYS_FETCH_WORKERS,
+        sentry_api.use_legacy_api,
+        bool(projects_slug),
+        discover.load_discover_queries(),
+    )
+    interval = REFRESH_INTERVAL if REFRESH_MODE == "background" else CACHE_TTL
+    if REFRESH_MODE != "background" and SCRAPE_TIMEOUT:
+        interval = min(interval, float(SCRAPE_TIMEOUT))
+    return report(rows, median(latencies), rate_limit(sentry_api.rate_limit_headers), interval)
@@ -1,21 +1,120 @@
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
+from os import getenv
+from time import time
 from uuid import uuid4
 
 from prometheus_client.core import (
     CounterMetricFamily,
     GaugeHistogramMetricFamily,
     GaugeMetricFamily,
+    HistogramMetricFamily,
 )
 
-from helpers.utils import get_cached, write_cache
+from helpers.breaker import CircuitBreakers, breaker_key
+from helpers.decoding import decode_and_sum, decode_pool, issues_events
+from helpers.discover import DISCOVER_FILE, load_discover_queries, run_discover_queries
+from helpers.events import LAG_BUCKETS, parse_timestamp, tail_project_events
+from helpers.queries import QUERIES_FILE, evaluate_queries, load_queries, plan_queries
+from helpers.rates import RATE_LABELS, STATS_PERIOD, compute_event_rates
+from helpers.releases import (
+    RELEASE_LABEL,
+    RELEASES_PER_PROJECT,
+    projects_releases,
+    release_at,
+    sync_releases,
+)
+from helpers.rollups import ROLLUP_LABELS, compute_rollups
+from helpers.scheduler import (
+    ADAPTIVE_REFRESH,
+    RefreshScheduler,
+    issues_fingerprint,
+    schedule_key,
+)
+from helpers.utils import cache_lock, get_cached, iso_date_label, snapshot_age, write_cache
+
+# constants for caching file, the snapshot is marshal data: it must live in a directory only
+# the exporter user can write to, see helpers.utils.get_cached()
+CACHE_FILE = getenv("SENTRY_EXPORTER_CACHE_FILE", "/tmp/sentry-prometheus-exporter-cache.bin")
+# bump whenever the data structure built by SentryCollector changes, so cache files written
+# by a previous version are never loaded
+SNAPSHOT_SCHEMA_VERSION = 2
+
+# with Sentry webhooks (helpers.webhooks) applying changes as they happen, polling the API
+# is only a slow reconciliation loop
+WEBHOOK_SECRET = getenv("SENTRY_WEBHOOK_SECRET")
+RECONCILE_INTERVAL = getenv("SENTRY_WEBHOOK_RECONCILE_INTERVAL", "1800")
+CACHE_TTL = int(
+    getenv("SENTRY_EXPORTER_CACHE_TTL") or (RECONCILE_INTERVAL if WEBHOOK_SECRET else "120")
+)
+
+# "scrape": the data structure is rebuilt from the API by the scrape that finds the cache expired
+# "background": scrapes only read the cache, kept up to date by helpers.refresher
+# SENTRY_EXPORTER_WARMUP: build the first data structure on startup, before any scrape
+REFRESH_MODE = getenv("SENTRY_EXPORTER_REFRESH_MODE", "scrape")
+REFRESH_INTERVAL = int(
+    getenv("SENTRY_EXPORTER_REFRESH_INTERVAL") or (RECONCILE_INTERVAL if WEBHOOK_SECRET else "120")
+)
+WARMUP = getenv("SENTRY_EXPORTER_WARMUP", "True")
+
+# in scrape mode, a rebuild taking longer than the scrape timeout (sent by Prometheus in the
+# X-Prometheus-Scrape-Timeout-Seconds header, or this default) minus the offset is left running
+# in background, and the scrape is answered with the previous data flagged as partial
+SCRAPE_TIMEOUT = getenv("SENTRY_EXPORTER_SCRAPE_TIMEOUT")
+SCRAPE_TIMEOUT_OFFSET = float(getenv("SENTRY_EXPORTER_SCRAPE_TIMEOUT_OFFSET", "0.5"))
 
-# constants for caching file
-JSON_CACHE_FILE = "/tmp/sentry-prometheus-exporter-cache.json"
-DEFAULT_CACHE_EXPIRE_TIMESTAMP = int(datetime.timestamp(datetime.now() + timedelta(minutes=2)))
+# client keys rarely change, so their configuration is cached for a long time
+KEYS_CACHE_FILE = CACHE_FILE + ".keys"
+KEYS_CACHE_TTL = int(getenv("SENTRY_RATE_LIMIT_CACHE_TTL", "3600"))
+KEYS_FETCH_WORKERS = int(getenv("SENTRY_RATE_LIMIT_FETCH_WORKERS", "3"))
 
 log = logging.getLogger(__name__)
 
+# a single rebuild at a time per process, scrapes wait on the one in flight
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sentry-refresh")
+_refresh_lock = threading.Lock()
+_refresh_future = None
+
+
+def _empty_data():
+    return {"metadata": {"projects": [], "projects_envs": {}}, "projects_data": {}}
+
+
+def snapshot_families(partial=False):
+    """Yields the snapshot age and scrape partial families, which don't need the snapshot.
+
+    Args:
+        partial: Optional; whether the scrape served the previous data.
+    """
+    snapshot_age_metrics = GaugeMetricFamily(
+        "sentry_exporter_snapshot_age_seconds",
+        "Number of seconds since the served data was built from the Sentry API",
+    )
+    age = snapshot_age(CACHE_FILE)
+    if age is not None:
+        snapshot_age_metrics.add_metric([], round(age, 3))
+    yield snapshot_age_metrics
+
+    partial_metrics = GaugeMetricFamily(
+        "sentry_exporter_scrape_partial",
+        "Whether the scrape timed out waiting for fresh data and served the previous data",
+    )
+    partial_metrics.add_metric([], int(partial))
+    yield partial_metrics
+
+
+# the original metric config flags (issues, events, rate limit, 1h, 24h and 14d metrics) are
+# followed by the event stream, releases, rollups and events rates flags
+METRIC_CONFIG_SIZE = 10
+
+
+def pad_metric_config(metric_config):
+    """Return a metric config list with the flags a shorter one lacks disabled"""
+    return list(metric_config) + ["False"] * (METRIC_CONFIG_SIZE - len(metric_config))
+
 
 class SentryCollector(object):
     """A simple :class:`SentryCollector <SentryCollector>` returns a list of Metric objects.
@@ -38,9 +137,16 @@ class SentryCollector(object):
         sentry_org_slug,
         metric_scraping_config,
         sentry_projects_slug=None,
+        scrape_timeout=None,
     ):
-        """Inits SentryCollector with a SentryAPI object"""
+        """Inits SentryCollector with a SentryAPI object.
+
+        scrape_timeout is the number of seconds the scrape is allowed to wait for the
+        data structure to be rebuilt, no limit if None. The metric_scraping_config list
+        may only hold the first flags, see `pad_metric_config()`.
+        """
         super(SentryCollector, self).__init__()
+        metric_scraping_config = pad_metric_config(metric_scraping_config)
         self.__sentry_api = sentry_api
         self.sentry_org_slug = sentry_org_slug
         self.sentry_projects_slug = sentry_projects_slug
@@ -50,6 +156,15 @@ class SentryCollector(object):
         self.get_1h_metrics = metric_scraping_config[3]
         self.get_24h_metrics = metric_scraping_config[4]
         self.get_14d_metrics = metric_scraping_config[5]
+        self.event_stream_metrics = metric_scraping_config[6]
+        self.release_metrics = metric_scraping_config[7]
+        self.release_label = RELEASE_LABEL
+        self.rollup_metrics = metric_scraping_config[8]
+        self.event_rate_metrics = metric_scraping_config[9]
+        if scrape_timeout is None and SCRAPE_TIMEOUT:
+            scrape_timeout = float(SCRAPE_TIMEOUT)
+        self.scrape_timeout = scrape_timeout
+        self.partial = False
 
     def __build_sentry_data_from_api(self):
         """Build a local data structure from sentry API calls.
@@ -60,7 +175,18 @@ class SentryCollector(object):
             The metadata key will store organization and projects metadata info
             (i.e.: slug names, ids, status, etc...) and projects_data key will store
             project's issues data, each key is a corrensponding environment
-            which contains 3 different ages: 1h, 24h and 14d lists of issues
+            which contains 3 different ages: 1h, 24h and 14d lists of issues.
+            projects_events and projects_keys keys store each project's events
+            stats and client keys when the related metrics are enabled,
+            events_stream stores the helpers.events tailer state and releases
+            the helpers.releases state, also used to label issues with their release.
+            rollups stores the helpers.rollups issues aggregates, event_rates the
+            helpers.rates issues events rates,
+            issue_queries stores the results of the helpers.queries user defined queries,
+            discover the helpers.discover Discover queries state
+            and schedule the helpers.scheduler state when the adaptive refresh is enabled.
+            breakers stores the helpers.breaker state: the projects endpoints circuit
+            breakers and when their data was last refreshed.
 
             Example:
                 data = {
@@ -84,7 +210,23 @@ class SentryCollector(object):
                                 "14d": []
                             }
                         }
-                    }
+                    },
+                    "projects_events": {
+                        "project_slug": {"received": 0, "rejected": 0, "blacklisted": 0}
+                    },
+                    "projects_keys": {
+                        "project_slug": [{"id": "", "name": "", "rate_limit_second": 0}]
+                    },
+                    "events_stream": {
+                        "project_slug": {"watermark": 0.0, "watermark_ids": [], "envs": {}}
+                    },
+                    "releases": {"watermark": "", "releases": {}},
+                    "rollups": {"projects": [], "org": []},
+                    "event_rates": [("project_slug", "production", "error", "1h", 0.0)],
+                    "issue_queries": {"query_name": {"project_slug": {"production": (0, 0)}}},
+                    "discover": {"query_name": {"expire_at": 0, "labels": [], "rows": []}},
+                    "schedule": {"project_slug/production": {"interval": 60, "next_due": 0.0}},
+                    "breakers": {"project_slug/issues": {"failures": 0, "last_success": 0.0}}
                 }
         """
 
@@ -107,8 +249,6 @@ class SentryCollector(object):
                 project = self.__sentry_api.get_project(self.org.get("slug"), project_slug)
                 projects.append(project)
                 projects_slug.append(project_slug)
-                envs = self.__sentry_api.environments(self.org.get("slug"), project)
-                projects_envs[project.get("slug")] = envs
             log.info(
                 "metadata: projects loaded from API: {num_proj}".format(num_proj=len(projects))
             )
@@ -119,12 +259,41 @@ class SentryCollector(object):
             for project in self.__sentry_api.projects(self.sentry_org_slug):
                 projects.append(project)
                 projects_slug.append(project.get("slug"))
-                envs = self.__sentry_api.environments(self.org.get("slug"), project)
-                projects_envs[project.get("slug")] = envs
             log.info(
                 "metadata: projects loaded from API: {num_proj}".format(num_proj=len(projects))
             )
 
+        previous_data = self.__previous_data()
+        previous_envs = (previous_data.get("metadata") or {}).get("projects_envs") or {}
+        breakers = CircuitBreakers(previous_data.get("breakers"))
+        scheduler = None
+        if ADAPTIVE_REFRESH == "True":
+            scheduler = RefreshScheduler(previous_data.get("schedule"))
+            envs_due = scheduler.plan(
+                [schedule_key(slug, "environments") for slug in projects_slug]
+            )
+
+        for project in projects:
+            envs_key = schedule_key(project.get("slug"), "environments")
+            if scheduler and envs_key not in envs_due:
+                if project.get("slug") in previous_envs:
+                    projects_envs[project.get("slug")] = previous_envs.get(project.get("slug"))
+                    continue
+                # the issues keys of a new project depend on its environments, listed anyway
+                scheduler.charge()
+            envs = breakers.call(
+                breaker_key(project.get("slug"), "environments"),
+                self.__sentry_api.environments,
+                self.org.get("slug"),
+                project,
+            )
+            if envs is None:
+                projects_envs[project.get("slug")] = previous_envs.get(project.get("slug")) or []
+                continue
+            projects_envs[project.get("slug")] = envs
+            if scheduler:
+                scheduler.observe(envs_key, ",".join(envs))
+
         log.debug("metadata: building projects metadata structure")
         data = {
             "metadata": {
@@ -134,262 +303,802 @@ class SentryCollector(object):
                 "projects_envs": projects_envs,
             }
         }
+        releases_index = {}
+        label_releases = self.issue_metrics == "True" and self.release_label == "releases"
+        if self.release_metrics == "True" or label_releases:
+            log.debug("data structure: synchronizing organization releases")
+            data["releases"] = sync_releases(
+                self.__sentry_api, self.org.get("slug"), previous_data.get("releases")
+            )
+            if label_releases:
+                releases_index = projects_releases(data["releases"])
+
         if self.issue_metrics == "True":
             __metadata = data.get("metadata")
 
             projects_issue_data = {}
+            previous_issue_data = previous_data.get("projects_data") or {}
+            issues_keys = [
+                schedule_key(project.get("slug"), env)
+                for project in projects
+                for env in projects_envs.get(project.get("slug")) or [None]
+            ]
+            if scheduler:
+                issues_cost = [
+                    self.get_1h_metrics,
+                    self.get_24h_metrics,
+                    self.get_14d_metrics,
+                ].count("True")
+                issues_due = scheduler.plan(issues_keys, cost=issues_cost)
+
+            pool = decode_pool()
+            fetched = []
+            events_data = {}
+
+            def decode(project_slug, env, previous_issues):
+                try:
+                    issues_by_age, events_by_age = self.__decode_project_issues(
+                        projects_issue_data[project_slug][env or "all"],
+                        env,
+                        (previous_issues or {}).get("1h"),
+                        releases_index.get(project_slug),
+                    )
+                except Exception:
+                    log.exception(
+                        "data structure: failed to decode issues - project: {proj} env: {env}"
+                        "".format(proj=project_slug, env=env)
+                    )
+                    projects_issue_data[project_slug][env or "all"] = previous_issues or {}
+                    events_data[project_slug][env or "all"] = issues_events(previous_issues or {})
+                    return
+                projects_issue_data[project_slug][env or "all"] = issues_by_age
+                events_data[project_slug][env or "all"] = events_by_age
+                if scheduler:
+                    scheduler.observe(
+                        schedule_key(project_slug, env), issues_fingerprint(issues_by_age)
+                    )
 
             for project in __metadata.get("projects"):
                 projects_issue_data[project.get("slug")] = {}
+                events_data[project.get("slug")] = {}
                 envs = __metadata.get("projects_envs").get(project.get("slug"))
                 envs = envs if envs else [None]
                 for env in envs:
-                    project_issues_1h = project_issues_24h = project_issues_14d = {}
-                    if self.get_1h_metrics == "True":
+                    issues_key = schedule_key(project.get("slug"), env)
+                    previous_issues = (previous_issue_data.get(project.get("slug")) or {}).get(
+                        env or "all"
+                    )
+                    if scheduler and issues_key not in issues_due:
                         log.debug(
-                            "metadata: getting issues from api - project: {proj} env: {env} age: 1h".format(
-                                proj=project.get("slug"), env=env
-                            )
-                        )
-                        project_issues_1h = self.__sentry_api.issues(
-                            self.org.get("slug"), project, env, age="1h"
+                            "scheduler: keeping {key} previous issues".format(key=issues_key)
                         )
-                    if self.get_24h_metrics == "True":
-                        log.debug(
-                            "metadata: getting issues from api - project: {proj} env: {env} age: 24h".format(
-                                proj=project.get("slug"), env=env
-                            )
+                        projects_issue_data[project.get("slug")][env or "all"] = (
+                            previous_issues or {}
                         )
-                        project_issues_24h = self.__sentry_api.issues(
-                            self.org.get("slug"), project, env, age="24h"
+                        events_data[project.get("slug")][env or "all"] = issues_events(
+                            previous_issues or {}
                         )
-                    if self.get_14d_metrics == "True":
-                        log.debug(
-                            "metadata: getting issues from api - project: {proj} env: {env} age: 14d".format(
-                                proj=project.get("slug"), env=env
-                            )
+                        continue
+
+                    issues_by_age = breakers.call(
+                        breaker_key(project.get("slug"), "issues"),
+                        self.__get_project_issues,
+                        project,
+                        env,
+                        pool,
+                    )
+                    if issues_by_age is None:
+                        projects_issue_data[project.get("slug")][env or "all"] = (
+                            previous_issues or {}
                         )
-                        project_issues_14d = self.__sentry_api.issues(
-                            self.org.get("slug"), project, env, age="14d"
+                        events_data[project.get("slug")][env or "all"] = issues_events(
+                            previous_issues or {}
                         )
+                        continue
+                    projects_issue_data[project.get("slug")][env or "all"] = issues_by_age
+                    if pool is None:
+                        # decoded right away, the raw responses are never all held at once
+                        decode(project.get("slug"), env, previous_issues)
+                    else:
+                        fetched.append((project.get("slug"), env, previous_issues))
 
-                    log.debug("data structure: building projects issues data")
-                    for k, v in project_issues_1h.items():
-                        projects_issue_data[project.get("slug")][k] = {"1h": v}
+            # the pool decodes the responses while the next ones are requested
+            for project_slug, env, previous_issues in fetched:
+                decode(project_slug, env, previous_issues)
 
-                    for k, v in project_issues_24h.items():
-                        projects_issue_data[project.get("slug")][k].update({"24h": v})
-
-                    for k, v in project_issues_14d.items():
-                        projects_issue_data[project.get("slug")][k].update({"14d": v})
+            if scheduler:
+                scheduler.forget(
+                    issues_keys
+                    + [schedule_key(project.get("slug"), "environments") for project in projects]
+                )
 
             data["projects_data"] = projects_issue_data
+            data["issues_events"] = events_data
+            if self.rollup_metrics == "True":
+                log.debug("data structure: computing issues rollups")
+                data["rollups"] = compute_rollups(projects_issue_data)
+            if self.event_rate_metrics == "True" and self.__stats_age():
+                log.debug("data structure: computing issues events rates")
+                data["event_rates"] = compute_event_rates(projects_issue_data, self.__stats_age())
 
-        write_cache(JSON_CACHE_FILE, data, DEFAULT_CACHE_EXPIRE_TIMESTAMP)
-        log.debug("cache: writing data structure to file: {cache}".format(cache=JSON_CACHE_FILE))
+        if scheduler:
+            data["schedule"] = scheduler.state
+
+        if QUERIES_FILE:
+            log.debug("data structure: evaluating user defined issue queries")
+            local_ages = [
+                age
+                for age, enabled in (
+                    ("1h", self.get_1h_metrics),
+                    ("24h", self.get_24h_metrics),
+                    ("14d", self.get_14d_metrics),
+                )
+                if enabled == "True" and self.issue_metrics == "True"
+            ]
+            # listing every project id can exceed the URL length limits
+            data["issue_queries"] = evaluate_queries(
+                plan_queries(load_queries(), local_ages),
+                data.get("projects_data"),
+                self.__sentry_api,
+                self.org.get("slug"),
+                projects if self.sentry_projects_slug else None,
+            )
+
+        if DISCOVER_FILE:
+            log.debug("data structure: running expired discover queries")
+            data["discover"] = run_discover_queries(
+                load_discover_queries(),
+                self.__sentry_api,
+                self.org.get("slug"),
+                projects if self.sentry_projects_slug else None,
+                previous_data.get("discover"),
+            )
+
+        if self.events_metrics == "True":
+            log.debug("data structure: building projects events data")
+            previous_events = previous_data.get("projects_events") or {}
+            data["projects_events"] = {}
+            for project in projects:
+                events = breakers.call(
+                    breaker_key(project.get("slug"), "stats"),
+                    self.__sentry_api.project_stats,
+                    self.org.get("slug"),
+                    project.get("slug"),
+                )
+                data["projects_events"][project.get("slug")] = (
+                    events if events is not None else previous_events.get(project.get("slug"))
+                )
+
+        if self.rate_limit_metrics == "True":
+            data["projects_keys"] = self.__get_projects_keys(
+                projects, breakers, previous_data.get("projects_keys") or {}
+            )
+
+        if self.event_stream_metrics == "True":
+            log.debug("data structure: tailing projects events")
+            previous_stream = previous_data.get("events_stream") or {}
+            data["events_stream"] = {}
+            for project in projects:
+                project_stream = breakers.call(
+                    breaker_key(project.get("slug"), "events"),
+                    tail_project_events,
+                    self.__sentry_api,
+                    self.org.get("slug"),
+                    project,
+                    previous_stream.get(project.get("slug")),
+                )
+                if project_stream is None:
+                    project_stream = previous_stream.get(project.get("slug"))
+                if project_stream is not None:
+                    data["events_stream"][project.get("slug")] = project_stream
+
+        breakers.forget(projects_slug)
+        data["breakers"] = breakers.state
+
+        with cache_lock(CACHE_FILE):
+            write_cache(
+                CACHE_FILE,
+                data,
+                int(datetime.timestamp(datetime.now() + timedelta(seconds=CACHE_TTL))),
+                SNAPSHOT_SCHEMA_VERSION,
+            )
+        log.debug("cache: writing data structure to file: {cache}".format(cache=CACHE_FILE))
         return data
 
+    def __previous_data(self):
+        """Return the last data structure built, even if expired, to carry state over"""
+        return (
+            get_cached(CACHE_FILE, expired_ok=True, schema_version=SNAPSHOT_SCHEMA_VERSION) or {}
+        )
+
     def __build_sentry_data(self):
-        data = get_cached(JSON_CACHE_FILE)
+        # in background mode the last snapshot is served even if expired, stale data beats
+        # no data and helpers.utils.liveness reports a refresher that stopped renewing it
+        data = get_cached(
+            CACHE_FILE,
+            expired_ok=(REFRESH_MODE == "background"),
+            schema_version=SNAPSHOT_SCHEMA_VERSION,
+        )
+
+        if data is False and REFRESH_MODE == "background":
+            log.warning("cache: {cache} not built by the refresher yet.".format(cache=CACHE_FILE))
+            return _empty_data()
 
         if data is False:
-            log.debug("cache: {cache} not found.".format(cache=JSON_CACHE_FILE))
+            log.debug("cache: {cache} not found.".format(cache=CACHE_FILE))
             log.debug("cache: rebuilding from API...")
-            api_data = self.__build_sentry_data_from_api()
-            return api_data
+            if self.scrape_timeout is None:
+                return self.__build_sentry_data_from_api()
+            return self.__build_sentry_data_before(self.scrape_timeout - SCRAPE_TIMEOUT_OFFSET)
 
-        log.debug("cache: reading data structure from file: {cache}".format(cache=JSON_CACHE_FILE))
+        log.debug("cache: reading data structure from file: {cache}".format(cache=CACHE_FILE))
         return data
 
-    def collect(self):
-        """Yields metrics from the collectors in the registry."""
+    def __build_sentry_data_before(self, timeout):
+        """Rebuild the data structure in background, waiting for it at most timeout seconds.
 
-        __data = self.__build_sentry_data()
-        __metadata = __data.get("metadata")
-        __projects_data = __data.get("projects_data")
+        A rebuild already in flight (i.e.: started by a previous scrape that timed out) is
+        waited for instead of starting a new one. If it doesn't finish in time the previous
+        data structure is returned and the scrape flagged as partial, the rebuild keeps going
+        and stores its result into the cache for the next scrape.
+        """
+        global _refresh_future
 
-        self.org = __metadata.get("org")
-        self.projects_data = {}
+        with _refresh_lock:
+            if _refresh_future is None or _refresh_future.done():
+                _refresh_future = _refresh_executor.submit(self.__build_sentry_data_from_api)
+            future = _refresh_future
 
-        if self.issue_metrics == "True":
-            issues_histogram_metrics = GaugeHistogramMetricFamily(
-                "sentry_issues",
-                "Number of open issues (aka is:unresolved) per project",
-                buckets=None,
-                gsum_value=None,
-                labels=[
-                    "project_slug",
-                    "environment",
-                ],
-                unit="",
+        try:
+            return future.result(timeout=max(timeout, 0))
+        except FutureTimeoutError:
+            log.warning(
+                "collector: data structure not rebuilt within the {timeout:.1f}s scrape timeout, "
+                "serving the previous one".format(timeout=timeout)
             )
+            self.partial = True
+            return self.__previous_data() or _empty_data()
 
-            log.info("collector: loading projects issues")
-            for project in __metadata.get("projects"):
-                envs = __metadata.get("projects_envs").get(project.get("slug"))
-                project_issues = __projects_data.get(project.get("slug"))
-                for env in envs:
-                    log.debug(
-                        "collector: loading issues - project: {proj} env: {env}".format(
-                            proj=project.get("slug"), env=env
-                        )
-                    )
+    def refresh(self):
+        """Rebuild the data structure from sentry API calls and store it into the cache.
 
-                    project_issues_1h = project_issues.get(env).get("1h")
-                    project_issues_24h = project_issues.get(env).get("24h")
-                    project_issues_14d = project_issues.get(env).get("14d")
-
-                    events_1h = 0
-                    events_24h = 0
-                    events_14d = 0
-
-                    if project_issues_1h:
-                        for issue in project_issues_1h:
-                            events_1h += int(issue.get("count") or 0)
-
-                    if project_issues_24h:
-                        for issue in project_issues_24h:
-                            events_24h += int(issue.get("count") or 0)
-
-                    if project_issues_14d:
-                        for issue in project_issues_14d:
-                            events_14d += int(issue.get("count") or 0)
-
-                    sum_events = events_1h + events_24h + events_14d
-                    histo_buckets = []
-                    if self.get_1h_metrics == "True":
-                        histo_buckets.append(("1h", float(events_1h)))
-                    if self.get_24h_metrics == "True":
-                        histo_buckets.append(("24h", float(events_24h)))
-                    if self.get_14d_metrics == "True":
-                        histo_buckets.append(("+Inf", float(events_14d)))
-                    issues_histogram_metrics.add_metric(
-                        labels=[
-                            str(project.get("slug")),
-                            str(env),
-                        ],
-                        buckets=histo_buckets,
-                        gsum_value=int(sum_events),
-                    )
+        Used by helpers.refresher to keep the cache up to date out of the scrape path.
+        """
+        return self.__build_sentry_data_from_api()
 
-            yield issues_histogram_metrics
-
-            issues_metrics = GaugeMetricFamily(
-                "sentry_open_issue_events",
-                "Number of open issues (aka is:unresolved) per project",
-                labels=[
-                    "issue_id",
-                    "logger",
-                    "level",
-                    "status",
-                    "platform",
-                    "project_slug",
-                    "environment",
-                    "release",
-                    "isUnhandled",
-                    "firstSeen",
-                    "lastSeen",
-                ],
+    def __get_project_issues(self, project, env, pool):
+        """Return the issues of a project environment for each enabled age: 1h, 24h and 14d.
+
+        The raw response bodies are submitted to the decoding pool when there is one, the
+        issues are then decoded futures, see `__decode_project_issues()`. When the events
+        rates are enabled, the widest age issues embed their hourly events stats.
+        """
+
+        stats_age = self.__stats_age() if self.event_rate_metrics == "True" else None
+        issues_by_age = {}
+        for age, enabled in (
+            ("1h", self.get_1h_metrics),
+            ("24h", self.get_24h_metrics),
+            ("14d", self.get_14d_metrics),
+        ):
+            if enabled != "True":
+                continue
+            log.debug(
+                "metadata: getting issues from api - project: {proj} env: {env} age: {age}".format(
+                    proj=project.get("slug"), env=env, age=age
+                )
+            )
+            stats = age == stats_age
+            body = self.__sentry_api.issues(
+                self.org.get("slug"),
+                project,
+                env,
+                age=age,
+                raw=True,
+                stats_period=STATS_PERIOD if stats else None,
+            ).get(env or "all")
+            issues_by_age[age] = (
+                pool.submit(decode_and_sum, body, stats) if pool else (body, stats)
             )
+        return issues_by_age
 
-            for project in __metadata.get("projects"):
-                envs = __metadata.get("projects_envs").get(project.get("slug"))
-                project_issues = __projects_data.get(project.get("slug"))
-                envs = envs if envs else [None]
-                for env in envs:
-                    project_issues_1h = (
-                        project_issues.get(env).get("1h")
-                        if env
-                        else project_issues.get("all").get("1h")
+    def __stats_age(self):
+        """Return the widest enabled age, whose issues give the events rates, or None"""
+
+        for age, enabled in (
+            ("14d", self.get_14d_metrics),
+            ("24h", self.get_24h_metrics),
+            ("1h", self.get_1h_metrics),
+        ):
+            if enabled == "True":
+                return age
+        return None
+
+    def __decode_project_issues(self, issues_by_age, env, previous_issues, project_releases):
+        """Decode the issues returned by `__get_project_issues()` and label them with releases.
+
+        Returns:
+            A (issues_by_age, events_by_age) tuple, the events summed by the decoding workers.
+        """
+
+        decoded = {
+            age: issues.result() if isinstance(issues, Future) else decode_and_sum(*issues)
+            for age, issues in issues_by_age.items()
+        }
+        issues_by_age = {age: issues for age, (issues, _) in decoded.items()}
+        self.__label_releases(
+            issues_by_age.get("1h") or [], env, previous_issues, project_releases
+        )
+        return issues_by_age, {age: events for age, (_, events) in decoded.items()}
+
+    def __label_releases(self, issues, env, previous_issues, project_releases):
+        """Label the issues with their release, see helpers.releases.RELEASE_LABEL.
+
+        The current release of an issue is only requested again when it was last seen since
+        the previous refresh, otherwise the previous label is kept.
+        """
+        if self.release_label == "releases":
+            for issue in issues:
+                issue["release"] = release_at(project_releases, issue.get("lastSeen"))
+            return
+        if self.release_label != "current":
+            return
+
+        previous_releases = {
+            (issue.get("id"), issue.get("lastSeen")): issue.get("release")
+            for issue in previous_issues or []
+            if "release" in issue
+        }
+        for issue in issues:
+            key = (issue.get("id"), issue.get("lastSeen"))
+            if key in previous_releases:
+                issue["release"] = previous_releases.get(key)
+                continue
+            try:
+                issue["release"] = self.__sentry_api.issue_release(issue.get("id"), env)
+            except Exception:
+                log.exception(
+                    "data structure: failed to get the current release of issue {issue}".format(
+                        issue=issue.get("id")
                     )
-                    for issue in project_issues_1h:
-                        release = self.__sentry_api.issue_release(issue.get("id"), env)
-                        first_seen = (
-                            datetime.strptime(str(issue.get("firstSeen")), "%Y-%m-%dT%H:%M:%SZ")
-                            if len(str(issue.get("firstSeen"))) == 20
-                            else (
-                                datetime.strptime(
-                                    str(issue.get("firstSeen")), "%Y-%m-%dT%H:%M:%S.%fZ"
-                                )
-                                if issue.get("firstSeen")
-                                else datetime.now()
-                            )
-                        )
-                        last_seen = (
-                            datetime.strptime(str(issue.get("lastSeen")), "%Y-%m-%dT%H:%M:%SZ")
-                            if len(str(issue.get("lastSeen"))) == 20
-                            else (
-                                datetime.strptime(
-                                    str(issue.get("lastSeen")), "%Y-%m-%dT%H:%M:%S.%fZ"
-                                )
-                                if issue.get("lastSeen")
-                                else datetime.now()
-                            )
-                        )
-                        issues_metrics.add_metric(
-                            [
-                                str(issue.get("id")),
-                                str(issue.get("logger")) or "None",
-                                str(issue.get("level")),
-                                str(issue.get("status")),
-                                str(issue.get("platform")),
-                                str(issue.get("project").get("slug")),
-                                str(env),
-                                str(release),
-                                str(issue.get("isUnhandled")),
-                                str(
-                                    datetime.strftime(
-                                        first_seen,
-                                        "%Y-%m-%d",
-                                    )
-                                ),
-                                str(
-                                    datetime.strftime(
-                                        last_seen,
-                                        "%Y-%m-%d",
-                                    )
-                                ),
-                            ],
-                            int(issue.get("count")),
-                        )
-            yield issues_metrics
+                )
+                return
+
+    def __get_projects_keys(self, projects, breakers, previous_keys):
+        """Return the client keys of every project, reading from the keys cache when possible.
+
+        Only projects missing from the cache are requested, concurrently, and the cache is
+        rewritten under its lock, keeping its original expiration. Projects whose keys can't be
+        fetched keep the keys of the previous data structure.
+
+        Returns:
+            A dict mapping each project slug to its list of client keys.
+        """
+
+        cache = get_cached(KEYS_CACHE_FILE) or {}
+        projects_keys = cache.get("projects_keys", {})
+        expire_at = cache.get("expire_at") or int(
+            datetime.timestamp(datetime.now()) + KEYS_CACHE_TTL
+        )
+
+        missing = [
+            project.get("slug") for project in projects if project.get("slug") not in projects_keys
+        ]
+        if missing:
+            log.debug("cache: fetching client keys of {num} projects".format(num=len(missing)))
+            with ThreadPoolExecutor(max_workers=KEYS_FETCH_WORKERS) as executor:
+                fetched = executor.map(
+                    lambda slug: breakers.call(
+                        breaker_key(slug, "keys"),
+                        self.__sentry_api.project_keys,
+                        self.org.get("slug"),
+                        slug,
+                    ),
+                    missing,
+                )
+                fetched_keys = {
+                    slug: keys for slug, keys in zip(missing, fetched) if keys is not None
+                }
+            # merged into the keys another process may have cached meanwhile
+            with cache_lock(KEYS_CACHE_FILE):
+                cache = get_cached(KEYS_CACHE_FILE) or cache
+                projects_keys = dict(cache.get("projects_keys", {}), **fetched_keys)
+                write_cache(
+                    KEYS_CACHE_FILE,
+                    {"projects_keys": projects_keys},
+                    cache.get("expire_at") or expire_at,
+                )
+
+        return {
+            project.get("slug"): projects_keys.get(project.get("slug"))
+            or previous_keys.get(project.get("slug"))
+            or []
+            for project in projects
+        }
+
+    def collect(self):
+        """Yields metrics from the collectors in the registry.
+
+        Each group of metric families is collected on its own, so a failure in one of
+        them (i.e.: unexpected data) is logged without dropping all the others.
+        """
+
+        __data = self.__build_sentry_data()
+        self.org = __data.get("metadata").get("org")
+        self.projects_data = {}
 
+        collectors = [("exporter", self.__collect_exporter_metrics)]
+        if self.issue_metrics == "True":
+            collectors.append(("issues", self.__collect_issues_metrics))
+        if self.issue_metrics == "True" and self.rollup_metrics == "True":
+            collectors.append(("rollups", self.__collect_rollup_metrics))
+        if self.issue_metrics == "True" and self.event_rate_metrics == "True":
+            collectors.append(("events rates", self.__collect_event_rate_metrics))
         if self.events_metrics == "True":
-            project_events_metrics = CounterMetricFamily(
-                "sentry_events",
-                "Total events counts per project",
-                labels=[
-                    "project_slug",
-                    "stat",
-                ],
-            )
+            collectors.append(("events", self.__collect_events_metrics))
+        if self.rate_limit_metrics == "True":
+            collectors.append(("rate limit", self.__collect_rate_limit_metrics))
+        if self.event_stream_metrics == "True":
+            collectors.append(("events stream", self.__collect_event_stream_metrics))
+        if self.release_metrics == "True":
+            collectors.append(("releases", self.__collect_release_metrics))
+        if QUERIES_FILE:
+            collectors.append(("issue queries", self.__collect_issue_queries_metrics))
+        if DISCOVER_FILE:
+            collectors.append(("discover queries", self.__collect_discover_metrics))
 
-            for project in __metadata.get("projects"):
-                events = self.__sentry_api.project_stats(self.org.get("slug"), project.get("slug"))
-                for stat, value in events.items():
-                    project_events_metrics.add_metric(
+        for name, collector in collectors:
+            try:
+                yield from collector(__data)
+            except Exception:
+                log.exception(
+                    "collector: failed to collect {name} metrics, skipping them".format(name=name)
+                )
+
+    def __collect_exporter_metrics(self, data):
+        """Yields the exporter own metrics"""
+
+        yield from snapshot_families(self.partial)
+
+        breaker_open_metrics = GaugeMetricFamily(
+            "sentry_exporter_circuit_breaker_open",
+            "Whether the project endpoint circuit breaker is open (1) or closed (0)",
+            labels=["project_slug", "endpoint"],
+        )
+        data_age_metrics = GaugeMetricFamily(
+            "sentry_exporter_project_data_age_seconds",
+            "Number of seconds since the project endpoint data was last fetched successfully",
+            labels=["project_slug", "endpoint"],
+        )
+        breakers = CircuitBreakers(data.get("breakers"))
+        for key, entry in sorted(breakers.state.items()):
+            labels = key.rsplit("/", 1)
+            breaker_open_metrics.add_metric(labels, int(breakers.is_open(key)))
+            if entry.get("last_success"):
+                data_age_metrics.add_metric(labels, round(time() - entry.get("last_success"), 3))
+        yield breaker_open_metrics
+        yield data_age_metrics
+
+    def __collect_issues_metrics(self, data):
+        """Yields the projects issues metrics"""
+
+        __metadata = data.get("metadata")
+        __projects_data = data.get("projects_data") or {}
+        __events_data = data.get("issues_events") or {}
+
+        issues_histogram_metrics = GaugeHistogramMetricFamily(
+            "sentry_issues",
+            "Number of open issues (aka is:unresolved) per project",
+            buckets=None,
+            gsum_value=None,
+            labels=[
+                "project_slug",
+                "environment",
+            ],
+            unit="",
+        )
+
+        log.info("collector: loading projects issues")
+        for project in __metadata.get("projects"):
+            envs = __metadata.get("projects_envs").get(project.get("slug")) or []
+            project_issues = __projects_data.get(project.get("slug")) or {}
+            for env in envs:
+                log.debug(
+                    "collector: loading issues - project: {proj} env: {env}".format(
+                        proj=project.get("slug"), env=env
+                    )
+                )
+
+                # projects whose issues were never fetched (see helpers.breaker) have none
+                env_issues = project_issues.get(env) or {}
+                # summed by the decoding workers, older snapshots don't have them
+                env_events = (__events_data.get(project.get("slug")) or {}).get(env)
+                if env_events is None:
+                    env_events = issues_events(env_issues)
+                events_1h = env_events.get("1h") or 0
+                events_24h = env_events.get("24h") or 0
+                events_14d = env_events.get("14d") or 0
+
+                events_sum = events_1h + events_24h + events_14d
+                histo_buckets = []
+                if self.get_1h_metrics == "True":
+                    histo_buckets.append(("1h", float(events_1h)))
+                if self.get_24h_metrics == "True":
+                    histo_buckets.append(("24h", float(events_24h)))
+                if self.get_14d_metrics == "True":
+                    histo_buckets.append(("+Inf", float(events_14d)))
+                issues_histogram_metrics.add_metric(
+                    labels=[
+                        str(project.get("slug")),
+                        str(env),
+                    ],
+                    buckets=histo_buckets,
+                    gsum_value=int(events_sum),
+                )
+
+        yield issues_histogram_metrics
+
+        issues_metrics = GaugeMetricFamily(
+            "sentry_open_issue_events",
+            "Number of open issues (aka is:unresolved) per project",
+            labels=[
+                "issue_id",
+                "logger",
+                "level",
+                "status",
+                "platform",
+                "project_slug",
+                "environment",
+                "release",
+                "isUnhandled",
+                "firstSeen",
+                "lastSeen",
+            ],
+        )
+
+        for project in __metadata.get("projects"):
+            envs = __metadata.get("projects_envs").get(project.get("slug"))
+            project_issues = __projects_data.get(project.get("slug")) or {}
+            envs = envs if envs else [None]
+            for env in envs:
+                project_issues_1h = (project_issues.get(env or "all") or {}).get("1h") or []
+                for issue in project_issues_1h:
+                    issues_metrics.add_metric(
                         [
-                            str(project.get("slug")),
-                            str(stat),
+                            str(issue.get("id")),
+                            str(issue.get("logger")) or "None",
+                            str(issue.get("level")),
+                            str(issue.get("status")),
+                            str(issue.get("platform")),
+                            str(issue.get("project").get("slug")),
+                            str(env),
+                            str(issue.get("release")),
+                            str(issue.get("isUnhandled")),
+                            str(
+                                issue.get("firstSeenDate")
+                                or iso_date_label(issue.get("firstSeen"))
+                            ),
+                            str(
+                                issue.get("lastSeenDate") or iso_date_label(issue.get("lastSeen"))
+                            ),
                         ],
-                        int(value),
+                        int(issue.get("count")),
                     )
+        yield issues_metrics
 
-            yield project_events_metrics
+    def __collect_rollup_metrics(self, data):
+        """Yields the open issues rollups, computed when the data structure is built"""
 
-        if self.rate_limit_metrics == "True":
-            project_rate_metrics = GaugeMetricFamily(
-                "sentry_rate_limit_events_sec",
-                "Rate limit events per second for a project",
-                labels=["project_slug"],
-            )
+        families = [
+            (
+                "sentry_project_open_issues",
+                "Number of open issues per project, environment, age window and issue attributes",
+                ["project_slug"],
+                "projects",
+                -2,
+            ),
+            (
+                "sentry_project_open_issues_events",
+                "Number of events of the open issues per project, environment, age window and "
+                "issue attributes",
+                ["project_slug"],
+                "projects",
+                -1,
+            ),
+            (
+                "sentry_org_open_issues",
+                "Number of open issues per environment, age window and issue attributes",
+                [],
+                "org",
+                -2,
+            ),
+            (
+                "sentry_org_open_issues_events",
+                "Number of events of the open issues per environment, age window and issue "
+                "attributes",
+                [],
+                "org",
+                -1,
+            ),
+        ]
+        rollups = data.get("rollups") or {}
+        for name, documentation, labels, scope, value in families:
+            metrics = GaugeMetricFamily(name, documentation, labels=labels + ROLLUP_LABELS)
+            for row in rollups.get(scope) or []:
+                metrics.add_metric(list(row[:-2]), row[value])
+            yield metrics
 
-            for project in __metadata.get("projects"):
-                rate_limit_second = self.__sentry_api.rate_limit(
-                    self.org.get("slug"), project.get("slug")
+    def __collect_event_rate_metrics(self, data):
+        """Yields the issues events rates, computed when the data structure is built"""
+
+        event_rate_metrics = GaugeMetricFamily(
+            "sentry_issues_events_rate",
+            "Events per second of the open issues per project, environment and level, averaged "
+            "over the last complete hours of the window",
+            labels=["project_slug"] + RATE_LABELS,
+        )
+        for row in data.get("event_rates") or []:
+            event_rate_metrics.add_metric(list(row[:-1]), row[-1])
+        yield event_rate_metrics
+
+    def __collect_events_metrics(self, data):
+        """Yields the projects events metrics"""
+
+        __metadata = data.get("metadata")
+
+        project_events_metrics = CounterMetricFamily(
+            "sentry_events",
+            "Total events counts per project",
+            labels=[
+                "project_slug",
+                "stat",
+            ],
+        )
+
+        projects_events = data.get("projects_events") or {}
+        for project in __metadata.get("projects"):
+            events = projects_events.get(project.get("slug")) or {}
+            for stat, value in events.items():
+                project_events_metrics.add_metric(
+                    [
+                        str(project.get("slug")),
+                        str(stat),
+                    ],
+                    int(value),
                 )
+
+        yield project_events_metrics
+
+    def __collect_rate_limit_metrics(self, data):
+        """Yields the projects client keys rate limit metrics"""
+
+        __metadata = data.get("metadata")
+
+        project_rate_metrics = GaugeMetricFamily(
+            "sentry_rate_limit_events_sec",
+            "Rate limit events per second for a project",
+            labels=["project_slug", "key_id", "key_name"],
+        )
+
+        projects_keys = data.get("projects_keys") or {}
+        for project in __metadata.get("projects"):
+            for key in projects_keys.get(project.get("slug")) or []:
                 project_rate_metrics.add_metric(
-                    [str(project.get("slug"))], round(rate_limit_second, 6)
+                    [str(project.get("slug")), str(key.get("id")), str(key.get("name"))],
+                    round(key.get("rate_limit_second"), 6),
+                )
+
+        yield project_rate_metrics
+
+    def __collect_event_stream_metrics(self, data):
+        """Yields the projects events stream metrics"""
+
+        events_received_metrics = CounterMetricFamily(
+            "sentry_events_received",
+            "Number of events received since the exporter started tailing the project",
+            labels=["project_slug", "environment"],
+        )
+        ingestion_lag_metrics = HistogramMetricFamily(
+            "sentry_event_ingestion_lag_seconds",
+            "Time between an event creation and its reception by Sentry",
+            labels=["project_slug", "environment"],
+        )
+
+        events_stream = data.get("events_stream") or {}
+        for project_slug, project_state in events_stream.items():
+            for env, env_state in project_state.get("envs").items():
+                events_received_metrics.add_metric(
+                    [str(project_slug), str(env)], env_state.get("count")
+                )
+                cumulative, buckets = 0, []
+                bounds = [str(bound) for bound in LAG_BUCKETS] + ["+Inf"]
+                for bound, count in zip(bounds, env_state.get("lag_buckets")):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                ingestion_lag_metrics.add_metric(
+                    [str(project_slug), str(env)], buckets, env_state.get("lag_sum")
+                )
+
+        yield events_received_metrics
+        yield ingestion_lag_metrics
+
+    def __collect_release_metrics(self, data):
+        """Yields the projects releases metrics"""
+
+        release_new_issues_metrics = GaugeMetricFamily(
+            "sentry_release_new_issues",
+            "Number of new issues per release of a project, for its most recent releases",
+            labels=["project_slug", "release"],
+        )
+        last_deploy_metrics = GaugeMetricFamily(
+            "sentry_project_last_deploy_timestamp_seconds",
+            "Unix time of the last deploy finished per project and environment",
+            labels=["project_slug", "environment"],
+        )
+        project_releases_metrics = GaugeMetricFamily(
+            "sentry_project_releases",
+            "Number of releases per project, among its most recent ones kept by the exporter",
+            labels=["project_slug"],
+        )
+
+        releases = (data.get("releases") or {}).get("releases") or {}
+        last_deploys = {}
+        for project_slug, (dates, versions) in projects_releases(data.get("releases")).items():
+            project_releases_metrics.add_metric([str(project_slug)], len(versions))
+            for version in versions[-RELEASES_PER_PROJECT:]:
+                release_new_issues_metrics.add_metric(
+                    [str(project_slug), str(version)],
+                    releases.get(version).get("projects").get(project_slug),
                 )
+            for version in versions:
+                release = releases.get(version)
+                if not release.get("lastDeploy"):
+                    continue
+                key = (project_slug, release.get("lastDeployEnvironment"))
+                last_deploys[key] = max(last_deploys.get(key, ""), release.get("lastDeploy"))
+
+        for (project_slug, env), last_deploy in last_deploys.items():
+            last_deploy_metrics.add_metric(
+                [str(project_slug), str(env)], parse_timestamp(last_deploy)
+            )
+
+        yield release_new_issues_metrics
+        yield last_deploy_metrics
+        yield project_releases_metrics
+
+    def __collect_issue_queries_metrics(self, data):
+        """Yields the user defined issue queries metrics"""
 
-            yield project_rate_metrics
+        query_issues_metrics = GaugeMetricFamily(
+            "sentry_issue_query_issues",
+            "Number of issues matching a user defined query",
+            labels=["query", "project_slug", "environment"],
+        )
+        query_events_metrics = GaugeMetricFamily(
+            "sentry_issue_query_events",
+            "Number of events of the issues matching a user defined query",
+            labels=["query", "project_slug", "environment"],
+        )
+
+        for name, query_results in (data.get("issue_queries") or {}).items():
+            for project_slug, project_results in query_results.items():
+                for env, (issues, events) in project_results.items():
+                    labels = [str(name), str(project_slug), str(env)]
+                    query_issues_metrics.add_metric(labels, issues)
+                    query_events_metrics.add_metric(labels, events)
+
+        yield query_issues_metrics
+        yield query_events_metrics
+
+    def __collect_discover_metrics(self, data):
+        """Yields a gauge family per user defined Discover query"""
+
+        for name, query_state in sorted((data.get("discover") or {}).items()):
+            discover_metrics = GaugeMetricFamily(
+                "sentry_discover_{name}".format(name=name),
+                "Aggregates of the {name} Discover query".format(name=name),
+                labels=list(query_state.get("labels")) + ["aggregate"],
+            )
+            for row in query_state.get("rows") or []:
+                discover_metrics.add_metric([str(label) for label in row[:-1]], row[-1])
+            yield discover_metrics
@@ -0,0 +1,58 @@
+"""Push each refreshed snapshot to a Prometheus Pushgateway.
+
+With ``SENTRY_EXPORTER_PUSHGATEWAY_URL`` set, the background refresher (see helpers.refresher)
+pushes the metrics of every snapshot it builds, once, to the Pushgateway. Prometheus servers
+and federation tiers then scrape the Pushgateway, and scrape fan-out costs nothing to the
+exporter nor to the Sentry API.
+"""
+
+import logging
+from os import getenv
+
+from prometheus_client import push_to_gateway
+from prometheus_client.core import CollectorRegistry
+from prometheus_client.exposition import basic_auth_handler, default_handler
+from retry import retry
+
+from libs.sentry import retry_settings
+
+log = logging.getLogger(__name__)
+
+PUSHGATEWAY_URL = getenv("SENTRY_EXPORTER_PUSHGATEWAY_URL")
+PUSHGATEWAY_JOB = getenv("SENTRY_EXPORTER_PUSHGATEWAY_JOB", "sentry_exporter")
+PUSHGATEWAY_USER = getenv("SENTRY_EXPORTER_PUSHGATEWAY_USER")
+PUSHGATEWAY_PASS = getenv("SENTRY_EXPORTER_PUSHGATEWAY_PASS")
+PUSHGATEWAY_TIMEOUT = float(getenv("SENTRY_EXPORTER_PUSHGATEWAY_TIMEOUT", "30"))
+
+
+def _handler(url, method, timeout, headers, data):
+    if PUSHGATEWAY_USER:
+        return basic_auth_handler(
+            url, method, timeout, headers, data, PUSHGATEWAY_USER, PUSHGATEWAY_PASS
+        )
+    return default_handler(url, method, timeout, headers, data)
+
+
+@retry(OSError, **retry_settings)
+def push(collector, url=None, job=None):
+    """Push the metrics of a collector, in a single request, replacing the job's previous push.
+
+    Args:
+        collector: SentryCollector instance, its cached data structure is pushed.
+        url: Optional; the Pushgateway address, defaults to PUSHGATEWAY_URL.
+        job: Optional; the job label, defaults to PUSHGATEWAY_JOB.
+
+    Raises:
+        OSError: An error occurred if the Pushgateway is unreachable or rejects the push,
+            once the retries are exhausted.
+    """
+    registry = CollectorRegistry()
+    registry.register(collector)
+    push_to_gateway(
+        url or PUSHGATEWAY_URL,
+        job=job or PUSHGATEWAY_JOB,
+        registry=registry,
+        timeout=PUSHGATEWAY_TIMEOUT,
+        handler=_handler,
+    )
+    log.debug("push: metrics pushed to {url}".format(url=url or PUSHGATEWAY_URL))
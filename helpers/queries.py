@@ -0,0 +1,226 @@
+"""User defined issue queries, planned together and evaluated in one batched pass.
+
+Queries are read from the YAML file set in ``SENTRY_ISSUE_QUERIES_FILE``:
+
+    queries:
+      - name: fatal
+        query: "is:unresolved level:fatal"
+        age: 24h
+      - name: checkout
+        query: "is:unresolved transaction:/checkout"
+
+Before anything is requested the queries are planned:
+
+* identical queries (same terms in any order, same age) are deduplicated and evaluated once;
+* queries on unresolved issues (``is:unresolved`` and no other status term) only filtering
+  on fields of the issues list payload (assignment, level, platform, logger), over an age
+  window the collector already fetches (1h, 24h or 14d), are evaluated locally on those
+  issues, per environment, without any extra request. The collector only fetches unresolved
+  issues: other statuses, or queries without a status term, can't be evaluated locally;
+* the remaining queries are run once for all the projects through the organization issues
+  endpoint, so their cost doesn't grow with the number of projects. Those issues don't carry
+  their environment, so their results are reported with the ``all`` environment.
+"""
+
+import logging
+import os
+import shlex
+from os import getenv
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+QUERIES_FILE = getenv("SENTRY_ISSUE_QUERIES_FILE")
+MAX_PAGES = int(getenv("SENTRY_ISSUE_QUERIES_MAX_PAGES", "5"))
+DEFAULT_AGE = "24h"
+
+# queries of each file, with its modification time, see load_queries()
+_loaded = {}
+
+LOCAL_FIELDS = {
+    "is": {
+        "unresolved": lambda issue: issue.get("status") == "unresolved",
+        "assigned": lambda issue: bool(issue.get("assignedTo")),
+        "unassigned": lambda issue: not issue.get("assignedTo"),
+        "unhandled": lambda issue: bool(issue.get("isUnhandled")),
+    },
+    "level": "level",
+    "platform": "platform",
+    "logger": "logger",
+}
+
+
+def _parse_query(query):
+    if not isinstance(query, dict) or not query.get("name") or not query.get("query"):
+        raise ValueError("issue queries need a name and a query: {0}".format(query))
+    # an unbalanced quote would only fail when planning
+    shlex.split(str(query.get("query")))
+    return {
+        "name": str(query.get("name")),
+        "query": str(query.get("query")),
+        "age": str(query.get("age") or DEFAULT_AGE),
+    }
+
+
+def load_queries(filename=QUERIES_FILE):
+    """Return the list of queries defined in the queries file, empty if there is none.
+
+    The file is loaded once, until it's modified. An invalid query is logged and skipped, the
+    other ones are still evaluated, and an unreadable file has no queries.
+    """
+    if not filename:
+        return []
+    try:
+        modified_at = os.path.getmtime(filename)
+        if _loaded.get(filename, (None, None))[0] == modified_at:
+            return _loaded[filename][1]
+        with open(filename) as queries_file:
+            config = yaml.safe_load(queries_file) or {}
+    except (OSError, yaml.YAMLError):
+        log.exception("queries: failed to load {file}".format(file=filename))
+        return []
+
+    queries = []
+    for query in (config.get("queries") if isinstance(config, dict) else None) or []:
+        try:
+            queries.append(_parse_query(query))
+        except ValueError as err:
+            log.error("queries: skipping invalid query: {err}".format(err=err))
+    _loaded[filename] = (modified_at, queries)
+    return queries
+
+
+def _parse_term(term):
+    negated = term.startswith("!")
+    key, _, value = term.lstrip("!").partition(":")
+    return negated, key, value
+
+
+def _format_term(term):
+    """Quote a search term value back the way Sentry expects it, if it holds spaces"""
+    if " " not in term:
+        return term
+    negated, key, value = _parse_term(term)
+    return '{0}{1}:"{2}"'.format("!" if negated else "", key, value)
+
+
+def _local_predicate(term):
+    """Return a function evaluating a search term on an issue, None if it can't be done locally"""
+    negated, key, value = _parse_term(term)
+    field = LOCAL_FIELDS.get(key)
+    if field is None or not value or value.startswith("["):
+        return None
+    if isinstance(field, dict):
+        predicate = field.get(value)
+        if predicate is None:
+            return None
+    else:
+
+        def predicate(issue):
+            return str(issue.get(field)) == value
+
+    if negated:
+        return lambda issue: not predicate(issue)
+    return predicate
+
+
+def _unresolved_only(terms):
+    """Return True if the terms select the unresolved issues, the only ones fetched locally"""
+    statuses = [
+        term
+        for term in terms
+        if _parse_term(term)[1] == "is"
+        and _parse_term(term)[2] not in ("assigned", "unassigned", "unhandled")
+    ]
+    return statuses == ["is:unresolved"]
+
+
+def plan_queries(queries, local_ages):
+    """Deduplicate the queries and decide how each distinct query is evaluated.
+
+    Args:
+        queries: A list of queries as returned by `load_queries()`.
+        local_ages: The age windows whose issues are already fetched (i.e.: ["1h", "24h"]).
+
+    Returns:
+        A list of plans, each a dict with the query "names" sharing it, its normalized
+        "query" and "age" and either a list of "predicates" (local) or None (remote).
+    """
+    plans = {}
+    for query in queries:
+        terms = tuple(sorted(shlex.split(query.get("query"))))
+        key = (terms, query.get("age"))
+        if key not in plans:
+            predicates = [_local_predicate(term) for term in terms]
+            local = query.get("age") in local_ages and _unresolved_only(terms) and all(predicates)
+            plans[key] = {
+                "names": [],
+                "query": " ".join(_format_term(term) for term in terms),
+                "age": query.get("age"),
+                "predicates": predicates if local else None,
+            }
+        plans[key]["names"].append(query.get("name"))
+
+    plans = list(plans.values())
+    log.info(
+        "queries: {num} queries planned, {local} evaluated locally, {remote} batched".format(
+            num=len(queries),
+            local=len([plan for plan in plans if plan.get("predicates") is not None]),
+            remote=len([plan for plan in plans if plan.get("predicates") is None]),
+        )
+    )
+    return plans
+
+
+def _aggregate(results, project_slug, env, issue):
+    project_results = results.setdefault(str(project_slug), {})
+    issues, events = project_results.get(str(env), (0, 0))
+    project_results[str(env)] = (issues + 1, events + int(issue.get("count") or 0))
+
+
+def evaluate_queries(plans, projects_data, sentry_api, org_slug, projects):
+    """Evaluate the planned queries.
+
+    Args:
+        plans: A list of plans as returned by `plan_queries()`.
+        projects_data: The collector's projects issues data, keyed by project, env and age.
+        sentry_api: SentryAPI instance, used for the remote queries.
+        org_slug: A organization slug string name.
+        projects: A list of project dicts the remote queries are scoped to, None for all the
+            organization's projects.
+
+    Returns:
+        A dict mapping each query name to {project_slug: {env: (issues, events)}}.
+    """
+    results = {}
+    for plan in plans:
+        plan_results = {}
+        if plan.get("predicates") is not None:
+            for project_slug, project_issues in (projects_data or {}).items():
+                for env, issues_by_age in project_issues.items():
+                    for issue in issues_by_age.get(plan.get("age")) or []:
+                        if all(predicate(issue) for predicate in plan.get("predicates")):
+                            _aggregate(plan_results, project_slug, env, issue)
+        elif projects is None or projects:
+            query = "{query} age:-{age}".format(query=plan.get("query"), age=plan.get("age"))
+            try:
+                pages = sentry_api.org_issues_pages(org_slug, projects, query)
+                for page_number, page in enumerate(pages, start=1):
+                    for issue in page:
+                        _aggregate(
+                            plan_results, (issue.get("project") or {}).get("slug"), "all", issue
+                        )
+                    if page_number >= MAX_PAGES:
+                        log.warning(
+                            "queries: {query} has more than {pages} pages of issues".format(
+                                query=query, pages=MAX_PAGES
+                            )
+                        )
+                        break
+            except Exception:
+                log.exception("queries: {query} query failed, skipping it".format(query=query))
+                continue
+        for name in plan.get("names"):
+            results[name] = plan_results
+    return results
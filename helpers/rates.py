@@ -0,0 +1,64 @@
+"""Recent events rates of the open issues, from their embedded hourly stats.
+
+The issues list endpoint embeds, in each issue ``stats``, the number of events of the issue
+per time bucket. Requested with ``statsPeriod=24h`` (``groupStatsPeriod=24h`` on the
+organization issues endpoint), they're hourly buckets of the last 24 hours: the exporter
+gets per hour trends without making any extra request.
+
+The buckets of the widest age window issues are summed per project, environment and level,
+and averaged over the last complete hours of each rate window. The rates are stored in the
+collector's data structure as a list of rows:
+
+    event_rates = [("project_slug", "production", "error", "1h", 0.25)]
+
+each row ending with the number of events per second.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+STATS_PERIOD = "24h"
+BUCKET_SECONDS = 3600
+RATE_WINDOWS = (("1h", 1), ("6h", 6), ("24h", 24))
+RATE_LABELS = ["environment", "level", "window"]
+
+
+def compute_event_rates(projects_data, age, now=None):
+    """Average the issues hourly events buckets per project, environment and level.
+
+    The current hour bucket is still filling up, only complete buckets are averaged.
+
+    Args:
+        projects_data: The collector's projects issues data, keyed by project, env and age.
+        age: The age window whose issues carry the stats, the widest enabled one.
+        now: Optional; timestamp the buckets are complete at, defaults to the current time.
+    """
+    if now is None:
+        now = datetime.timestamp(datetime.now())
+
+    # start of the last complete hour bucket
+    last_complete = (int(now) // BUCKET_SECONDS - 1) * BUCKET_SECONDS
+    rows = []
+    for project_slug, project_issues in sorted((projects_data or {}).items()):
+        for env, issues_by_age in sorted(project_issues.items()):
+            # same environment label as sentry_open_issue_events for projects without any
+            env_label = str(None) if env == "all" else str(env)
+            buckets = defaultdict(lambda: defaultdict(int))
+            for issue in issues_by_age.get(age) or []:
+                for timestamp, count in (issue.get("stats") or {}).get(STATS_PERIOD) or []:
+                    if timestamp <= last_complete:
+                        buckets[str(issue.get("level"))][timestamp] += count
+            for level, level_buckets in sorted(buckets.items()):
+                for window, num_hours in RATE_WINDOWS:
+                    since = last_complete - (num_hours - 1) * BUCKET_SECONDS
+                    events = sum(count for hour, count in level_buckets.items() if hour >= since)
+                    rows.append(
+                        (
+                            str(project_slug),
+                            env_label,
+                            level,
+                            window,
+                            events / float(num_hours * BUCKET_SECONDS),
+                        )
+                    )
+    return rows
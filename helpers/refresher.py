@@ -0,0 +1,128 @@
+"""Background refresher keeping the collector's cached data structure up to date.
+
+When ``SENTRY_EXPORTER_REFRESH_MODE=background`` scrapes never call the Sentry API, they only
+read the cache file. This module rebuilds it every ``SENTRY_EXPORTER_REFRESH_INTERVAL`` seconds
+from a single dedicated process, started by the gunicorn master (see ``gunicorn.conf.py``),
+so the crawl runs once per replica no matter how many workers serve ``/metrics/``.
+Each refreshed snapshot is also pushed to the Pushgateway, if any (see helpers.push), and
+rendered into the workers shared exposition, if enabled (see helpers.exposition), which is
+rendered again when a webhook marks it stale.
+In ``scrape`` mode it's only started once (``--once``) to warm up the cache on startup.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+from time import monotonic, sleep
+
+from helpers.config import SHARED_EXPOSITION, build_collector, configure_logging
+from helpers.exposition import exposition_file, render
+from helpers.prometheus import REFRESH_INTERVAL
+from helpers.push import PUSHGATEWAY_URL, push
+
+log = logging.getLogger(__name__)
+
+# seconds between checks of the shared exposition, between two refreshes
+STALE_CHECK_INTERVAL = 5
+
+# pid of the warm-up process started by this process (or the gunicorn master the workers are
+# forked from), readiness waits for it to exit, see helpers.utils.readiness_problem()
+warm_up_pid = None
+
+
+def run():
+    """Refresh the cache forever, one refresh every REFRESH_INTERVAL seconds"""
+    collector = build_collector()
+    log.info("refresher: refreshing data every {interval}s".format(interval=REFRESH_INTERVAL))
+    while True:
+        cycle_start = monotonic()
+        try:
+            collector.refresh()
+            log.info("refresher: data refreshed in {:.2f}s".format(monotonic() - cycle_start))
+        except Exception:
+            log.exception("refresher: failed to refresh data from API")
+        else:
+            if SHARED_EXPOSITION == "True":
+                render_exposition(collector)
+            if PUSHGATEWAY_URL:
+                push_snapshot(collector)
+        while monotonic() - cycle_start < REFRESH_INTERVAL:
+            sleep(
+                max(0, min(STALE_CHECK_INTERVAL, REFRESH_INTERVAL - (monotonic() - cycle_start)))
+            )
+            # invalidated by a webhook, see exporter.sentry_webhook()
+            if SHARED_EXPOSITION == "True" and not os.path.exists(exposition_file("text")):
+                render_exposition(collector)
+
+
+def render_exposition(collector):
+    """Render the snapshot just refreshed, scrapes load it until the next rendering"""
+    try:
+        render(collector)
+    except Exception:
+        log.exception("refresher: failed to render the shared exposition")
+
+
+def push_snapshot(collector):
+    """Push the snapshot just refreshed, a failed push is retried with the next one"""
+    try:
+        push(collector)
+    except OSError:
+        log.exception("refresher: failed to push data to {url}".format(url=PUSHGATEWAY_URL))
+
+
+def warm_up():
+    """Build the first data structure once, so the first scrape doesn't pay the whole crawl"""
+    warm_up_start = monotonic()
+    try:
+        build_collector().refresh()
+        log.info("refresher: warm-up done in {:.2f}s".format(monotonic() - warm_up_start))
+    except Exception:
+        log.exception("refresher: warm-up failed, data will be built on the first scrape")
+
+
+def warming_up():
+    """Return True while the warm-up process started with `start(once=True)` is running"""
+    if warm_up_pid is None:
+        return False
+    try:
+        pid, _ = os.waitpid(warm_up_pid, os.WNOHANG)
+    except ChildProcessError:
+        # reaped already, or not a child of the gunicorn workers: the master reaps it on exit
+        try:
+            os.kill(warm_up_pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return pid == 0
+
+
+def start(once=False):
+    """Start the refresher in a dedicated process and return its Popen object.
+
+    A fresh interpreter is used rather than a fork, so the refresher doesn't inherit the
+    parent's threads and locks and the forked workers don't inherit any child bookkeeping.
+
+    Args:
+        once: Optional; only warm up the cache, building the data structure a single time.
+    """
+    global warm_up_pid
+    process = subprocess.Popen(
+        [sys.executable, "-m", "helpers.refresher"] + (["--once"] if once else []),
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    log.info("refresher: started process {pid}".format(pid=process.pid))
+    if once:
+        warm_up_pid = process.pid
+    return process
+
+
+if __name__ == "__main__":
+    configure_logging()
+    if "--once" in sys.argv[1:]:
+        warm_up()
+    else:
+        run()
@@ -0,0 +1,144 @@
+"""Incremental synchronization of the organization's releases.
+
+Releases are listed once for the whole organization, newest first, and fanned out to their
+projects locally instead of being requested per project and environment. Only the pages
+holding releases created since the previous refresh are requested: the first page is always
+read again, as recent releases are the ones still getting new issues and deploys, older
+releases keep the values stored by previous refreshes.
+
+The state is a plain dict stored in the collector's data structure:
+
+    state = {
+        "watermark": "2021-03-01T10:00:00",
+        "releases": {
+            "1.0.0": {
+                "dateCreated": "2021-03-01T10:00:00",
+                "lastDeploy": "2021-03-01T11:00:00",
+                "lastDeployEnvironment": "production",
+                "projects": {"project_slug": 3},
+            }
+        }
+    }
+
+Timestamps are stored truncated to the second (``YYYY-MM-DDTHH:MM:SS``), so they can be
+compared as strings. Only the ``RELEASES_KEPT_PER_PROJECT`` most recent releases of each
+project are kept, older ones are pruned from the state.
+"""
+
+import logging
+from bisect import bisect_right
+from os import getenv
+
+log = logging.getLogger(__name__)
+
+MAX_PAGES = int(getenv("SENTRY_RELEASES_MAX_PAGES", "10"))
+RELEASES_PER_PROJECT = int(getenv("SENTRY_RELEASES_PER_PROJECT", "5"))
+RELEASES_KEPT_PER_PROJECT = int(getenv("SENTRY_RELEASES_KEPT_PER_PROJECT", "100"))
+# release label of the issues: "current" their current release in their environment (one
+# request per new or changed issue), "releases" the latest synchronized release of their
+# project created before they were last seen (no request), "False" none
+RELEASE_LABEL = getenv("SENTRY_ISSUES_RELEASE_LABEL", "current")
+
+
+def _second(timestamp):
+    return str(timestamp)[:19] if timestamp else None
+
+
+def _prune(releases, keep):
+    """Remove the releases which aren't among the most recent ones of any of their projects"""
+    by_project = {}
+    for version, release in releases.items():
+        for project_slug in release.get("projects"):
+            by_project.setdefault(project_slug, []).append(
+                (release.get("dateCreated") or "", version)
+            )
+    kept = set()
+    for project_releases in by_project.values():
+        kept.update(version for _, version in sorted(project_releases)[-keep:])
+    for version in [version for version in releases if version not in kept]:
+        del releases[version]
+
+
+def sync_releases(sentry_api, org_slug, state=None, keep=RELEASES_KEPT_PER_PROJECT):
+    """Update the releases state with the releases created or changed since the last refresh.
+
+    Args:
+        sentry_api: SentryAPI instance.
+        org_slug: A organization slug string name.
+        state: Optional; the state returned by the previous refresh.
+        keep: Optional; the number of most recent releases kept per project.
+
+    Returns:
+        The new releases state.
+    """
+    state = state or {"watermark": None, "releases": {}}
+    watermark = state.get("watermark")
+    releases = state.get("releases")
+    new_watermark = watermark
+
+    for page_number, page in enumerate(sentry_api.releases_pages(org_slug), start=1):
+        for release in page:
+            created = _second(release.get("dateCreated"))
+            last_deploy = release.get("lastDeploy") or {}
+            releases[release.get("version")] = {
+                "dateCreated": created,
+                "lastDeploy": _second(last_deploy.get("dateFinished")),
+                "lastDeployEnvironment": last_deploy.get("environment"),
+                "projects": {
+                    project.get("slug"): project.get("newGroups") or 0
+                    for project in release.get("projects") or []
+                },
+            }
+            if created and (new_watermark is None or created > new_watermark):
+                new_watermark = created
+
+        oldest = _second(page[-1].get("dateCreated")) if page else None
+        if watermark is not None and (oldest is None or oldest <= watermark):
+            break
+        if page_number >= MAX_PAGES:
+            log.warning(
+                "releases: more than {pages} pages of new releases, skipping the rest".format(
+                    pages=MAX_PAGES
+                )
+            )
+            break
+
+    _prune(releases, keep)
+    state["watermark"] = new_watermark
+    return state
+
+
+def projects_releases(state):
+    """Fan the organization's releases out to their projects.
+
+    Returns:
+        A dict mapping each project slug to a (dates, versions) tuple of lists,
+        sorted by release creation date.
+    """
+    by_project = {}
+    for version, release in (state or {}).get("releases", {}).items():
+        for project_slug in release.get("projects"):
+            by_project.setdefault(project_slug, []).append(
+                (release.get("dateCreated") or "", version)
+            )
+    return {
+        project_slug: tuple(list(column) for column in zip(*sorted(project_releases)))
+        for project_slug, project_releases in by_project.items()
+    }
+
+
+def release_at(project_releases, timestamp):
+    """Return the version of the latest release created at or before the given timestamp.
+
+    Args:
+        project_releases: A (dates, versions) tuple as built by `projects_releases()`.
+        timestamp: A Sentry ISO-8601 timestamp (i.e.: an issue lastSeen), the latest
+            release is returned when it's missing.
+    """
+    if not project_releases:
+        return None
+    dates, versions = project_releases
+    if not timestamp:
+        return versions[-1]
+    index = bisect_right(dates, _second(timestamp))
+    return versions[index - 1] if index else None
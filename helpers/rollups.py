@@ -0,0 +1,67 @@
+"""Organization and project level rollups of the open issues.
+
+Dashboards summing thousands of ``sentry_open_issue_events`` series at query time are slow,
+so the issues are aggregated once per snapshot, in a single pass over every project
+environment and age window, into low cardinality rows the collector exports as they are.
+
+The ``platform`` and ``status`` labels multiply the number of rows, they're only added when
+listed in ``SENTRY_ROLLUP_EXTRA_LABELS`` (i.e.: ``platform,status``).
+
+The rollups are stored in the collector's data structure as lists of rows:
+
+    rollups = {
+        "projects": [("project_slug", "production", "1h", "error", "False", 2, 9)],
+        "org": [("production", "1h", "error", "False", 5, 31)],
+    }
+
+each row ending with the number of issues and the sum of their events.
+"""
+
+from collections import Counter
+from os import getenv
+
+EXTRA_LABELS = ("platform", "status")
+ROLLUP_EXTRA_LABELS = [
+    label
+    for label in EXTRA_LABELS
+    if label in getenv("SENTRY_ROLLUP_EXTRA_LABELS", "").replace(" ", "").split(",")
+]
+ROLLUP_LABELS = ["environment", "window", "level"] + ROLLUP_EXTRA_LABELS + ["isUnhandled"]
+
+
+def compute_rollups(projects_data, extra_labels=None):
+    """Aggregate the projects issues by environment, age window, level, the extra labels
+    and handling, per project and for the whole organization.
+
+    Args:
+        projects_data: The collector's projects issues data, keyed by project, env and age.
+        extra_labels: Optional; the issue attributes added as labels, defaults to
+            ROLLUP_EXTRA_LABELS.
+    """
+    if extra_labels is None:
+        extra_labels = ROLLUP_EXTRA_LABELS
+    issues, events = Counter(), Counter()
+    for project_slug, project_issues in (projects_data or {}).items():
+        for env, issues_by_age in project_issues.items():
+            # same environment label as sentry_open_issue_events for projects without any
+            env_label = str(None) if env == "all" else str(env)
+            for window, window_issues in issues_by_age.items():
+                for issue in window_issues or []:
+                    # same isUnhandled label as sentry_open_issue_events
+                    key = (
+                        (str(project_slug), env_label, str(window), str(issue.get("level")))
+                        + tuple(str(issue.get(label)) for label in extra_labels)
+                        + (str(issue.get("isUnhandled")),)
+                    )
+                    issues[key] += 1
+                    events[key] += int(issue.get("count") or 0)
+
+    org_issues, org_events = Counter(), Counter()
+    for key, num in issues.items():
+        org_issues[key[1:]] += num
+        org_events[key[1:]] += events[key]
+
+    return {
+        "projects": [key + (num, events[key]) for key, num in sorted(issues.items())],
+        "org": [key + (num, org_events[key]) for key, num in sorted(org_issues.items())],
+    }
@@ -0,0 +1,117 @@
+"""Adaptive per project and environment refresh scheduling.
+
+Every project environment gets its own refresh interval: it's reset to the minimum when its
+issues changed since the previous refresh, and doubled (up to the maximum) when they didn't.
+On each refresh the due project environments are picked by priority, the most overdue first,
+until the optional request budget is spent; the others keep their previous data. Environments
+never refreshed are the most overdue ones, but they count against the budget too, and are left
+without data until a refresh has room for them. Hot projects stay fresh while idle ones are
+barely polled, and the API cost of a refresh stays bounded as the organization grows.
+
+The state is a plain dict stored in the collector's data structure:
+
+    state = {
+        "project_slug/production": {"interval": 120, "next_due": 1614556800.0, "fingerprint": ""}
+    }
+"""
+
+import heapq
+import logging
+from os import getenv
+from time import time
+
+log = logging.getLogger(__name__)
+
+ADAPTIVE_REFRESH = getenv("SENTRY_EXPORTER_ADAPTIVE_REFRESH", "False")
+MIN_INTERVAL = int(getenv("SENTRY_SCHEDULER_MIN_INTERVAL", "60"))
+MAX_INTERVAL = int(getenv("SENTRY_SCHEDULER_MAX_INTERVAL", "3600"))
+# maximum number of issues requests per refresh, 0 means unlimited
+REQUEST_BUDGET = int(getenv("SENTRY_SCHEDULER_REQUEST_BUDGET", "0"))
+
+
+def schedule_key(project_slug, env):
+    return "{proj}/{env}".format(proj=project_slug, env=env)
+
+
+def issues_fingerprint(issues_by_age):
+    """Summarize a project environment issues, to tell if they changed between two refreshes"""
+    fingerprint = []
+    for age in sorted(issues_by_age):
+        issues = issues_by_age.get(age) or []
+        fingerprint.append(
+            "{age}:{num}:{events}:{last}".format(
+                age=age,
+                num=len(issues),
+                events=sum(int(issue.get("count") or 0) for issue in issues),
+                last=max([str(issue.get("lastSeen")) for issue in issues] or [""]),
+            )
+        )
+    return "|".join(fingerprint)
+
+
+class RefreshScheduler(object):
+    """A simple :class:`RefreshScheduler <RefreshScheduler>` picking what to refresh.
+
+    Typical usage example:
+
+      >>> scheduler = RefreshScheduler(previous_state)
+      >>> due = scheduler.plan(["backend/production", "backend/staging"], cost=3)
+      >>> scheduler.observe("backend/production", issues_fingerprint(issues_by_age))
+      >>> data["schedule"] = scheduler.state
+    """
+
+    def __init__(self, state=None, budget=REQUEST_BUDGET):
+        """Inits RefreshScheduler with the state of the previous refresh"""
+        super(RefreshScheduler, self).__init__()
+        self.state = dict(state or {})
+        self.budget = budget
+        self.spent = 0
+        self.now = time()
+
+    def plan(self, keys, cost=1):
+        """Return the set of keys to refresh now.
+
+        Args:
+            keys: Every project environment key, as built by `schedule_key()`.
+            cost: Number of requests needed to refresh a single key, the request budget is
+                shared by every plan of the refresh.
+        """
+        queue = [((self.state.get(key) or {}).get("next_due", 0), key) for key in keys]
+        heapq.heapify(queue)
+        due = set()
+        while queue:
+            next_due, key = heapq.heappop(queue)
+            if next_due > self.now:
+                break
+            if self.budget and self.spent + cost > self.budget:
+                log.info(
+                    "scheduler: request budget of {budget} spent, {num} refreshes "
+                    "postponed".format(budget=self.budget, num=len(queue) + 1)
+                )
+                break
+            due.add(key)
+            self.spent += cost
+        log.debug("scheduler: {num}/{total} refreshes due".format(num=len(due), total=len(keys)))
+        return due
+
+    def charge(self, cost=1):
+        """Count requests made outside of the plans against the request budget"""
+        self.spent += cost
+
+    def observe(self, key, fingerprint):
+        """Record a refresh result and schedule the next refresh of the key"""
+        entry = self.state.get(key)
+        if entry is None or entry.get("fingerprint") != fingerprint:
+            interval = MIN_INTERVAL
+        else:
+            interval = min(max(entry.get("interval") * 2, MIN_INTERVAL), MAX_INTERVAL)
+        self.state[key] = {
+            "interval": interval,
+            "next_due": self.now + interval,
+            "fingerprint": fingerprint,
+        }
+
+    def forget(self, keys):
+        """Drop the keys that no longer exist (i.e.: removed projects or environments)"""
+        for key in set(self.state) - set(keys):
+            self.state.pop(key)
@@ -0,0 +1,188 @@
+"""Lightweight standalone server, an alternative to the Flask app for serving the metrics.
+
+Run with ``python -m helpers.server``. It's built on the standard library ``http.server``
+and ``prometheus_client`` only: Flask, its extensions and werkzeug are never imported, so it
+starts fast with a small memory footprint. It serves the same ``/metrics/`` page (optionally
+gzip compressed), ``/healthz/live`` and ``/healthz/ready`` checks and basic authentication as
+the Flask app, and starts the refresher the same way as ``gunicorn.conf.py``. The webhooks
+and debug endpoints are only served by the Flask app.
+"""
+
+import base64
+import gzip
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+
+from prometheus_client.core import CollectorRegistry
+from prometheus_client.exposition import choose_encoder
+
+from helpers.config import (
+    AUTH_TOKEN,
+    EXPORTER_BASIC_AUTH,
+    EXPORTER_BASIC_AUTH_PASS,
+    EXPORTER_BASIC_AUTH_USER,
+    ORG_SLUG,
+    SHARED_EXPOSITION,
+    build_collector,
+    configure_logging,
+)
+from helpers.utils import liveness_problem, readiness_problem
+
+log = logging.getLogger(__name__)
+
+LISTEN_ADDR = getenv("SENTRY_EXPORTER_LISTEN_ADDR", "0.0.0.0")
+PORT = int(getenv("SENTRY_EXPORTER_PORT", "9790"))
+
+HOME_PAGE = b"<h1>Sentry Issues & Events Exporter</h1>\
+    <h3>Go to <a href=/metrics/>/metrics</a></h3>\
+    "
+HEALTH_CHECKS = {"live": liveness_problem, "ready": readiness_problem}
+
+
+def authorized(header):
+    """Return True if the Authorization header holds the basic authentication credentials"""
+    if EXPORTER_BASIC_AUTH != "True":
+        return True
+    scheme, _, credentials = (header or "").partition(" ")
+    if scheme.lower() != "basic":
+        return False
+    try:
+        username, _, password = base64.b64decode(credentials).decode("utf-8").partition(":")
+    except (ValueError, UnicodeDecodeError):
+        return False
+    # both compared, in constant time, to not tell which one is wrong
+    valid_user = hmac.compare_digest(username.encode(), EXPORTER_BASIC_AUTH_USER.encode())
+    valid_pass = hmac.compare_digest(password.encode(), EXPORTER_BASIC_AUTH_PASS.encode())
+    return valid_user and valid_pass
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    """Serve the exporter endpoints"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.response_started = False
+        try:
+            self.route()
+        except Exception:
+            log.exception("server: failed to serve {path}".format(path=self.path))
+            if self.response_started:
+                # the status is sent already, the client can only tell from the connection
+                self.close_connection = True
+            else:
+                self.respond(500, "text/plain", b"Internal Server Error")
+
+    def do_HEAD(self):
+        """Same status and headers as GET, without the body, like the Flask app"""
+        self.do_GET()
+
+    def route(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/":
+            self.respond(200, "text/html; charset=utf-8", HOME_PAGE)
+        elif path in ("/metrics", "/metrics/"):
+            if not authorized(self.headers.get("Authorization")):
+                self.respond(
+                    401,
+                    "text/plain",
+                    b"Unauthorized Access",
+                    {"WWW-Authenticate": 'Basic realm="Authentication Required"'},
+                )
+                return
+            self.metrics()
+        elif path.startswith("/healthz/"):
+            self.healthz(path[len("/healthz/") :])
+        else:
+            self.respond(404, "text/plain", b"Not Found")
+
+    def metrics(self):
+        if SHARED_EXPOSITION == "True" and "name[]" not in self.path:
+            from helpers import exposition
+
+            shared = exposition.serve(
+                self.headers.get("Accept"), self.headers.get("Accept-Encoding")
+            )
+            if shared is not None:
+                headers, length, chunks = shared
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(length))
+                self.end_headers()
+                if self.command != "HEAD":
+                    for chunk in chunks:
+                        self.wfile.write(chunk)
+                return
+        try:
+            scrape_timeout = float(self.headers.get("X-Prometheus-Scrape-Timeout-Seconds"))
+        except (TypeError, ValueError):
+            scrape_timeout = None
+        registry = CollectorRegistry()
+        registry.register(build_collector(scrape_timeout))
+        encoder, content_type = choose_encoder(self.headers.get("Accept"))
+        self.respond(200, content_type, encoder(registry))
+
+    def healthz(self, name):
+        """Same responses as flask_healthz: a JSON problem with the check status and title"""
+        check = HEALTH_CHECKS.get(name)
+        if check is None:
+            status, title = 404, "The {} check endpoint is not setup".format(name)
+        else:
+            problem = check()
+            status, title = (503, problem) if problem else (200, "OK")
+        body = json.dumps({"status": status, "title": title}).encode("utf-8")
+        self.respond(status, "application/problem+json", body)
+
+    def respond(self, status, content_type, body, headers=None):
+        if "gzip" in (self.headers.get("Accept-Encoding") or "") and len(body) > 1024:
+            body = gzip.compress(body, 1)
+            headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def end_headers(self):
+        super(ExporterHandler, self).end_headers()
+        self.response_started = True
+
+    def log_message(self, format, *args):
+        log.debug("server: %s - %s", self.address_string(), format % args)
+
+
+def serve(listen_addr=LISTEN_ADDR, port=PORT):
+    """Start the refresher, if needed, then serve the exporter endpoints forever"""
+    from helpers import refresher
+    from helpers.prometheus import REFRESH_MODE, WARMUP
+
+    process = None
+    if REFRESH_MODE == "background":
+        process = refresher.start()
+    elif WARMUP == "True":
+        process = refresher.start(once=True)
+
+    server = ThreadingHTTPServer((listen_addr, port), ExporterHandler)
+    server.daemon_threads = True
+    log.info("server: listening on {addr}:{port}".format(addr=listen_addr, port=port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if process is not None and process.poll() is None:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    if not ORG_SLUG or not AUTH_TOKEN:
+        log.error("ENVs: SENTRY_AUTH_TOKEN or SENTRY_EXPORTER_ORG was not found!")
+        exit(1)
+    serve()
@@ -1,55 +1,245 @@
-import json
+import fcntl
 import logging
+import marshal
+import mmap
 import os.path
-from datetime import datetime
-from flask_healthz import HealthError
-from libs.sentry import SentryAPI
+import struct
+import sys
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from time import time
 from os import getenv
 import os
 
-# TODO - Move these settings to use Flask Ccnfiguration Handling
-# https://flask.palletsprojects.com/en/2.0.x/config/
-DEFAULT_BASE_URL = "https://sentry.io/api/0/"
-BASE_URL = getenv("SENTRY_BASE_URL") or DEFAULT_BASE_URL
-AUTH_TOKEN = getenv("SENTRY_AUTH_TOKEN")
+# binary cache file format, bump CACHE_FORMAT_VERSION when the header layout changes
+# magic, format version, schema version, python major & minor, compressed, expire at, length
+CACHE_HEADER = struct.Struct(">4sHHBB?dQ")
+CACHE_MAGIC = b"SPEC"
+CACHE_FORMAT_VERSION = 1
+CACHE_COMPRESS = getenv("SENTRY_EXPORTER_CACHE_COMPRESS", "False")
+
+# snapshots older than this are considered stuck, by default 5 background refreshes
+MAX_SNAPSHOT_AGE = getenv("SENTRY_EXPORTER_MAX_SNAPSHOT_AGE")
+STARTED_AT = time()
 
 log = logging.getLogger(__name__)
 
 
-def write_cache(filename, data, expire_timestamp=None):
-    """Store OAuth token into a local file using pickle"""
+def write_cache(filename, data, expire_timestamp=None, schema_version=0):
+    """Store a data structure into a local file using the binary cache format.
+
+    The file starts with a fixed size header (see CACHE_HEADER) followed by the ``marshal``
+    encoded data, optionally zlib compressed. ``marshal`` only handles builtin types and is
+    much faster to load than JSON, but its format is tied to the Python version, which is
+    recorded in the header along with the data schema version and the expiration.
+
+    Args:
+        filename: Cache file path.
+        data: dict instance to store.
+        expire_timestamp: Optional; timestamp after which the data is expired, never if None.
+        schema_version: Optional; version of the data structure layout, data stored with a
+            different version is never loaded back.
+
+    Raises:
+        TypeError: An error occurred if the data instance isn't a valid dict
+    """
 
     if not isinstance(data, dict):
         raise TypeError("project param isn't a dictionary")
 
     data.update({"expire_at": expire_timestamp})
-    json.dump(data, open(filename, "w"))
+    payload = marshal.dumps(data)
+    if CACHE_COMPRESS == "True":
+        payload = zlib.compress(payload, 1)
+    header = CACHE_HEADER.pack(
+        CACHE_MAGIC,
+        CACHE_FORMAT_VERSION,
+        schema_version,
+        sys.version_info[0],
+        sys.version_info[1],
+        CACHE_COMPRESS == "True",
+        float("inf") if expire_timestamp is None else expire_timestamp,
+        len(payload),
+    )
+    # write then rename, so concurrent readers (i.e.: gunicorn workers) never see a partial file
+    tmp_filename = "{file}.{pid}.tmp".format(file=filename, pid=os.getpid())
+    with open(tmp_filename, "wb") as cache_file:
+        cache_file.write(header)
+        cache_file.write(payload)
+    os.replace(tmp_filename, filename)
 
 
-def get_cached(filename):
-    """Validate if we already have a local token stored, if doesn't initiate the oauth workflow"""
-    if os.path.isfile(filename):
+@contextmanager
+def cache_lock(filename):
+    """Hold an exclusive lock on a cache file, across processes, for read-modify-write updates"""
+    with open(filename + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
         try:
-            cache = json.load(open(filename, "r"))
-        except json.decoder.JSONDecodeError:
-            os.remove(filename)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_cached(filename, expired_ok=False, schema_version=0):
+    """Load a data structure stored by `write_cache()`.
+
+    The header is checked first, so expired or incompatible files are discarded without
+    decoding them, and uncompressed data is decoded straight from a memory map. ``marshal``
+    isn't meant for untrusted data: files owned by another user, or writable by others
+    (i.e.: planted in a world-writable directory like /tmp), are never loaded.
+
+    Args:
+        filename: Cache file path.
+        expired_ok: Optional; also return the data if it's expired.
+        schema_version: Optional; the expected version of the data structure layout.
+
+    Returns:
+        The stored dict, or False if the file is missing, expired or incompatible.
+    """
+    try:
+        cache_file = open(filename, "rb")
+    except OSError:
+        return False
+
+    with cache_file:
+        stat = os.fstat(cache_file.fileno())
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            log.warning(
+                "cache: {file} is owned by another user or writable by others, ignoring it"
+                "".format(file=filename)
+            )
             return False
-        if cache.get("expire_at") <= datetime.timestamp(datetime.now()):
-            log.debug("cache: expired data, removing cache file: {file}".format(file=filename))
+        try:
+            cache_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
             return False
-        return cache
-    else:
-        return False
+        with cache_map:
+            if len(cache_map) < CACHE_HEADER.size:
+                return False
+            (
+                magic,
+                format_version,
+                data_schema_version,
+                py_major,
+                py_minor,
+                compressed,
+                expire_at,
+                length,
+            ) = CACHE_HEADER.unpack_from(cache_map)
+            if (
+                magic != CACHE_MAGIC
+                or format_version != CACHE_FORMAT_VERSION
+                or data_schema_version != schema_version
+                or (py_major, py_minor) != tuple(sys.version_info[:2])
+                or len(cache_map) != CACHE_HEADER.size + length
+            ):
+                log.debug("cache: incompatible cache file: {file}".format(file=filename))
+                return False
+            if not expired_ok and expire_at <= datetime.timestamp(datetime.now()):
+                log.debug("cache: expired data, ignoring cache file: {file}".format(file=filename))
+                return False
+            payload = memoryview(cache_map)[CACHE_HEADER.size :]
+            try:
+                return marshal.loads(zlib.decompress(payload) if compressed else payload)
+            except (EOFError, ValueError, TypeError, zlib.error):
+                log.warning("cache: corrupted cache file: {file}".format(file=filename))
+                return False
+            finally:
+                payload.release()
+
+
+def snapshot_age(filename):
+    """Return how many seconds ago the cache file was written, None if it doesn't exist.
+
+    Cache files are atomically replaced on each write, so their mtime is the data build time.
+    """
+    try:
+        return time() - os.path.getmtime(filename)
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def _date_label(prefix):
+    """Validate a ``YYYY-MM-DD`` prefix, memoized since many issues share the same day"""
+    try:
+        return date.fromisoformat(prefix).isoformat()
+    except ValueError:
+        return None
+
+
+def iso_date_label(timestamp):
+    """Return the ``YYYY-MM-DD`` label of a Sentry ISO-8601 timestamp.
+
+    Sentry timestamps (i.e.: ``2021-03-01T12:00:00Z`` or ``2021-03-01T12:00:00.123456Z``)
+    always start with the date, so slicing it avoids a full ``strptime`` round trip.
+    Missing or malformed timestamps fall back to today's date.
+    """
+    if timestamp:
+        label = _date_label(str(timestamp)[:10])
+        if label:
+            return label
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def liveness_problem():
+    """Return why the application isn't running properly, None if it is.
+
+    When the data is refreshed in background, a snapshot that is not renewed for more than
+    MAX_SNAPSHOT_AGE seconds (counted from the process start at most) means the refresher
+    is stuck.
+    """
+    from helpers.prometheus import CACHE_FILE, REFRESH_INTERVAL, REFRESH_MODE
+
+    if REFRESH_MODE != "background":
+        return None
+
+    max_age = int(MAX_SNAPSHOT_AGE) if MAX_SNAPSHOT_AGE is not None else 5 * REFRESH_INTERVAL
+    age = snapshot_age(CACHE_FILE)
+    age = min(age, time() - STARTED_AT) if age is not None else time() - STARTED_AT
+    if age > max_age:
+        return "snapshot is {age:.0f}s old, the refresher looks stuck (max: {max}s)".format(
+            age=age, max=max_age
+        )
+    return None
+
+
+def readiness_problem():
+    """Return why the application isn't ready, None once a data snapshot exists.
+
+    In scrape mode, the application is ready once the warm-up process exited, whether it built
+    the snapshot or failed, or right away without any warm-up started (i.e.: the app isn't
+    served with ``gunicorn.conf.py`` or helpers.server): the first scrape builds the snapshot.
+    """
+    from helpers import refresher
+    from helpers.prometheus import CACHE_FILE, REFRESH_MODE
+
+    age = snapshot_age(CACHE_FILE)
+    if age is None:
+        if REFRESH_MODE != "background" and not refresher.warming_up():
+            return None
+        return "snapshot not built yet, warming up"
+    log.debug("healthz: snapshot age: {age:.0f}s".format(age=age))
+    return None
 
 
 def liveness():
-    """Return True if the application is running properly"""
-    return True  # TODO - Can't find a good way to validate if the app is running properly
+    """Return True if the application is running properly, see `liveness_problem()`"""
+    problem = liveness_problem()
+    if problem:
+        from flask_healthz import HealthError
+
+        raise HealthError(problem)
+    return True
 
 
 def readiness():
-    """Return SentryAPI instance saying that app is ready to serve requests"""
-    try:
-        SentryAPI(BASE_URL, AUTH_TOKEN)
-    except Exception as e:
-        raise HealthError(e)
+    """Return True once a data snapshot exists, so scrapes never hit a cold cache"""
+    problem = readiness_problem()
+    if problem:
+        from flask_healthz import HealthError
+
+        raise HealthError(problem)
+    return True
@@ -0,0 +1,337 @@
+"""Apply Sentry integration webhooks to the cached data structure.
+
+Sentry integrations can push ``issue`` (created, resolved, assigned, ignored, unresolved)
+and ``error`` (created) webhooks to the exporter's ``/webhooks/sentry`` endpoint. Each one is
+applied incrementally to the issues of the cached data structure, so issue metrics follow
+Sentry in near real time and the API polling only reconciles them from time to time.
+Webhooks are queued for ``SENTRY_WEBHOOK_FLUSH_INTERVAL`` seconds and applied in batches, a
+burst of events costs a single cache write.
+
+Issue webhooks don't tell in which environment the issue happens, so created issues are
+kept as pending until an error webhook brings their environment (projects without
+environments get them right away). Resolved and ignored issues are removed from the open
+issues lists, and kept aside to be put back in the same lists if they're unresolved.
+"""
+
+import atexit
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from os import getenv
+
+from helpers.config import SHARED_EXPOSITION
+from helpers.decoding import issues_events
+from helpers.prometheus import CACHE_FILE, SNAPSHOT_SCHEMA_VERSION
+from helpers.rollups import compute_rollups
+from helpers.utils import cache_lock, get_cached, iso_date_label, write_cache
+
+log = logging.getLogger(__name__)
+
+MAX_PENDING_ISSUES = 1000
+# seconds the webhooks are queued for, to be applied to the cache in a single write
+FLUSH_INTERVAL = float(getenv("SENTRY_WEBHOOK_FLUSH_INTERVAL", "1"))
+
+_queue = []
+_queue_lock = threading.Lock()
+_flusher = None
+# (cache file key, data structure) written by the last batch of this process
+_snapshot = None
+CLOSING_ACTIONS = ("resolved", "ignored")
+
+
+def verify_signature(secret, body, signature):
+    """Return True if the Sentry-Hook-Signature header matches the request body.
+
+    Args:
+        secret: The integration client secret.
+        body: The raw request body bytes.
+        signature: The Sentry-Hook-Signature header value.
+    """
+    if not secret or not signature:
+        return False
+    digest = hmac.new(secret.encode("utf-8"), msg=body, digestmod=hashlib.sha256).hexdigest()
+    return hmac.compare_digest(digest, signature)
+
+
+def _project_issues(data, project_slug):
+    """Yield every issues list (one per environment and age) of a project"""
+    for issues_by_age in ((data.get("projects_data") or {}).get(project_slug) or {}).values():
+        for issues in issues_by_age.values():
+            yield issues
+
+
+def _update_issue(issue, fields):
+    issue.update(fields)
+    issue["firstSeenDate"] = iso_date_label(issue.get("firstSeen"))
+    issue["lastSeenDate"] = iso_date_label(issue.get("lastSeen"))
+
+
+def _insert_issue(data, project_slug, env, issue):
+    """Add a new issue to every age window of a project environment"""
+    issues_by_age = ((data.get("projects_data") or {}).get(project_slug) or {}).get(env)
+    if issues_by_age is None:
+        return False
+    for issues in issues_by_age.values():
+        if not any(str(known.get("id")) == str(issue.get("id")) for known in issues):
+            issues.insert(0, dict(issue))
+    return True
+
+
+def _keep(data, key, issue_id, value):
+    """Keep a value aside, in a bounded dict of the data structure, the oldest are dropped"""
+    kept = data.setdefault(key, {})
+    kept[issue_id] = value
+    while len(kept) > MAX_PENDING_ISSUES:
+        kept.pop(next(iter(kept)))
+
+
+def _remove_issue(data, project_slug, issue_id):
+    """Remove an issue from the lists of its project.
+
+    Returns:
+        The removed issue, None if it wasn't found, and the [env, age] lists it was removed from.
+    """
+    removed, lists = None, []
+    project_issues = (data.get("projects_data") or {}).get(project_slug) or {}
+    for env, issues_by_age in project_issues.items():
+        for age, issues in issues_by_age.items():
+            for index, known in enumerate(issues):
+                if str(known.get("id")) == issue_id:
+                    removed = issues.pop(index)
+                    lists.append([env, age])
+                    break
+    return removed, lists
+
+
+def _reopen_issue(data, project_slug, issue_id):
+    """Put an unresolved issue back in the lists it was removed from, see `_remove_issue()`"""
+    closed = (data.get("webhook_closed_issues") or {}).pop(issue_id, None)
+    if closed is None:
+        return False
+    issue = closed.get("issue")
+    issue["status"] = "unresolved"
+    project_issues = (data.get("projects_data") or {}).get(project_slug) or {}
+    for env, age in closed.get("lists"):
+        issues = (project_issues.get(env) or {}).get(age)
+        if issues is not None and not any(str(known.get("id")) == issue_id for known in issues):
+            issues.insert(0, dict(issue))
+    return True
+
+
+def _apply_issue(data, action, issue):
+    project_slug = (issue.get("project") or {}).get("slug")
+    issue_id = str(issue.get("id"))
+    if action == "unresolved" and _reopen_issue(data, project_slug, issue_id):
+        return True
+    if action in ("created", "unresolved"):
+        if any(
+            str(known.get("id")) == issue_id
+            for issues in _project_issues(data, project_slug)
+            for known in issues
+        ):
+            return False
+        fields = dict(issue, status="unresolved")
+        _update_issue(fields, {})
+        if not _insert_issue(data, project_slug, "all", fields):
+            _keep(data, "webhook_pending_issues", issue_id, fields)
+        return True
+
+    if action in CLOSING_ACTIONS:
+        # sentry_issues and sentry_open_issue_events only count the unresolved issues
+        (data.get("webhook_pending_issues") or {}).pop(issue_id, None)
+        removed, lists = _remove_issue(data, project_slug, issue_id)
+        if removed is None:
+            return False
+        removed["status"] = action
+        _keep(data, "webhook_closed_issues", issue_id, {"issue": removed, "lists": lists})
+        return True
+
+    if action != "assigned":
+        return False
+    updated = False
+    for issues in _project_issues(data, project_slug):
+        for known in issues:
+            if str(known.get("id")) == issue_id:
+                known.update({"assignedTo": issue.get("assignedTo")})
+                updated = True
+    return updated
+
+
+def _error_environment(error):
+    if error.get("environment"):
+        return error.get("environment")
+    for tag in error.get("tags") or []:
+        key, value = (
+            (tag[0], tag[1]) if isinstance(tag, list) else (tag.get("key"), tag.get("value"))
+        )
+        if key == "environment":
+            return value
+    return None
+
+
+def _apply_error(data, error):
+    issue_id = str(error.get("issue_id"))
+    projects = (data.get("metadata") or {}).get("projects") or []
+    project_slug = next(
+        (
+            project.get("slug")
+            for project in projects
+            if str(project.get("id")) == str(error.get("project"))
+        ),
+        None,
+    )
+    if project_slug is None:
+        return False
+    seen = error.get("datetime") or error.get("received")
+    env = _error_environment(error)
+
+    # the counts are per environment, projects without environments have a single "all" one
+    updated = False
+    project_issues = (data.get("projects_data") or {}).get(project_slug) or {}
+    for list_env in set([env, "all"]):
+        for issues in (project_issues.get(list_env) or {}).values():
+            for known in issues:
+                if str(known.get("id")) == issue_id:
+                    known["count"] = str(int(known.get("count") or 0) + 1)
+                    _update_issue(known, {"lastSeen": seen} if seen else {})
+                    updated = True
+    if updated:
+        return True
+
+    pending = (data.get("webhook_pending_issues") or {}).get(issue_id)
+    if pending is not None and env is not None:
+        pending["count"] = str(int(pending.get("count") or 0) + 1)
+        _update_issue(pending, {"lastSeen": seen} if seen else {})
+        if _insert_issue(data, project_slug, env, pending):
+            data["webhook_pending_issues"].pop(issue_id)
+            return True
+    return False
+
+
+def _apply(data, resource, payload):
+    action = payload.get("action")
+    body = payload.get("data") or {}
+    if resource == "issue" and body.get("issue"):
+        return _apply_issue(data, action, body.get("issue"))
+    if resource == "error" and action == "created" and body.get("error"):
+        return _apply_error(data, body.get("error"))
+    log.debug("webhooks: ignoring {res} {action} webhook".format(res=resource, action=action))
+    return False
+
+
+def _update_aggregates(data):
+    """Compute the aggregates of the issues again, once they're changed"""
+    if "rollups" in data:
+        data["rollups"] = compute_rollups(data.get("projects_data"))
+    if "issues_events" in data:
+        data["issues_events"] = {
+            project_slug: {env: issues_events(issues) for env, issues in project_issues.items()}
+            for project_slug, project_issues in (data.get("projects_data") or {}).items()
+        }
+
+
+def apply_webhook(data, resource, payload):
+    """Apply a single webhook to a data structure built by SentryCollector.
+
+    Args:
+        data: The collector's data structure, modified in place.
+        resource: The Sentry-Hook-Resource header value (i.e.: "issue", "error").
+        payload: The decoded webhook JSON body.
+
+    Returns:
+        True if the data structure was changed.
+    """
+    updated = _apply(data, resource, payload)
+    if updated:
+        _update_aggregates(data)
+    return updated
+
+
+def _file_key(stat):
+    # the cache keeps its modification time when webhooks are applied, its inode changes
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def apply_webhooks_to_cache(webhooks):
+    """Apply a batch of webhooks to the cached data structure, shared by all the workers.
+
+    The data structure written by the last batch of this process is kept in memory and used
+    as long as the cache file is the one it wrote, so consecutive batches don't load it again.
+    The aggregates are computed and the file is written once per batch. The cache file keeps
+    its expiration and modification time, which stand for the last reconciliation with the
+    API (see helpers.utils.liveness).
+
+    Args:
+        webhooks: A list of (resource, payload) tuples, see `apply_webhook()`.
+
+    Returns:
+        True if the cached data structure was changed.
+    """
+    global _snapshot
+    with cache_lock(CACHE_FILE):
+        try:
+            stat = os.stat(CACHE_FILE)
+        except OSError:
+            return False
+        if _snapshot is not None and _snapshot[0] == (CACHE_FILE,) + _file_key(stat):
+            data = _snapshot[1]
+        else:
+            _snapshot = None
+            data = get_cached(CACHE_FILE, expired_ok=True, schema_version=SNAPSHOT_SCHEMA_VERSION)
+        if not data:
+            return False
+        updated = [_apply(data, resource, payload) for resource, payload in webhooks]
+        if not any(updated):
+            return False
+        _update_aggregates(data)
+        write_cache(CACHE_FILE, data, data.get("expire_at"), SNAPSHOT_SCHEMA_VERSION)
+        os.utime(CACHE_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        _snapshot = ((CACHE_FILE,) + _file_key(os.stat(CACHE_FILE)), data)
+    log.debug(
+        "webhooks: applied {num} of {total} webhooks".format(num=sum(updated), total=len(updated))
+    )
+    if SHARED_EXPOSITION == "True":
+        from helpers import exposition
+
+        # the cache keeps its modification time, the refresher renders it again
+        exposition.invalidate()
+    return True
+
+
+def queue_webhook(resource, payload):
+    """Queue a webhook, applied along with the others received within FLUSH_INTERVAL seconds"""
+    global _flusher
+    with _queue_lock:
+        _queue.append((resource, payload))
+        if _flusher is None:
+            _flusher = threading.Timer(FLUSH_INTERVAL, flush)
+            _flusher.daemon = True
+            _flusher.start()
+
+
+def flush():
+    """Apply the queued webhooks to the cached data structure, see `apply_webhooks_to_cache()`.
+
+    Returns:
+        True if the cached data structure was changed.
+    """
+    global _flusher
+    with _queue_lock:
+        webhooks = list(_queue)
+        del _queue[:]
+        if _flusher is not None:
+            _flusher.cancel()
+            _flusher = None
+    if not webhooks:
+        return False
+    try:
+        return apply_webhooks_to_cache(webhooks)
+    except Exception:
+        log.exception("webhooks: failed to apply {num} webhooks".format(num=len(webhooks)))
+        return False
+
+
+# the queued webhooks aren't lost when the worker exits
+atexit.register(flush)
@@ -1,5 +1,6 @@
 from datetime import datetime
 from os import getenv
+from urllib.parse import quote
 
 from retry import retry
 import requests
@@ -11,6 +12,15 @@ retry_settings = {
     "backoff": float(getenv("SENTRY_RETRY_BACKOFF", "2")),
     "jitter": float(getenv("SENTRY_RETRY_JITTER", "0.5")),
 }
+# seconds to wait for the server, a hung endpoint fails instead of blocking the whole refresh
+REQUEST_TIMEOUT = float(getenv("SENTRY_REQUEST_TIMEOUT", "30"))
+
+
+def _projects_param(projects):
+    """Return the project query string parameters, project=-1 (all projects) if None"""
+    if projects is None:
+        return "project=-1"
+    return "&".join("project={id}".format(id=project.get("id")) for project in projects)
 
 
 class SentryAPI(object):
@@ -46,14 +56,37 @@ class SentryAPI(object):
         self.use_legacy_api = use_legacy_api
         self.__token = auth_token
         self.__session = requests.Session()
+        # X-Sentry-Rate-Limit-* headers of the last response, see helpers.planner
+        self.rate_limit_headers = {}
 
     @retry(requests.exceptions.HTTPError, **retry_settings)
     def __get(self, url):
         HEADERS = {"Authorization": "Bearer " + self.__token}
-        response = self.__session.get(self.base_url + url, headers=HEADERS)
+        response = self.__session.get(
+            self.base_url + url, headers=HEADERS, timeout=REQUEST_TIMEOUT
+        )
+        self.rate_limit_headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower().startswith("x-sentry-rate-limit-")
+        }
         response.raise_for_status()
         return response
 
+    def __get_pages(self, url):
+        """Iterate over a paginated endpoint, following the ``Link`` response header cursor.
+
+        Pages are requested lazily, so callers can stop iterating once they have what they need.
+        """
+        cursor = None
+        while True:
+            resp = self.__get(url + ("&cursor={cursor}".format(cursor=cursor) if cursor else ""))
+            yield resp.json()
+            next_page = resp.links.get("next", {})
+            if next_page.get("results") != "true" or not next_page.get("cursor"):
+                return
+            cursor = next_page.get("cursor")
+
     def __post(self, url):
         raise NotImplementedError
 
@@ -231,7 +264,7 @@ class SentryAPI(object):
         environments = [env.get("name") for env in resp.json()]
         return environments
 
-    def issues(self, org_slug, project, environment=None, age="24h"):
+    def issues(self, org_slug, project, environment=None, age="24h", raw=False, stats_period=None):
         """Return a list open issues to a project.
 
         Retrieves the first 100 new open issues created in the past age, using the default query
@@ -244,6 +277,9 @@ class SentryAPI(object):
                 A sequence of strings representing the environment names.
             age: Optional;
                 If age is different from default (aka 24h) query will use now - age.
+            raw: Optional; return the response body bytes instead of the decoded issues.
+            stats_period: Optional; period of the events time buckets embedded in each issue
+                ``stats`` (i.e.: "24h" for hourly buckets, "14d" for daily buckets).
 
         Returns:
             A list mapping with all project's corresponding issues and each element is a dict.
@@ -274,18 +310,107 @@ class SentryAPI(object):
                 age=age,
             )
 
+        if stats_period:
+            # statsPeriod filters the organization issues by date, groupStatsPeriod picks
+            # their stats buckets
+            issues_url = issues_url + "&{param}={period}".format(
+                param="statsPeriod" if self.use_legacy_api else "groupStatsPeriod",
+                period=stats_period,
+            )
+
         if environment:
             issues = {}
             issues_url = issues_url + "&environment={env}".format(env=environment)
             resp = self.__get(issues_url)
             if resp.status_code == 404:
-                issues[environment] = []
+                issues[environment] = b"[]" if raw else []
             else:
-                issues[environment] = resp.json()
+                issues[environment] = resp.content if raw else resp.json()
             return issues
         else:
             resp = self.__get(issues_url)
-            return {"all": resp.json()}
+            return {"all": resp.content if raw else resp.json()}
+
+    def org_issues_pages(self, org_slug, projects, query):
+        """Iterate over the pages of the organization's issues matching a query.
+
+        A single query is run for all the given projects, instead of one request per project.
+
+        Args:
+            org_slug: A organization slug string name.
+            projects: A list of project dicts, None for all the organization's projects.
+            query: A Sentry search query (i.e.: "is:unresolved level:fatal age:-24h").
+
+        Returns:
+            An iterator over the pages, each page is a list of issues and each element is a dict.
+        """
+
+        issues_url = "organizations/{org}/issues/?{projects}&sort=date&query={query}".format(
+            org=org_slug,
+            projects=_projects_param(projects),
+            query=quote(query),
+        )
+        return self.__get_pages(issues_url)
+
+    def discover_pages(self, org_slug, projects, fields, query="", period="1h", dataset=None):
+        """Iterate over the pages of a Discover table query of the organization's events.
+
+        A single query is run for all the given projects, instead of one request per project.
+
+        Args:
+            org_slug: A organization slug string name.
+            projects: A list of project dicts, None for all the organization's projects.
+            fields: A list of fields, tags and aggregates (i.e.: ["project", "count()"]).
+            query: Optional; a Sentry search query (i.e.: "event.type:transaction").
+            period: Optional; the statsPeriod of the query.
+            dataset: Optional; the dataset queried (i.e.: "transactions", "errors").
+
+        Returns:
+            An iterator over the pages, each page is a dict whose data key is the list of rows.
+        """
+
+        events_url = "organizations/{org}/events/?{projects}&{fields}&query={query}".format(
+            org=org_slug,
+            projects=_projects_param(projects),
+            fields="&".join("field={field}".format(field=quote(field)) for field in fields),
+            query=quote(query),
+        )
+        events_url = events_url + "&statsPeriod={period}&per_page=100".format(period=period)
+        if dataset:
+            events_url = events_url + "&dataset={dataset}".format(dataset=dataset)
+        return self.__get_pages(events_url)
+
+    def events_stats(
+        self, org_slug, projects, y_axis, query="", period="1h", interval="5m", dataset=None
+    ):
+        """Return the time series of aggregates of the organization's events.
+
+        Args:
+            org_slug: A organization slug string name.
+            projects: A list of project dicts, None for all the organization's projects.
+            y_axis: A list of aggregates (i.e.: ["count()", "failure_rate()"]).
+            query: Optional; a Sentry search query (i.e.: "event.type:error").
+            period: Optional; the statsPeriod of the query.
+            interval: Optional; the time buckets interval.
+            dataset: Optional; the dataset queried (i.e.: "transactions", "errors").
+
+        Returns:
+            A dict, the series of a single y axis or one series per y axis.
+        """
+
+        stats_url = "organizations/{org}/events-stats/?{projects}&{y_axis}&query={query}".format(
+            org=org_slug,
+            projects=_projects_param(projects),
+            y_axis="&".join("yAxis={field}".format(field=quote(field)) for field in y_axis),
+            query=quote(query),
+        )
+        stats_url = stats_url + "&statsPeriod={period}&interval={interval}".format(
+            period=period, interval=interval
+        )
+        if dataset:
+            stats_url = stats_url + "&dataset={dataset}".format(dataset=dataset)
+        resp = self.__get(stats_url)
+        return resp.json()
 
     def events(self, org_slug, project, environment=None):
         """Return a list of events bound to a project.
@@ -321,6 +446,35 @@ class SentryAPI(object):
             resp = self.__get(events_url)
             return {"all": resp.json()}
 
+    def events_pages(self, org_slug, project, full=False):
+        """Iterate over the pages of events bound to a project, most recent first.
+
+        Follows the cursor of the ``Link`` response header, so callers can stop as soon as
+        they reach events they already know about.
+
+        Args:
+            org_slug: A organization slug string name.
+            project: dict instance of a project.
+            full: Optional; include the full event body (i.e.: dateReceived, stacktrace).
+
+        Returns:
+            An iterator over the pages, each page is a list of events and each element is a dict.
+
+        Raises:
+            TypeError: An error occurred if the project instance isn't a valid dict
+        """
+
+        if not isinstance(project, dict):
+            raise TypeError("project param isn't a dictionary")
+
+        events_url = "projects/{org}/{proj_slug}/events/?sort=date".format(
+            org=org_slug, proj_slug=project.get("slug")
+        )
+        if full:
+            events_url = events_url + "&full=true"
+
+        return self.__get_pages(events_url)
+
     def issue_events(self, issue_id, environment=None):
         """This method lists issue's events."""
 
@@ -389,9 +543,56 @@ class SentryAPI(object):
             resp = self.__get(proj_releases_url)
             return {"all": resp.json()}
 
+    def releases_pages(self, org_slug):
+        """Iterate over the pages of the organization's releases, most recently created first.
+
+        Args:
+            org_slug: A organization slug string name.
+
+        Returns:
+            An iterator over the pages, each page is a list of releases and each element is a dict.
+        """
+
+        return self.__get_pages("organizations/{org}/releases/?sort=date".format(org=org_slug))
+
+    def project_keys(self, org_slug, project_slug):
+        """Return the client keys configuration of an individual project.
+
+        Args:
+            org_slug: A organization's slug string name.
+            project_slug: The project's slug string name
+
+        Returns:
+            A list mapping with all project's client keys and each element is a dict,
+            rate_limit_second is 0 when the key has no rate limit configured.
+        """
+
+        keys_url = "projects/{org}/{proj_slug}/keys/".format(org=org_slug, proj_slug=project_slug)
+        resp = self.__get(keys_url)
+        keys = []
+        for key in resp.json():
+            rate_limit = key.get("rateLimit")
+            if rate_limit and rate_limit.get("window"):
+                rate_limit_second = rate_limit.get("count") / rate_limit.get("window")
+            else:
+                rate_limit_second = 0
+            keys.append(
+                {
+                    "id": key.get("id"),
+                    "name": key.get("name") or key.get("label"),
+                    "is_active": key.get("isActive"),
+                    "rate_limit_second": rate_limit_second,
+                }
+            )
+
+        return keys
+
     def rate_limit(self, org_slug, project_slug):
         """Return client key rate limits configuration on an individual project.
 
+        Only the first project's client key is considered, use `project_keys()`
+        to get the rate limit of every key.
+
         Args:
             org_slug: A organization's slug string name.
             project_slug: The project's slug string name
@@ -400,15 +601,5 @@ class SentryAPI(object):
             A dict corresponding of the project rate limit key
         """
 
-        rate_limit_url = "projects/{org}/{proj_slug}/keys/".format(
-            org=org_slug, proj_slug=project_slug
-        )
-        resp = self.__get(rate_limit_url)
-        if resp.json()[0].get("rateLimit"):
-            rate_limit_window = resp.json()[0].get("rateLimit").get("window")
-            rate_limit_count = resp.json()[0].get("rateLimit").get("count")
-            rate_limit_second = rate_limit_count / rate_limit_window
-        else:
-            rate_limit_second = 0
-
-        return rate_limit_second
+        keys = self.project_keys(org_slug, project_slug)
+        return keys[0].get("rate_limit_second") if keys else 0
@@ -0,0 +1,32 @@
+"""Fixtures shared by the tests serving a cached data structure."""
+
+import time
+
+import pytest
+
+import helpers.prometheus as prometheus
+from helpers.utils import write_cache
+
+
+@pytest.fixture
+def write_snapshot(tmp_path, monkeypatch):
+    """Point the cache file to a temporary one and return a function writing a snapshot to it.
+
+    The function takes the data structure, an organization without projects by default, and
+    its expiration timestamp, a minute from now by default. It returns the cache file path.
+    """
+    cache_file = str(tmp_path / "cache.bin")
+    monkeypatch.setattr(prometheus, "CACHE_FILE", cache_file)
+
+    def write(data=None, expire_at=None):
+        if data is None:
+            data = {
+                "metadata": {"org": {"slug": "acme"}, "projects": [], "projects_envs": {}},
+                "projects_data": {},
+            }
+        if expire_at is None:
+            expire_at = time.time() + 60
+        write_cache(cache_file, data, expire_at, prometheus.SNAPSHOT_SCHEMA_VERSION)
+        return cache_file
+
+    return write
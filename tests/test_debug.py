@@ -0,0 +1,56 @@
+"""Tests for the exporter's profiling endpoints."""
+
+import base64
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import exporter
+
+CREDENTIALS = base64.b64encode(b"prometheus:debug-secret").decode("ascii")
+
+
+@pytest.fixture
+def client(write_snapshot, monkeypatch):
+    monkeypatch.setattr(exporter, "EXPORTER_DEBUG_ENDPOINTS", "True")
+    monkeypatch.setattr(exporter, "EXPORTER_BASIC_AUTH_PASS", "debug-secret")
+    monkeypatch.setitem(exporter.users, "prometheus", generate_password_hash("debug-secret"))
+    write_snapshot()
+    return exporter.app.test_client()
+
+
+def test_debug_endpoints_require_authentication(client):
+    assert client.get("/debug/memory").status_code == 401
+
+
+def test_debug_endpoints_are_disabled_by_default(client, monkeypatch):
+    monkeypatch.setattr(exporter, "EXPORTER_DEBUG_ENDPOINTS", "False")
+    headers = {"Authorization": "Basic " + CREDENTIALS}
+    assert client.get("/debug/profile", headers=headers).status_code == 404
+    # not found before any authentication
+    assert client.get("/debug/memory").status_code == 404
+
+
+def test_debug_endpoints_are_refused_with_the_default_password(client, monkeypatch):
+    monkeypatch.setattr(exporter, "EXPORTER_BASIC_AUTH_PASS", "prometheus")
+    monkeypatch.setitem(exporter.users, "prometheus", generate_password_hash("prometheus"))
+    credentials = base64.b64encode(b"prometheus:prometheus").decode("ascii")
+    headers = {"Authorization": "Basic " + credentials}
+    assert client.get("/debug/profile?target=refresh", headers=headers).status_code == 404
+
+
+def test_profile_reports_the_scrape_hot_path(client):
+    headers = {"Authorization": "Basic " + CREDENTIALS}
+    resp = client.get("/debug/profile?target=scrape&limit=10", headers=headers)
+
+    assert resp.status_code == 200
+    assert "function calls" in resp.get_data(as_text=True)
+    assert client.get("/debug/profile?target=nope", headers=headers).status_code == 400
+
+
+def test_memory_reports_the_snapshot_keys(client):
+    headers = {"Authorization": "Basic " + CREDENTIALS}
+    resp = client.get("/debug/memory?limit=5", headers=headers)
+
+    assert resp.status_code == 200
+    assert "projects_data" in resp.get_data(as_text=True)
@@ -0,0 +1,151 @@
+"""Tests for the user defined Discover queries."""
+
+import pytest
+import requests
+import responses
+
+from helpers.discover import load_discover_queries, run_discover_queries
+from libs.sentry import SentryAPI
+
+BASE_URL = "https://sentry.example.com/api/0/"
+
+QUERIES = """
+queries:
+  - name: transaction_duration
+    dataset: transactions
+    query: "event.type:transaction"
+    fields: ["p95(transaction.duration)", "failure_rate()"]
+    groupby: ["project", "browser.name"]
+    ttl: 60
+  - name: org_errors
+    type: events-stats
+    fields: count()
+"""
+
+PROJECTS = [{"id": "1", "slug": "backend"}, {"id": "2", "slug": "frontend"}]
+
+
+def add_discover_responses():
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/events/?project=1&project=2&field=project"
+        "&field=browser.name&field=p95%28transaction.duration%29&field=failure_rate%28%29"
+        "&query=event.type%3Atransaction&statsPeriod=1h&per_page=100&dataset=transactions",
+        json={
+            "data": [
+                {
+                    "project": "backend",
+                    "browser.name": "Firefox",
+                    "p95(transaction.duration)": 250.0,
+                    "failure_rate()": 0.5,
+                },
+                # older Sentry versions key the aggregates by an alias
+                {
+                    "project": "frontend",
+                    "browser.name": "Chrome",
+                    "p95_transaction_duration": 120,
+                    "failure_rate": None,
+                },
+            ]
+        },
+    )
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/events-stats/?project=1&project=2&yAxis=count%28%29"
+        "&query=&statsPeriod=1h&interval=5m",
+        json={"data": [[1614600000, [{"count": 4}]], [1614600300, [{"count": 1}]]]},
+    )
+
+
+@responses.activate
+def test_queries_are_batched_for_all_projects_and_cached_for_their_ttl(tmp_path):
+    queries_file = tmp_path / "discover.yml"
+    queries_file.write_text(QUERIES)
+    queries = load_discover_queries(str(queries_file))
+    add_discover_responses()
+    sentry_api = SentryAPI(BASE_URL, "token")
+
+    state = run_discover_queries(queries, sentry_api, "acme", PROJECTS, now=1000)
+
+    assert state["transaction_duration"]["labels"] == ["project_slug", "browser_name"]
+    assert state["transaction_duration"]["rows"] == [
+        ["backend", "Firefox", "p95(transaction.duration)", 250.0],
+        ["backend", "Firefox", "failure_rate()", 0.5],
+        ["frontend", "Chrome", "p95(transaction.duration)", 120.0],
+    ]
+    # the last bucket is still filling up
+    assert state["org_errors"]["rows"] == [["count()", 4.0]]
+    assert len(responses.calls) == 2
+
+    assert run_discover_queries(queries, sentry_api, "acme", PROJECTS, state, now=1030) == state
+    assert len(responses.calls) == 2
+    run_discover_queries(queries, sentry_api, "acme", PROJECTS, state, now=1061)
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_failing_query_keeps_its_previous_results(tmp_path):
+    queries_file = tmp_path / "discover.yml"
+    queries_file.write_text(QUERIES)
+    queries = load_discover_queries(str(queries_file))
+    add_discover_responses()
+    sentry_api = SentryAPI(BASE_URL, "token")
+    state = run_discover_queries(queries, sentry_api, "acme", PROJECTS, now=1000)
+
+    responses.replace(
+        responses.GET,
+        BASE_URL + "organizations/acme/events-stats/?project=1&project=2&yAxis=count%28%29"
+        "&query=&statsPeriod=1h&interval=5m",
+        body=requests.exceptions.ConnectionError("timed out"),
+    )
+
+    new_state = run_discover_queries(queries, sentry_api, "acme", PROJECTS, state, now=5000)
+    assert new_state["org_errors"] == state["org_errors"]
+    assert new_state["transaction_duration"]["expire_at"] == 5060
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "{name: p95-duration, fields: [count()]}",
+        "{name: no_fields}",
+        "{name: grouped, type: events-stats, fields: [count()], groupby: [project]}",
+        "{name: reserved, fields: [count()], groupby: [aggregate]}",
+        "{name: transaction_duration, fields: [count()]}",
+        "not_a_mapping",
+    ],
+)
+def test_invalid_queries_are_skipped(tmp_path, query):
+    queries_file = tmp_path / "discover.yml"
+    queries_file.write_text(QUERIES + "  - {0}\n".format(query))
+
+    queries = load_discover_queries(str(queries_file))
+
+    assert [query["name"] for query in queries] == ["transaction_duration", "org_errors"]
+
+
+@responses.activate
+def test_queries_of_all_projects_arent_scoped_to_each_project():
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/events-stats/?project=-1&yAxis=count%28%29"
+        "&query=&statsPeriod=1h&interval=5m",
+        json={"data": [[1614600000, [{"count": 4}]], [1614600300, [{"count": 1}]]]},
+    )
+    queries = [
+        {
+            "name": "org_errors",
+            "type": "events-stats",
+            "dataset": "",
+            "query": "",
+            "fields": ["count()"],
+            "groupby": [],
+            "period": "1h",
+            "interval": "5m",
+            "ttl": 300,
+        }
+    ]
+
+    state = run_discover_queries(queries, SentryAPI(BASE_URL, "token"), "acme", None, now=1000)
+
+    assert state["org_errors"]["rows"] == [["count()", 4.0]]
@@ -0,0 +1,96 @@
+"""Tests for the incremental events tailer."""
+
+import responses
+
+from helpers.events import LAG_BUCKETS, tail_project_events
+from libs.sentry import SentryAPI
+
+BASE_URL = "https://sentry.example.com/api/0/"
+EVENTS_URL = BASE_URL + "projects/acme/backend/events/?sort=date&full=true"
+PROJECT = {"slug": "backend", "id": "1"}
+
+
+def event(event_id, received, created, env="production"):
+    return {
+        "id": event_id,
+        "dateReceived": received,
+        "dateCreated": created,
+        "tags": [{"key": "environment", "value": env}],
+    }
+
+
+@responses.activate
+def test_first_refresh_only_sets_the_watermark():
+    responses.add(
+        responses.GET,
+        EVENTS_URL,
+        json=[event("2", "2021-03-01T10:00:05Z", "2021-03-01T10:00:00Z")],
+    )
+    state = tail_project_events(SentryAPI(BASE_URL, "token"), "acme", PROJECT)
+
+    assert list(state["seen"]) == ["2"]
+    assert state["envs"] == {}
+
+
+@responses.activate
+def test_next_refreshes_only_process_new_events_across_pages():
+    sentry_api = SentryAPI(BASE_URL, "token")
+    responses.add(
+        responses.GET,
+        EVENTS_URL,
+        json=[event("1", "2021-03-01T10:00:00Z", "2021-03-01T10:00:00Z")],
+    )
+    state = tail_project_events(sentry_api, "acme", PROJECT)
+
+    responses.replace(
+        responses.GET,
+        EVENTS_URL,
+        json=[
+            event("3", "2021-03-01T10:02:00.500Z", "2021-03-01T10:01:00Z"),
+            event("2", "2021-03-01T10:01:02Z", "2021-03-01T10:01:00Z", env="staging"),
+        ],
+        headers={"Link": '<{0}>; rel="next"; results="true"; cursor="0:100:0"'.format(EVENTS_URL)},
+    )
+    responses.add(
+        responses.GET,
+        EVENTS_URL + "&cursor=0:100:0",
+        json=[event("1", "2021-03-01T10:00:00Z", "2021-03-01T10:00:00Z")],
+    )
+    state = tail_project_events(sentry_api, "acme", PROJECT, state)
+
+    production, staging = state["envs"]["production"], state["envs"]["staging"]
+    assert (production["count"], production["lag_sum"]) == (1, 60.5)
+    assert production["lag_buckets"][LAG_BUCKETS.index(300)] == 1
+    assert (staging["count"], staging["lag_sum"]) == (1, 2.0)
+    assert sorted(state["seen"]) == ["1", "2", "3"]
+
+
+@responses.activate
+def test_events_received_late_are_counted_once():
+    sentry_api = SentryAPI(BASE_URL, "token")
+    responses.add(
+        responses.GET,
+        EVENTS_URL,
+        json=[event("1", "2021-03-01T10:00:00Z", "2021-03-01T10:00:00Z")],
+    )
+    state = tail_project_events(sentry_api, "acme", PROJECT)
+
+    # ordered by event time, the late event is listed after the watermark event
+    responses.replace(
+        responses.GET,
+        EVENTS_URL,
+        json=[
+            event("3", "2021-03-01T10:01:00Z", "2021-03-01T10:01:00Z"),
+            event("1", "2021-03-01T10:00:00Z", "2021-03-01T10:00:00Z"),
+            event("late", "2021-03-01T10:00:30Z", "2021-03-01T09:58:00Z"),
+            event("0", "2021-03-01T09:40:00Z", "2021-03-01T09:40:00Z"),
+        ],
+    )
+    state = tail_project_events(sentry_api, "acme", PROJECT, state)
+
+    production = state["envs"]["production"]
+    assert (production["count"], production["lag_sum"]) == (2, 150.0)
+
+    state = tail_project_events(sentry_api, "acme", PROJECT, state)
+
+    assert state["envs"]["production"]["count"] == 2
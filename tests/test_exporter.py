@@ -0,0 +1,20 @@
+"""Tests for the exporter's Flask metrics endpoint."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import exporter
+
+
+def test_concurrent_scrapes_each_get_one_copy_of_every_family(write_snapshot):
+    write_snapshot()
+
+    def scrape(_):
+        return exporter.app.test_client().get("/metrics/")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(scrape, range(32)))
+
+    for resp in responses:
+        assert resp.status_code == 200
+        body = resp.get_data(as_text=True)
+        assert body.count("# TYPE sentry_exporter_snapshot_age_seconds gauge") == 1
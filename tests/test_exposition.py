@@ -0,0 +1,81 @@
+"""Tests for the pre-rendered exposition shared by the workers."""
+
+import gzip
+import os
+import time
+
+import pytest
+
+import helpers.prometheus as prometheus
+import helpers.utils as utils
+from helpers import exposition
+from helpers.prometheus import SentryCollector
+
+OPENMETRICS_ACCEPT = "application/openmetrics-text;version=0.0.1,text/plain;version=0.0.4;q=0.5"
+
+
+@pytest.fixture
+def collector(write_snapshot):
+    data = {
+        "metadata": {
+            "org": {"slug": "acme"},
+            "projects": [{"slug": "backend"}],
+            "projects_envs": {},
+        },
+        "projects_events": {"backend": {"received": 12}},
+    }
+    write_snapshot(data)
+    config = ["False", "True", "False", "False", "False", "False"]
+    return SentryCollector(None, "acme", config)
+
+
+def body(shared):
+    headers, length, chunks = shared
+    content = b"".join(chunks)
+    assert len(content) == length
+    return headers, content
+
+
+@pytest.mark.parametrize("accept", [None, OPENMETRICS_ACCEPT])
+def test_exposition_is_rendered_once_and_served_with_the_live_families(
+    collector, accept, monkeypatch
+):
+    # the snapshot age is live, frozen so both responses hold the same one
+    now = time.time()
+    monkeypatch.setattr(utils, "time", lambda: now)
+    exposition.render(collector)
+
+    headers, plain = body(exposition.serve(accept, None))
+    gzip_headers, compressed = body(exposition.serve(accept, "gzip"))
+
+    text = plain.decode("utf-8")
+    assert 'sentry_events_total{project_slug="backend",stat="received"} 12.0' in text
+    assert text.index("sentry_exporter_snapshot_age_seconds ") < text.index("sentry_events")
+    assert text.count("\nsentry_exporter_scrape_partial 0.0\n") == 1
+    assert gzip_headers["Content-Encoding"] == "gzip"
+    assert gzip_headers["Content-Type"] == headers["Content-Type"]
+    assert gzip.decompress(compressed) == plain
+    if accept:
+        assert headers["Content-Type"].startswith("application/openmetrics-text")
+        assert text.endswith("\n# EOF\n") and text.count("# EOF") == 1
+    else:
+        assert headers["Content-Type"].startswith("text/plain")
+
+
+def test_exposition_older_than_the_cache_is_ignored(collector):
+    assert exposition.serve() is None
+
+    exposition.render(collector)
+    rendered_at = os.path.getmtime(exposition.exposition_file("text"))
+    os.utime(prometheus.CACHE_FILE, (rendered_at + 1, rendered_at + 1))
+
+    assert exposition.serve() is None
+
+
+def test_invalidated_exposition_is_ignored(collector):
+    exposition.render(collector)
+
+    exposition.invalidate()
+
+    assert exposition.serve() is None
+    exposition.invalidate()
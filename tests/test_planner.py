@@ -0,0 +1,77 @@
+"""Tests for the Sentry API cost planner, on top of mocked metadata responses."""
+
+import responses
+
+from helpers import planner, releases
+from helpers.planner import estimate, plan
+from libs.sentry import SentryAPI
+
+BASE_URL = "https://sentry.example.com/api/0/"
+
+
+@responses.activate
+def test_plan_counts_requests_per_phase_from_the_metadata_only():
+    responses.add(responses.GET, BASE_URL + "organizations/acme/", json={"slug": "acme"})
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/projects/?all_projects=1",
+        json=[{"id": "1", "slug": "backend"}, {"id": "2", "slug": "frontend"}],
+        headers={"X-Sentry-Rate-Limit-Limit": "40"},
+    )
+    responses.add(
+        responses.GET,
+        BASE_URL + "projects/acme/backend/environments/",
+        json=[{"name": "production"}, {"name": "staging"}],
+        headers={"X-Sentry-Rate-Limit-Limit": "40"},
+    )
+    responses.add(
+        responses.GET,
+        BASE_URL + "projects/acme/frontend/environments/",
+        json=[],
+        headers={"X-Sentry-Rate-Limit-Limit": "40"},
+    )
+    config = ["True", "True", "False", "True", "True", "False", "False", "False", "True", "False"]
+
+    report = plan(SentryAPI(BASE_URL, "test-token"), "acme", None, config)
+
+    lines = {tuple(line.split()[0:2]): line.split() for line in report.splitlines() if line}
+    # 3 project environments (backend: 2, frontend: all) times the 1h and 24h ages
+    assert lines[("issues", "projects/{org}/{project}/issues/")][2] == "6"
+    assert lines[("issues", "issues/{issue}/current-release/")][2] == "0"
+    assert lines[("events", "projects/{org}/{project}/stats/")][2] == "6"
+    # the releases are only listed for the release metrics or the "releases" label
+    assert ("releases", "organizations/{org}/releases/") not in lines
+    assert ("total", "16") in lines
+    assert "rate limit: 40 requests/s" in report
+    assert len(responses.calls) == 4
+
+
+def test_discover_queries_cost_is_amortized_over_their_ttl(monkeypatch):
+    monkeypatch.setattr(planner, "REFRESH_INTERVAL", 60)
+    discover_queries = [
+        {"type": "events", "ttl": 300},
+        {"type": "events", "ttl": 30},
+        {"type": "events-stats", "ttl": 120},
+    ]
+    config = ["False"] * 6
+
+    rows = estimate({"backend": [], "frontend": []}, config, discover_queries=discover_queries)
+
+    discover_rows = {
+        endpoint: requests for phase, endpoint, requests, _ in rows if phase == "discover"
+    }
+    assert discover_rows == {
+        "organizations/{org}/events/": 1.2,
+        "organizations/{org}/events-stats/": 0.5,
+    }
+
+
+def test_releases_are_counted_when_the_issues_are_labelled_from_them(monkeypatch):
+    monkeypatch.setattr(releases, "RELEASE_LABEL", "releases")
+    config = ["True", "False", "False", "True", "False", "False", "False", "False"]
+
+    rows = estimate({"backend": []}, config)
+
+    endpoints = [endpoint for _, endpoint, _, _ in rows]
+    assert "organizations/{org}/releases/" in endpoints
+    assert "issues/{issue}/current-release/" not in endpoints
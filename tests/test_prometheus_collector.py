@@ -0,0 +1,311 @@
+"""Tests for the SentryCollector built on top of mocked Sentry API responses."""
+
+import os
+import re
+import threading
+
+import pytest
+import requests
+import responses
+
+import helpers.prometheus as prometheus
+from helpers import breaker, decoding
+from helpers.prometheus import SentryCollector
+from libs.sentry import SentryAPI
+
+BASE_URL = "https://sentry.example.com/api/0/"
+
+
+@pytest.fixture(autouse=True)
+def cache_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(prometheus, "CACHE_FILE", str(tmp_path / "cache.bin"))
+    monkeypatch.setattr(prometheus, "KEYS_CACHE_FILE", str(tmp_path / "keys-cache.bin"))
+
+
+@pytest.fixture
+def sentry_api():
+    return SentryAPI(base_url=BASE_URL, auth_token="test-token")
+
+
+def add_org_responses():
+    responses.add(responses.GET, BASE_URL + "organizations/acme/", json={"slug": "acme"})
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/projects/?all_projects=1",
+        json=[{"id": "1", "slug": "backend"}],
+    )
+    responses.add(responses.GET, BASE_URL + "projects/acme/backend/environments/", json=[])
+
+
+def collect_families(collector):
+    return {family.name: family for family in collector.collect()}
+
+
+def metric_config(
+    issues="False",
+    events="False",
+    rate_limit="False",
+    event_stream="False",
+    releases="False",
+    rollups="False",
+    rates="False",
+):
+    return [
+        issues,
+        events,
+        rate_limit,
+        issues,
+        issues,
+        issues,
+        event_stream,
+        releases,
+        rollups,
+        rates,
+    ]
+
+
+@responses.activate
+def test_rate_limit_metrics_are_exported_per_key_and_cached(sentry_api):
+    add_org_responses()
+    keys_url = BASE_URL + "projects/acme/backend/keys/"
+    responses.add(
+        responses.GET,
+        keys_url,
+        json=[
+            {"id": "a1", "name": "Default", "rateLimit": {"window": 60, "count": 120}},
+            {"id": "b2", "name": "Browser", "rateLimit": None},
+        ],
+    )
+
+    for _ in range(2):
+        collector = SentryCollector(sentry_api, "acme", metric_config(rate_limit="True"))
+        family = collect_families(collector)["sentry_rate_limit_events_sec"]
+
+    samples = {(s.labels["key_id"], s.labels["key_name"]): s.value for s in family.samples}
+    assert samples == {("a1", "Default"): 2, ("b2", "Browser"): 0}
+    assert len([call for call in responses.calls if call.request.url == keys_url]) == 1
+
+
+@responses.activate
+def test_background_refresh_mode_never_calls_the_api_on_scrape(sentry_api, monkeypatch):
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "background")
+    collector = SentryCollector(sentry_api, "acme", metric_config(issues="True", events="True"))
+
+    families = collect_families(collector)
+
+    assert all(
+        family.samples == []
+        for name, family in families.items()
+        if not name.startswith("sentry_exporter_")
+    )
+    assert len(responses.calls) == 0
+
+
+@responses.activate
+def test_snapshot_age_is_exported(sentry_api):
+    add_org_responses()
+    collector = SentryCollector(sentry_api, "acme", metric_config())
+
+    family = collect_families(collector)["sentry_exporter_snapshot_age_seconds"]
+
+    assert 0 <= family.samples[0].value < 60
+
+
+@responses.activate
+def test_releases_label_issues_and_are_exported_per_project(sentry_api, monkeypatch):
+    monkeypatch.setattr(prometheus, "RELEASE_LABEL", "releases")
+    add_org_responses()
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/releases/?sort=date",
+        json=[
+            {
+                "version": "2.0.0",
+                "dateCreated": "2021-03-02T00:00:00.000Z",
+                "lastDeploy": {"dateFinished": "2021-03-02T01:00:00Z", "environment": "prod"},
+                "projects": [{"slug": "backend", "newGroups": 4}],
+            },
+            {
+                "version": "1.0.0",
+                "dateCreated": "2021-03-01T00:00:00Z",
+                "lastDeploy": None,
+                "projects": [{"slug": "backend", "newGroups": 1}],
+            },
+        ],
+    )
+    responses.add(
+        responses.GET,
+        re.compile(re.escape(BASE_URL + "projects/acme/backend/issues/") + ".*"),
+        json=[
+            {
+                "id": "42",
+                "count": "3",
+                "project": {"slug": "backend"},
+                "firstSeen": "2021-03-01T10:00:00Z",
+                "lastSeen": "2021-03-01T12:00:00.123456Z",
+            }
+        ],
+    )
+    collector = SentryCollector(sentry_api, "acme", metric_config(issues="True", releases="True"))
+
+    families = collect_families(collector)
+
+    (issue,) = families["sentry_open_issue_events"].samples
+    assert (issue.labels["release"], issue.labels["lastSeen"]) == ("1.0.0", "2021-03-01")
+    new_issues = {
+        s.labels["release"]: s.value for s in families["sentry_release_new_issues"].samples
+    }
+    assert new_issues == {"1.0.0": 1, "2.0.0": 4}
+    (deploy,) = families["sentry_project_last_deploy_timestamp_seconds"].samples
+    assert (deploy.labels["environment"], deploy.value) == ("prod", 1614646800)
+    assert families["sentry_project_releases"].samples[0].value == 2
+    assert not any("current-release" in call.request.url for call in responses.calls)
+
+
+@responses.activate
+def test_failing_project_keeps_its_last_good_data_behind_an_open_breaker(sentry_api, monkeypatch):
+    monkeypatch.setattr(prometheus, "CACHE_TTL", -1)
+    monkeypatch.setattr(breaker, "FAILURE_THRESHOLD", 2)
+    add_org_responses()
+    responses.add(responses.GET, BASE_URL + "organizations/acme/releases/?sort=date", json=[])
+    issues_url = re.compile(re.escape(BASE_URL + "projects/acme/backend/issues/") + ".*")
+    responses.add(
+        responses.GET,
+        issues_url,
+        json=[{"id": "42", "count": "3", "project": {"slug": "backend"}}],
+    )
+    collector = SentryCollector(sentry_api, "acme", metric_config(issues="True"))
+    collect_families(collector)
+
+    responses.replace(
+        responses.GET, issues_url, body=requests.exceptions.ConnectionError("timed out")
+    )
+    calls = []
+    for _ in range(3):
+        families = collect_families(collector)
+        calls.append(len([call for call in responses.calls if "/issues/" in call.request.url]))
+
+    (issue,) = families["sentry_open_issue_events"].samples
+    assert issue.labels["issue_id"] == "42"
+    # the breaker opens after 2 failed refreshes, the 3rd one doesn't request the issues
+    assert calls[1] > calls[0] and calls[2] == calls[1]
+    breakers_open = {
+        s.labels["endpoint"]: s.value
+        for s in families["sentry_exporter_circuit_breaker_open"].samples
+    }
+    assert breakers_open == {"environments": 0, "issues": 1}
+    data_ages = [s.labels for s in families["sentry_exporter_project_data_age_seconds"].samples]
+    assert {"project_slug": "backend", "endpoint": "issues"} in data_ages
+
+
+@responses.activate
+def test_slow_rebuild_serves_previous_data_and_finishes_into_the_cache(sentry_api, monkeypatch):
+    monkeypatch.setattr(prometheus, "CACHE_TTL", -1)
+    add_org_responses()
+    collector = SentryCollector(sentry_api, "acme", metric_config(), scrape_timeout=5)
+    assert collect_families(collector)["sentry_exporter_scrape_partial"].samples[0].value == 0
+
+    rebuild = threading.Event()
+    responses.replace(
+        responses.GET,
+        BASE_URL + "organizations/acme/",
+        json={"slug": "acme"},
+        match=[lambda request: (rebuild.wait(5), "")],
+    )
+    collector = SentryCollector(sentry_api, "acme", metric_config(), scrape_timeout=1)
+    families = collect_families(collector)
+    assert families["sentry_exporter_scrape_partial"].samples[0].value == 1
+
+    age = os.path.getmtime(prometheus.CACHE_FILE)
+    rebuild.set()
+    prometheus._refresh_future.result(timeout=5)
+    assert os.path.getmtime(prometheus.CACHE_FILE) > age
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+@responses.activate
+def test_issues_are_decoded_into_compact_issues(sentry_api, monkeypatch, workers):
+    monkeypatch.setattr(decoding, "DECODE_WORKERS", workers)
+    monkeypatch.setattr(decoding, "_pool", None)
+    add_org_responses()
+    responses.add(responses.GET, BASE_URL + "organizations/acme/releases/?sort=date", json=[])
+    responses.add(
+        responses.GET,
+        re.compile(re.escape(BASE_URL + "projects/acme/backend/issues/") + ".*"),
+        json=[
+            {
+                "id": "42",
+                "count": "3",
+                "level": "error",
+                "project": {"slug": "backend"},
+                "lastSeen": "2021-03-01T12:00:00Z",
+                "metadata": {"title": "not used by the exporter"},
+            }
+        ],
+    )
+    responses.add(
+        responses.GET,
+        BASE_URL + "issues/42/current-release/",
+        json={"currentRelease": {"release": {"version": "1.2.0"}}},
+    )
+    collector = SentryCollector(sentry_api, "acme", metric_config(issues="True"))
+
+    try:
+        data = collector.refresh()
+        # the current release is only requested again for the issues seen again
+        collector.refresh()
+    finally:
+        if decoding._pool is not None:
+            decoding._pool.shutdown()
+
+    issue = data["projects_data"]["backend"]["all"]["24h"][0]
+    assert issue == {
+        "id": "42",
+        "count": "3",
+        "level": "error",
+        "project": {"slug": "backend"},
+        "lastSeen": "2021-03-01T12:00:00Z",
+        "firstSeenDate": issue["firstSeenDate"],
+        "lastSeenDate": "2021-03-01",
+    }
+    assert data["projects_data"]["backend"]["all"]["1h"][0]["release"] == "1.2.0"
+    assert len([call for call in responses.calls if "current-release" in call.request.url]) == 1
+    assert data["issues_events"]["backend"]["all"] == {"1h": 3, "24h": 3, "14d": 3}
+    # neither the release metrics nor the release label are enabled
+    assert "releases" not in data
+    assert not any("releases" in call.request.url for call in responses.calls)
+
+
+@responses.activate
+def test_issues_events_rates_come_from_the_widest_age_hourly_stats(sentry_api, monkeypatch):
+    hour = (int(prometheus.datetime.timestamp(prometheus.datetime.now())) // 3600) * 3600
+    add_org_responses()
+    responses.add(responses.GET, BASE_URL + "organizations/acme/releases/?sort=date", json=[])
+    responses.add(
+        responses.GET,
+        re.compile(re.escape(BASE_URL + "projects/acme/backend/issues/") + ".*"),
+        json=[
+            {
+                "id": "42",
+                "count": "3",
+                "level": "error",
+                "project": {"slug": "backend"},
+                # the current hour bucket isn't complete yet, it's left out
+                "stats": {"24h": [[hour - 7200, 7200], [hour - 3600, 3600], [hour, 100]]},
+            }
+        ],
+    )
+    collector = SentryCollector(sentry_api, "acme", metric_config(issues="True", rates="True"))
+
+    families = collect_families(collector)
+
+    rates = {s.labels["window"]: s.value for s in families["sentry_issues_events_rate"].samples}
+    assert rates == {"1h": 1, "6h": 10800 / 21600.0, "24h": 10800 / 86400.0}
+    issues_calls = [call.request.url for call in responses.calls if "/issues/" in call.request.url]
+    assert [url for url in issues_calls if "statsPeriod=24h" in url] == [
+        url for url in issues_calls if "age%3A-14d" in url
+    ]
+    assert all(
+        "stats" not in issue
+        for issue in collector.refresh()["projects_data"]["backend"]["all"]["24h"]
+    )
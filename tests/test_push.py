@@ -0,0 +1,51 @@
+"""Tests pushing snapshots to a local stand-in Pushgateway."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from helpers.prometheus import SentryCollector
+from helpers.push import push
+
+
+class Pushgateway(BaseHTTPRequestHandler):
+    pushes = []
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        self.pushes.append((self.path, body.decode("utf-8")))
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pushgateway():
+    server = HTTPServer(("127.0.0.1", 0), Pushgateway)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Pushgateway.pushes = []
+    yield "127.0.0.1:{port}".format(port=server.server_address[1])
+    server.shutdown()
+
+
+def test_snapshot_is_pushed_in_a_single_request(pushgateway, write_snapshot):
+    data = {
+        "metadata": {
+            "org": {"slug": "acme"},
+            "projects": [{"slug": "backend"}],
+            "projects_envs": {},
+        },
+        "projects_events": {"backend": {"received": 12}},
+    }
+    write_snapshot(data)
+    config = ["False", "True", "False", "False", "False", "False"]
+
+    push(SentryCollector(None, "acme", config), url=pushgateway, job="sentry")
+
+    ((path, body),) = Pushgateway.pushes
+    assert path == "/metrics/job/sentry"
+    assert 'sentry_events_total{project_slug="backend",stat="received"} 12.0' in body
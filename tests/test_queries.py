@@ -0,0 +1,121 @@
+"""Tests for the user defined issue queries planner."""
+
+import pytest
+import responses
+
+from helpers.queries import evaluate_queries, load_queries, plan_queries
+from libs.sentry import SentryAPI
+
+BASE_URL = "https://sentry.example.com/api/0/"
+
+QUERIES = """
+queries:
+  - name: fatal
+    query: "is:unresolved level:fatal"
+  - name: fatal-again
+    query: "level:fatal is:unresolved"
+    age: 24h
+  - name: checkout
+    query: 'transaction:"/checkout page"'
+    age: 1h
+"""
+
+PROJECTS_DATA = {
+    "backend": {
+        "production": {
+            "24h": [
+                {"id": "1", "level": "fatal", "status": "unresolved", "count": "3"},
+                {"id": "2", "level": "error", "status": "unresolved", "count": "5"},
+            ]
+        }
+    }
+}
+
+
+def test_queries_are_deduplicated_and_planned(tmp_path):
+    queries_file = tmp_path / "queries.yml"
+    queries_file.write_text(QUERIES)
+
+    plans = plan_queries(load_queries(str(queries_file)), local_ages=["24h"])
+
+    assert [plan["names"] for plan in plans] == [["fatal", "fatal-again"], ["checkout"]]
+    assert plans[0]["predicates"] is not None
+    assert plans[1]["predicates"] is None
+    assert plans[1]["query"] == 'transaction:"/checkout page"'
+
+
+@responses.activate
+def test_queries_are_evaluated_locally_or_batched_for_all_projects(tmp_path):
+    queries_file = tmp_path / "queries.yml"
+    queries_file.write_text(QUERIES)
+    url = (
+        BASE_URL + "organizations/acme/issues/?project=1&project=2&sort=date"
+        "&query=transaction%3A%22/checkout%20page%22%20age%3A-1h"
+    )
+    responses.add(
+        responses.GET,
+        url,
+        json=[{"id": "7", "count": "2", "project": {"slug": "frontend"}}],
+    )
+    projects = [{"id": "1", "slug": "backend"}, {"id": "2", "slug": "frontend"}]
+
+    results = evaluate_queries(
+        plan_queries(load_queries(str(queries_file)), local_ages=["24h"]),
+        PROJECTS_DATA,
+        SentryAPI(BASE_URL, "token"),
+        "acme",
+        projects,
+    )
+
+    assert results["fatal"] == results["fatal-again"] == {"backend": {"production": (1, 3)}}
+    assert results["checkout"] == {"frontend": {"all": (1, 2)}}
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_remote_queries_of_all_projects_arent_scoped_to_each_project(tmp_path):
+    queries_file = tmp_path / "queries.yml"
+    queries_file.write_text(QUERIES)
+    responses.add(
+        responses.GET,
+        BASE_URL + "organizations/acme/issues/?project=-1&sort=date"
+        "&query=transaction%3A%22/checkout%20page%22%20age%3A-1h",
+        json=[{"id": "7", "count": "2", "project": {"slug": "frontend"}}],
+    )
+
+    results = evaluate_queries(
+        plan_queries(load_queries(str(queries_file)), local_ages=["24h"]),
+        PROJECTS_DATA,
+        SentryAPI(BASE_URL, "token"),
+        "acme",
+        None,
+    )
+
+    assert results["checkout"] == {"frontend": {"all": (1, 2)}}
+
+
+def test_invalid_queries_are_skipped(tmp_path):
+    queries_file = tmp_path / "queries.yml"
+    queries_file.write_text(
+        QUERIES + "  - name: unbalanced\n    query: 'level:\"fatal'\n  - name: no-query\n"
+    )
+
+    assert [query["name"] for query in load_queries(str(queries_file))] == [
+        "fatal",
+        "fatal-again",
+        "checkout",
+    ]
+
+    broken_file = tmp_path / "broken.yml"
+    broken_file.write_text("queries: [")
+    assert load_queries(str(broken_file)) == []
+    assert load_queries(str(tmp_path / "missing.yml")) == []
+
+
+@pytest.mark.parametrize(
+    "query", ["is:resolved level:fatal", "is:ignored level:fatal", "level:fatal"]
+)
+def test_queries_not_limited_to_unresolved_issues_are_batched(query):
+    plans = plan_queries([{"name": "fatal", "query": query, "age": "24h"}], local_ages=["24h"])
+
+    assert plans[0]["predicates"] is None
@@ -0,0 +1,37 @@
+"""Tests for the issues events rates."""
+
+from helpers.rates import compute_event_rates
+
+
+def issue(level, buckets):
+    return {"level": level, "stats": {"24h": buckets}}
+
+
+def test_events_rates_average_the_complete_hours_per_project_env_and_level():
+    hour = 1614600000
+    projects_data = {
+        "backend": {
+            "production": {
+                "14d": [
+                    issue("error", [[hour - 3600, 1800], [hour, 900]]),
+                    issue("error", [[hour - 7200, 3600], [hour - 3600, 1800]]),
+                    issue("fatal", [[hour - 86400, 3600], [hour - 3600, 0]]),
+                ],
+                # only the given age issues are summed
+                "24h": [issue("error", [[hour - 3600, 1800]])],
+            }
+        },
+        "frontend": {"all": {"14d": [{"level": "warning"}]}},
+    }
+
+    # the last complete hour bucket is the one starting at hour, the next one is filling up
+    rates = compute_event_rates(projects_data, "14d", now=hour + 1800 + 3600)
+
+    assert rates == [
+        ("backend", "production", "error", "1h", 900 / 3600.0),
+        ("backend", "production", "error", "6h", 8100 / 21600.0),
+        ("backend", "production", "error", "24h", 8100 / 86400.0),
+        ("backend", "production", "fatal", "1h", 0.0),
+        ("backend", "production", "fatal", "6h", 0.0),
+        ("backend", "production", "fatal", "24h", 0.0),
+    ]
@@ -0,0 +1,34 @@
+"""Tests for the incremental releases synchronization."""
+
+from helpers.releases import sync_releases
+
+
+class ReleasesAPI(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def releases_pages(self, org_slug):
+        return iter(self.pages)
+
+
+def release(version, created, *projects):
+    return {
+        "version": version,
+        "dateCreated": created,
+        "projects": [{"slug": slug, "newGroups": 1} for slug in projects],
+    }
+
+
+def test_only_the_most_recent_releases_of_each_project_are_kept():
+    page = [
+        release("3.0.0", "2021-03-03T00:00:00Z", "backend"),
+        release("2.0.0", "2021-03-02T00:00:00Z", "backend"),
+        release("1.0.0", "2021-03-01T00:00:00Z", "backend", "frontend"),
+        release("0.1.0", "2021-02-01T00:00:00Z", "backend"),
+    ]
+
+    state = sync_releases(ReleasesAPI([page]), "acme", keep=2)
+
+    # 1.0.0 is still one of the most recent frontend releases
+    assert sorted(state["releases"]) == ["1.0.0", "2.0.0", "3.0.0"]
+    assert state["watermark"] == "2021-03-03T00:00:00"
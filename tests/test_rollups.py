@@ -0,0 +1,48 @@
+"""Tests for the open issues rollups."""
+
+from helpers.rollups import compute_rollups
+
+
+def issue(level, count, unhandled=False):
+    return {
+        "level": level,
+        "platform": "python",
+        "status": "unresolved",
+        "isUnhandled": unhandled,
+        "count": str(count),
+    }
+
+
+def test_issues_are_rolled_up_per_project_and_for_the_org():
+    projects_data = {
+        "backend": {
+            "production": {
+                "1h": [issue("error", 2), issue("error", 3), issue("fatal", 1, unhandled=True)],
+                "24h": [issue("error", 7)],
+            }
+        },
+        "frontend": {"all": {"1h": [issue("error", 4)], "24h": []}},
+    }
+
+    rollups = compute_rollups(projects_data)
+
+    assert rollups["projects"] == [
+        ("backend", "production", "1h", "error", "False", 2, 5),
+        ("backend", "production", "1h", "fatal", "True", 1, 1),
+        ("backend", "production", "24h", "error", "False", 1, 7),
+        ("frontend", "None", "1h", "error", "False", 1, 4),
+    ]
+    assert rollups["org"] == [
+        ("None", "1h", "error", "False", 1, 4),
+        ("production", "1h", "error", "False", 2, 5),
+        ("production", "1h", "fatal", "True", 1, 1),
+        ("production", "24h", "error", "False", 1, 7),
+    ]
+
+
+def test_extra_labels_are_opt_in():
+    projects_data = {"backend": {"production": {"1h": [issue("error", 2), issue("error", 3)]}}}
+
+    rollups = compute_rollups(projects_data, extra_labels=["platform", "status"])
+
+    assert rollups["org"] == [("production", "1h", "error", "python", "unresolved", "False", 2, 5)]
@@ -0,0 +1,57 @@
+"""Tests for the adaptive refresh scheduler."""
+
+from time import time
+
+from helpers import scheduler
+from helpers.scheduler import RefreshScheduler, issues_fingerprint, schedule_key
+
+
+def test_unchanged_keys_back_off_and_changed_keys_reset(monkeypatch):
+    monkeypatch.setattr(scheduler, "MIN_INTERVAL", 60)
+    monkeypatch.setattr(scheduler, "MAX_INTERVAL", 200)
+    key = schedule_key("backend", "production")
+    issues = {"24h": [{"count": "3", "lastSeen": "2021-03-01T12:00:00Z"}]}
+
+    state = {}
+    for expected in (60, 120, 200, 200):
+        refresh = RefreshScheduler(state, budget=0)
+        refresh.observe(key, issues_fingerprint(issues))
+        state = refresh.state
+        assert state[key]["interval"] == expected
+
+    issues["24h"].append({"count": "1", "lastSeen": "2021-03-01T13:00:00Z"})
+    refresh = RefreshScheduler(state, budget=0)
+    refresh.observe(key, issues_fingerprint(issues))
+    assert refresh.state[key]["interval"] == 60
+
+
+def test_plan_picks_most_overdue_keys_within_budget():
+    refresh = RefreshScheduler(
+        {
+            "a/all": {"interval": 60, "next_due": time() - 10, "fingerprint": ""},
+            "b/all": {"interval": 60, "next_due": time() - 100, "fingerprint": ""},
+            "c/all": {"interval": 60, "next_due": time() + 100, "fingerprint": ""},
+        },
+        budget=5,
+    )
+
+    # "d/all" was never refreshed, "c/all" isn't due yet
+    assert refresh.plan(["a/all", "b/all", "c/all", "d/all"], cost=2) == {"d/all", "b/all"}
+    # the budget is shared by every plan of the refresh
+    assert refresh.plan(["a/environments"], cost=1) == {"a/environments"}
+    assert refresh.plan(["b/environments"], cost=1) == set()
+
+
+def test_requests_made_outside_of_the_plans_spend_the_budget():
+    refresh = RefreshScheduler({}, budget=3)
+
+    refresh.charge()
+    # never refreshed keys are the most overdue, but they're postponed once the budget is spent
+    assert refresh.plan(["a/all", "b/all"], cost=2) == {"a/all"}
+    assert refresh.plan(["c/all"], cost=1) == set()
+
+
+def test_forget_drops_removed_keys():
+    refresh = RefreshScheduler({"a/all": {}, "b/all": {}})
+    refresh.forget(["a/all"])
+    assert list(refresh.state) == ["a/all"]
@@ -132,6 +132,21 @@ def test_issues_with_legacy_api_disabled_calls_organization_scoped_endpoint():
     assert responses.calls[0].request.url == url
 
 
+@responses.activate
+def test_issues_stats_period_with_legacy_api_disabled_keeps_the_age_filter():
+    # on the organization endpoint statsPeriod is a date range filter, the issue stats
+    # buckets are selected by groupStatsPeriod
+    sentry_api = SentryAPI(base_url=BASE_URL, auth_token="test-token", use_legacy_api=False)
+    project = {"slug": "backend", "id": "123"}
+    url = (
+        BASE_URL + "organizations/acme/issues/?project=123&sort=date&query=age%3A-14d"
+        "&groupStatsPeriod=24h"
+    )
+    responses.add(responses.GET, url, json=[])
+    sentry_api.issues("acme", project, age="14d", stats_period="24h")
+    assert responses.calls[0].request.url == url
+
+
 @responses.activate
 def test_project_releases_calls_expected_endpoint(sentry_api):
     # `project_releases(org_slug, project, environment=None)` -- project is a
@@ -165,3 +180,19 @@ def test_rate_limit_calls_expected_endpoint(sentry_api):
     rate = sentry_api.rate_limit("acme", "backend")
     assert responses.calls[0].request.url == url
     assert rate == 1000 / 7200
+
+
+@responses.activate
+def test_project_keys_returns_every_key_rate_limit(sentry_api):
+    url = BASE_URL + "projects/acme/backend/keys/"
+    responses.add(
+        responses.GET,
+        url,
+        json=[
+            {"id": "a1", "name": "Default", "rateLimit": {"window": 60, "count": 120}},
+            {"id": "b2", "name": "Browser", "rateLimit": None},
+        ],
+    )
+    keys = sentry_api.project_keys("acme", "backend")
+    assert len(responses.calls) == 1
+    assert [(key["id"], key["rate_limit_second"]) for key in keys] == [("a1", 2), ("b2", 0)]
@@ -0,0 +1,91 @@
+"""Tests for the standalone server, on top of a cached data structure."""
+
+import base64
+import gzip
+import json
+import subprocess
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import helpers.prometheus as prometheus
+import helpers.server as server
+
+
+@pytest.fixture
+def url(write_snapshot, monkeypatch):
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "background")
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.ExporterHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{port}".format(port=httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(url, headers=None, method="GET"):
+    try:
+        with urlopen(Request(url, headers=headers or {}, method=method)) as resp:
+            return resp.status, resp.headers, resp.read()
+    except HTTPError as err:
+        return err.code, err.headers, err.read()
+
+
+def test_health_checks_match_the_flask_app(url, write_snapshot):
+    status, headers, body = get(url + "/healthz/ready")
+    assert status == 503
+    assert headers["Content-Type"] == "application/problem+json"
+    assert json.loads(body) == {"status": 503, "title": "snapshot not built yet, warming up"}
+
+    write_snapshot({"metadata": {}})
+    assert json.loads(get(url + "/healthz/ready")[2]) == {"status": 200, "title": "OK"}
+    assert json.loads(get(url + "/healthz/live")[2]) == {"status": 200, "title": "OK"}
+    assert get(url + "/healthz/nope")[0] == 404
+
+
+def test_metrics_are_gzipped_and_require_basic_auth(url, write_snapshot, monkeypatch):
+    monkeypatch.setattr(server, "EXPORTER_BASIC_AUTH", "True")
+    projects = [{"slug": "project-{0}".format(num)} for num in range(50)]
+    data = {
+        "metadata": {"org": {"slug": "acme"}, "projects": projects, "projects_envs": {}},
+        "projects_events": {project["slug"]: {"received": 1} for project in projects},
+    }
+    write_snapshot(data)
+
+    status, headers, _ = get(url + "/metrics/")
+    assert status == 401
+    assert headers["WWW-Authenticate"] == 'Basic realm="Authentication Required"'
+
+    credentials = base64.b64encode(b"prometheus:prometheus").decode("ascii")
+    status, headers, body = get(
+        url + "/metrics/",
+        {"Authorization": "Basic " + credentials, "Accept-Encoding": "gzip"},
+    )
+    assert status == 200
+    assert headers["Content-Encoding"] == "gzip"
+    assert b'sentry_events_total{project_slug="project-49"' in gzip.decompress(body)
+
+
+def test_head_requests_and_failed_scrapes(url, write_snapshot, monkeypatch):
+    write_snapshot({"metadata": {}})
+    status, headers, body = get(url + "/healthz/ready", method="HEAD")
+    assert (status, body) == (200, b"")
+    assert int(headers["Content-Length"]) > 0
+
+    def failing_collector(scrape_timeout=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, "build_collector", failing_collector)
+    status, _, body = get(url + "/metrics/")
+    assert (status, body) == (500, b"Internal Server Error")
+
+
+def test_server_never_imports_flask():
+    modules = subprocess.check_output(
+        [sys.executable, "-c", "import sys, helpers.server; print(sorted(sys.modules))"]
+    )
+    assert b"'flask" not in modules and b"'werkzeug" not in modules
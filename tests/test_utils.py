@@ -0,0 +1,115 @@
+"""Tests for helpers.utils."""
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+from flask_healthz import HealthError
+
+import helpers.prometheus as prometheus
+import helpers.utils as utils
+from helpers import refresher
+from helpers.utils import iso_date_label, readiness
+
+
+def test_iso_date_label_without_fraction():
+    assert iso_date_label("2021-03-01T12:00:00Z") == "2021-03-01"
+
+
+def test_iso_date_label_with_fraction():
+    assert iso_date_label("2021-03-01T12:00:00.123456Z") == "2021-03-01"
+
+
+def test_iso_date_label_falls_back_to_today():
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert iso_date_label(None) == today
+    assert iso_date_label("not-a-date") == today
+
+
+def test_readiness_waits_for_the_first_snapshot(tmp_path, monkeypatch):
+    cache_file = tmp_path / "cache.bin"
+    monkeypatch.setattr(prometheus, "CACHE_FILE", str(cache_file))
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "background")
+
+    with pytest.raises(HealthError):
+        readiness()
+
+    utils.write_cache(str(cache_file), {}, 0)
+    assert readiness() is True
+
+
+def test_readiness_after_a_failed_warm_up_in_scrape_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(prometheus, "CACHE_FILE", str(tmp_path / "cache.bin"))
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "scrape")
+    warm_up = subprocess.Popen(
+        [sys.executable, "-c", "import sys; sys.stdin.read(); exit(1)"], stdin=subprocess.PIPE
+    )
+    monkeypatch.setattr(refresher, "warm_up_pid", warm_up.pid)
+
+    with pytest.raises(HealthError):
+        readiness()
+
+    warm_up.communicate()
+    # the warm-up exited without any snapshot, the first scrape builds it
+    assert readiness() is True
+
+
+def test_readiness_without_warm_up_in_scrape_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(prometheus, "CACHE_FILE", str(tmp_path / "cache.bin"))
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "scrape")
+    monkeypatch.setattr(refresher, "warm_up_pid", None)
+
+    assert readiness() is True
+
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "background")
+    with pytest.raises(HealthError):
+        readiness()
+
+
+def test_liveness_detects_a_stuck_refresher(tmp_path, monkeypatch):
+    cache_file = tmp_path / "cache.bin"
+    utils.write_cache(str(cache_file), {}, 0)
+    monkeypatch.setattr(prometheus, "CACHE_FILE", str(cache_file))
+    monkeypatch.setattr(prometheus, "REFRESH_MODE", "background")
+    assert utils.liveness() is True
+
+    monkeypatch.setattr(utils, "MAX_SNAPSHOT_AGE", -1)
+    with pytest.raises(HealthError):
+        utils.liveness()
+
+
+@pytest.mark.parametrize("compress", ["False", "True"])
+def test_cache_round_trip(tmp_path, monkeypatch, compress):
+    monkeypatch.setattr(utils, "CACHE_COMPRESS", compress)
+    cache_file = str(tmp_path / "cache.bin")
+    data = {"metadata": {"projects": [{"slug": "backend", "id": "1"}]}, "projects_data": {}}
+
+    utils.write_cache(cache_file, data, datetime.now().timestamp() + 60, schema_version=3)
+
+    assert utils.get_cached(cache_file, schema_version=3) == data
+
+
+def test_cache_discards_expired_and_incompatible_files(tmp_path):
+    cache_file = str(tmp_path / "cache.bin")
+    utils.write_cache(cache_file, {"projects_data": {}}, datetime.now().timestamp() - 1)
+
+    assert utils.get_cached(cache_file) is False
+    assert utils.get_cached(cache_file, expired_ok=True) == {
+        "projects_data": {},
+        "expire_at": pytest.approx(datetime.now().timestamp() - 1, abs=5),
+    }
+    assert utils.get_cached(cache_file, expired_ok=True, schema_version=1) is False
+
+    (tmp_path / "legacy.json").write_text('{"expire_at": 0}')
+    assert utils.get_cached(str(tmp_path / "legacy.json"), expired_ok=True) is False
+    assert utils.get_cached(str(tmp_path / "missing.bin")) is False
+
+
+def test_cache_writable_by_others_is_never_loaded(tmp_path):
+    cache_file = str(tmp_path / "cache.bin")
+    utils.write_cache(cache_file, {"planted": True}, 0)
+    os.chmod(cache_file, 0o666)
+
+    assert utils.get_cached(cache_file, expired_ok=True) is False
@@ -0,0 +1,135 @@
+"""Tests replaying recorded Sentry webhooks against the exporter's webhook endpoint."""
+
+import hashlib
+import hmac
+import os
+
+import pytest
+
+import exporter
+import helpers.prometheus as prometheus
+import helpers.webhooks as webhooks
+from helpers.utils import get_cached, write_cache
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "webhooks")
+SECRET = "client-secret"
+
+
+@pytest.fixture
+def cache_file(write_snapshot, monkeypatch):
+    monkeypatch.setattr(exporter, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(webhooks, "FLUSH_INTERVAL", 60)
+    monkeypatch.setattr(webhooks, "_snapshot", None)
+    data = {
+        "metadata": {"projects": [{"id": "1", "slug": "backend"}]},
+        "projects_data": {"backend": {"production": {"1h": [], "24h": []}}},
+    }
+    cache_file = write_snapshot(data, expire_at=0)
+    monkeypatch.setattr(webhooks, "CACHE_FILE", cache_file)
+    return cache_file
+
+
+def replay(client, resource, fixture, secret=SECRET):
+    with open(os.path.join(FIXTURES, fixture), "rb") as payload:
+        body = payload.read()
+    signature = hmac.new(secret.encode("utf-8"), msg=body, digestmod=hashlib.sha256).hexdigest()
+    return client.post(
+        "/webhooks/sentry",
+        data=body,
+        content_type="application/json",
+        headers={"Sentry-Hook-Resource": resource, "Sentry-Hook-Signature": signature},
+    )
+
+
+def cached_issues(cache_file):
+    webhooks.flush()
+    data = get_cached(
+        cache_file, expired_ok=True, schema_version=prometheus.SNAPSHOT_SCHEMA_VERSION
+    )
+    return data["projects_data"]["backend"]["production"]
+
+
+def test_replayed_webhooks_update_the_cached_issues(cache_file):
+    client = exporter.app.test_client()
+    mtime = os.path.getmtime(cache_file)
+
+    assert replay(client, "issue", "issue_created.json").status_code == 204
+    assert cached_issues(cache_file)["1h"] == []
+
+    assert replay(client, "error", "error_created.json").status_code == 204
+    issues = cached_issues(cache_file)
+    for age in ("1h", "24h"):
+        (issue,) = issues[age]
+        assert (issue["count"], issue["lastSeenDate"]) == ("1", "2021-03-02")
+
+    assert replay(client, "issue", "issue_resolved.json").status_code == 204
+    assert cached_issues(cache_file) == {"1h": [], "24h": []}
+    assert os.path.getmtime(cache_file) == mtime
+
+
+def test_error_events_only_count_in_their_environment(cache_file):
+    data = get_cached(
+        cache_file, expired_ok=True, schema_version=prometheus.SNAPSHOT_SCHEMA_VERSION
+    )
+    issue = {"id": "1170820242", "count": "5", "project": {"slug": "backend"}}
+    data["projects_data"]["backend"] = {
+        "production": {"1h": [dict(issue)]},
+        "staging": {"1h": [dict(issue)]},
+    }
+    write_cache(cache_file, data, 0, prometheus.SNAPSHOT_SCHEMA_VERSION)
+
+    replay(exporter.app.test_client(), "error", "error_created.json")
+    webhooks.flush()
+
+    data = get_cached(
+        cache_file, expired_ok=True, schema_version=prometheus.SNAPSHOT_SCHEMA_VERSION
+    )
+    assert data["projects_data"]["backend"]["production"]["1h"][0]["count"] == "6"
+    assert data["projects_data"]["backend"]["staging"]["1h"][0]["count"] == "5"
+
+
+def test_unresolved_issues_are_put_back_in_their_lists(cache_file):
+    client = exporter.app.test_client()
+    replay(client, "issue", "issue_created.json")
+    replay(client, "error", "error_created.json")
+    replay(client, "issue", "issue_resolved.json")
+
+    assert replay(client, "issue", "issue_unresolved.json").status_code == 204
+
+    issues = cached_issues(cache_file)
+    for age in ("1h", "24h"):
+        (issue,) = issues[age]
+        assert (issue["status"], issue["count"]) == ("unresolved", "1")
+
+
+def test_webhooks_with_an_invalid_signature_are_rejected(cache_file):
+    client = exporter.app.test_client()
+
+    assert replay(client, "issue", "issue_created.json", secret="wrong").status_code == 401
+
+
+def test_webhooks_endpoint_is_disabled_without_secret(cache_file, monkeypatch):
+    monkeypatch.setattr(exporter, "WEBHOOK_SECRET", None)
+    client = exporter.app.test_client()
+
+    assert replay(client, "issue", "issue_created.json").status_code == 404
+
+
+def test_queued_webhooks_are_applied_in_a_single_write(cache_file, monkeypatch):
+    writes = []
+    monkeypatch.setattr(
+        webhooks, "write_cache", lambda *args: writes.append(args) or write_cache(*args)
+    )
+    client = exporter.app.test_client()
+    replay(client, "issue", "issue_created.json")
+    replay(client, "error", "error_created.json")
+    replay(client, "error", "error_created.json")
+
+    assert cached_issues(cache_file)["1h"][0]["count"] == "2"
+    assert len(writes) == 1
+
+    # the next batch applies to the data structure kept in memory, not to a reload
+    monkeypatch.setattr(webhooks, "get_cached", None)
+    replay(client, "issue", "issue_resolved.json")
+    assert webhooks.flush() is True
+    assert len(writes) == 2